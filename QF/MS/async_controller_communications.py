@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+# Room Controller Communications Class (asyncio edition)
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# This is a drop-in alternative to ControllerCommunications for puzzle hosts that
+# want to run on an asyncio event loop instead of spinning on ProcessEvents().
+#
+# The callback contract is exactly the same (command_reset, command_activate,
+# command_solve, command_fail, command_reboot, ping, pong). The differences are:
+#  - the constructor does not connect, you run the class with "await Run()"
+#  - the paho socket is serviced by the event loop (add_reader/add_writer), so
+#    there is no paho network thread
+#  - heartbeats are a scheduled task, so an idle controller is actually idle
+#
+# PublishStatus() is still safe to call from other threads (gpiozero callbacks,
+# threading.Timer, etc.), paho only queues the packet and we hand the socket write
+# back over to the event loop.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Python3 Dependencies:
+#  - paho-mqtt-client (1.x)
+#  $> sudo pip3 install paho-mqtt
+
+
+import asyncio
+import socket
+import threading
+import paho.mqtt.client as mqtt
+
+import mqtt_v5
+import queued_log
+from controller_communications import ControllerCommunications
+
+
+class AsyncControllerCommunications(ControllerCommunications):
+
+  # A Bus (see local_bus.py) is only ever bridged here, the event loop needs a real broker socket to drive
+  def __init__(self, puzzleID, mqttBroker, mqttPort = 1883, MQTTv5 = False, RetainState = False, Bus = None):
+    if mqttBroker is None:
+      raise ValueError('Puzzle ID [{}] needs an MQTT broker, the asyncio variant cannot run on a local bus alone'.format(puzzleID))
+    #end if
+
+    super().__init__(puzzleID, mqttBroker, mqttPort, AutoConnect = False, MQTTv5 = MQTTv5, RetainState = RetainState, Bus = Bus)
+
+    self.__loop = None
+    self.__loopThreadID = None
+    self.__miscTask = None
+    self.__heartbeatTask = None
+    self.__reconnectTask = None
+    self.__heartbeatWake = None
+    self.__stopping = False
+
+    self.mqttClient.on_socket_open            = self.__handlerSocketOpen
+    self.mqttClient.on_socket_close           = self.__handlerSocketClose
+    self.mqttClient.on_socket_register_write   = self.__handlerSocketRegisterWrite
+    self.mqttClient.on_socket_unregister_write = self.__handlerSocketUnregisterWrite
+  #end def
+
+
+  async def Run(self):
+    self.__loop = asyncio.get_running_loop()
+    self.__loopThreadID = threading.get_ident()
+
+    # There is no main loop calling ProcessEvents(), the event loop itself is what has to keep moving (see loop_watchdog.py)
+    self._loopWatchdog.AddProbe('eventLoop', lambda probeDone: self.__loop.call_soon_threadsafe(probeDone))
+    self.__heartbeatWake = asyncio.Event()
+    self.__stopping = False
+
+    await self.__connectWithBackOff(WaitFirst = False)
+
+    self.__heartbeatTask = asyncio.ensure_future(self.__heartbeatLoop())
+
+    try:
+      await self.__heartbeatTask
+    except asyncio.CancelledError:
+      pass
+    #end try
+  #end def (Run)
+
+
+  def Stop(self):
+    self.__stopping = True
+
+    for task in [self.__heartbeatTask, self.__reconnectTask, self.__miscTask]:
+      if task is not None:
+        task.cancel()
+      #end if
+    #end for
+
+    self.disconnect()
+  #end def (Stop)
+
+
+  # The heartbeat is scheduled by the event loop, this is a no-op so existing
+  # "while True: ProcessEvents()" code keeps working if it is ever pointed at this class.
+  def ProcessEvents(self):
+    pass
+  #end def (ProcessEvents)
+
+
+  async def __connectWithBackOff(self, WaitFirst = True):
+
+    # After losing the broker, everybody in the room lost it at the same moment, so we don't all rush straight back
+    if WaitFirst is True:
+      backOffDelay = self._reconnectBackoff.NextDelay()
+      queued_log.Warning('>> Lost MQTT broker connection, next attempt in {:.1f} seconds..', backOffDelay)
+      await asyncio.sleep(backOffDelay)
+    #end if
+
+    while (self._MQTTConnected == False) and (self.__stopping == False):
+      try:
+        queued_log.Info(">> Attempting MQTT broker connection..")
+
+        # Resolve on the loop's resolver, then let paho do the TCP connect in an executor so
+        # a broker that is still booting can't stall every other task on the loop.
+        addressInfo = await self.__loop.getaddrinfo(self.mqttBroker, self.mqttPort, type=socket.SOCK_STREAM)
+        brokerAddress = addressInfo[0][4][0]
+
+        await self.__loop.run_in_executor(None, self.mqttClient.connect, brokerAddress, self.mqttPort, self.mqttKeepalive)
+        return
+
+      except asyncio.CancelledError:
+        raise
+
+      except Exception as connectError:
+        self._reconnectBackoff.OnConnectFailed(str(connectError))
+        backOffDelay = self._reconnectBackoff.NextDelay()
+
+        queued_log.Warning('>> Unable to connect to MQTT broker! Sleeping for {:.1f} seconds..', backOffDelay)
+        await asyncio.sleep(backOffDelay)
+      #end try
+    #end while
+
+  #end def (__connectWithBackOff)
+
+
+  async def __heartbeatLoop(self):
+    while True:
+      # pingDelay can change while we wait (see EnableAdaptiveHeartbeats), and a state change wakes us early
+      try:
+        await asyncio.wait_for(self.__heartbeatWake.wait(), timeout=self.pingDelay)
+      except asyncio.TimeoutError:
+        pass
+      #end try
+
+      self.__heartbeatWake.clear()
+
+      if self._MQTTConnected is True:
+        self._timestampLastPing = self.__loop.time()
+        self.SendPing()
+      #end if
+    #end while
+  #end def (__heartbeatLoop)
+
+
+  async def __miscLoop(self):
+    while self.mqttClient.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+      await asyncio.sleep(1)
+    #end while
+  #end def (__miscLoop)
+
+
+  def _requestHeartbeat(self):
+    if self.__heartbeatWake is not None:
+      self.__runOnLoop(self.__heartbeatWake.set)
+    #end if
+  #end def (_requestHeartbeat)
+
+
+  def handlerMQTTonDisconnect(self, client, userdata, rc, properties = None):
+
+    self._MQTTConnected = False
+    self._outboundQueue.SetConnected(False)
+
+    if self._mqttSession is not None:
+      self._mqttSession.OnDisconnect()
+    #end if
+
+    if rc == 0:
+      self._reconnectBackoff.OnDisconnected()
+    else:
+      self._reconnectBackoff.OnDisconnected(mqtt_v5.ErrorString(rc))
+    #end if
+
+    if self._puzzleState == 'REBOOTING':
+      self._fireCallback('command_reboot')
+
+    elif self.__stopping is False:
+      # Never reconnect inline from inside the read callback, schedule it on the loop instead
+      if (self.__reconnectTask is None) or (self.__reconnectTask.done()):
+        self.__reconnectTask = asyncio.ensure_future(self.__connectWithBackOff())
+      #end if
+    #end if
+
+  #end def (handlerMQTTonDisconnect)
+
+
+  # paho calls the four socket handlers below from whatever thread touched the client
+  # (connect() runs in an executor, publish() can come from a GPIO thread), so anything
+  # that didn't come from the loop itself is marshalled back onto it before we touch it.
+  def __runOnLoop(self, function, *args):
+    if threading.get_ident() == self.__loopThreadID:
+      function(*args)
+    else:
+      self.__loop.call_soon_threadsafe(function, *args)
+    #end if
+  #end def (__runOnLoop)
+
+
+  def __handlerSocketOpen(self, client, userdata, sock):
+    self.__runOnLoop(self.__socketOpened, sock)
+  #end def (__handlerSocketOpen)
+
+
+  def __socketOpened(self, sock):
+    self.__loop.add_reader(sock, self.mqttClient.loop_read)
+
+    if (self.__miscTask is None) or (self.__miscTask.done()):
+      self.__miscTask = asyncio.ensure_future(self.__miscLoop())
+    #end if
+  #end def (__socketOpened)
+
+
+  # The socket is closed as soon as this returns, it has to come off the loop right now
+  def __handlerSocketClose(self, client, userdata, sock):
+    self.__runOnLoop(self.__socketClosed, sock)
+  #end def (__handlerSocketClose)
+
+
+  def __socketClosed(self, sock):
+    self.__loop.remove_reader(sock)
+    self.__loop.remove_writer(sock)
+
+    if self.__miscTask is not None:
+      self.__miscTask.cancel()
+    #end if
+  #end def (__socketClosed)
+
+
+  def __handlerSocketRegisterWrite(self, client, userdata, sock):
+    self.__runOnLoop(self.__loop.add_writer, sock, self.mqttClient.loop_write)
+  #end def (__handlerSocketRegisterWrite)
+
+
+  def __handlerSocketUnregisterWrite(self, client, userdata, sock):
+    self.__runOnLoop(self.__loop.remove_writer, sock)
+  #end def (__handlerSocketUnregisterWrite)
+
+#end class
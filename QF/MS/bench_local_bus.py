@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+# Local Bus Benchmark
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Measures the round trip of a POPI event between two puzzles hosted on the same hub,
+# from SendPuzzleEvent() on one to the handler registered on the other having run (on
+# its callback worker, see callback_executor.py), and back again.
+#
+# Without a broker argument the hub runs broker-free on a LocalBus (see local_bus.py).
+# With one, the same round trip is measured through the broker, and again with the bus
+# bridged to it, which is how the multi controller runs.
+#
+#  $> python3 bench_local_bus.py [iterations] [broker] [port]
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import sys
+import threading
+import time
+
+import local_bus
+from controller_communications_hub import ControllerCommunicationsHub
+
+
+iterations = 2000
+mqttBroker = None
+mqttPort   = 1883
+
+if len(sys.argv) > 1:
+  iterations = int(sys.argv[1])
+#end if
+
+if len(sys.argv) > 2:
+  mqttBroker = sys.argv[2]
+#end if
+
+if len(sys.argv) > 3:
+  mqttPort = int(sys.argv[3])
+#end if
+
+
+def measureRoundTrip(transportName, mqttBroker, localBus):
+
+  hub = ControllerCommunicationsHub('bench', mqttBroker, mqttPort, Bus = localBus)
+  fuel = hub.AddPuzzle('bench-fuel')
+  keys = hub.AddPuzzle('bench-keys')
+
+  replyReceived = threading.Event()
+
+  keys.RegisterPuzzleEventHandler('PING', lambda eventName, payload: keys.SendPuzzleEvent('bench-fuel', 'PONG', payload))
+  fuel.RegisterPuzzleEventHandler('PONG', lambda eventName, payload: replyReceived.set())
+
+  # The hosted puzzles only subscribe once the hub's connection is up
+  time.sleep(0.5)
+
+  roundTrips = []
+  lostCount = 0
+
+  for index in range(iterations):
+    replyReceived.clear()
+
+    timestampStart = time.perf_counter()
+    fuel.SendPuzzleEvent('bench-keys', 'PING', str(index))
+
+    if replyReceived.wait(2) is False:
+      lostCount += 1
+      continue
+    #end if
+
+    roundTrips.append(time.perf_counter() - timestampStart)
+  #end for
+
+  hub.disconnect()
+
+  roundTrips.sort()
+
+  if len(roundTrips) == 0:
+    print('{:<22} {:>10} {:>10} {:>10} {:>8}'.format(transportName, '-', '-', '-', lostCount))
+    return
+  #end if
+
+  print('{:<22} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}'.format(transportName,
+                                                            roundTrips[len(roundTrips) // 2] * 1000000,
+                                                            roundTrips[int(len(roundTrips) * 0.99)] * 1000000,
+                                                            sum(roundTrips) / len(roundTrips) * 1000000,
+                                                            lostCount))
+#end def (measureRoundTrip)
+
+
+print('{} round trips per measurement'.format(iterations))
+print('')
+print('{:<22} {:>10} {:>10} {:>10} {:>8}'.format('TRANSPORT', 'P50 (us)', 'P99 (us)', 'MEAN (us)', 'LOST'))
+
+measureRoundTrip('local bus', None, local_bus.LocalBus())
+
+if mqttBroker is not None:
+  measureRoundTrip('broker', mqttBroker, None)
+  measureRoundTrip('local bus + broker', mqttBroker, local_bus.LocalBus())
+#end if
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+# Wire Format Benchmark
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Compares payload size and encode/decode cost of every available wire format
+# (see wire_format.py) for the heartbeat that ControllerCommunications.SendPing()
+# actually sends, both as a full snapshot and as a delta heartbeat.
+#
+# No broker is needed, the communications class is never connected.
+#
+#  $> python3 bench_wire_format.py [iterations]
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import sys
+import timeit
+
+import wire_format
+from controller_communications import ControllerCommunications
+
+
+iterations = 20000
+
+if len(sys.argv) > 1:
+  iterations = int(sys.argv[1])
+#end if
+
+
+comms = ControllerCommunications('pressure', 'ms-roomcontroller.local', AutoConnect = False)
+comms.PublishStatus('ACTIVE')
+
+pingPayloads = {}
+pingPayloads['full ping'] = comms.BuildPing()
+
+comms.EnableDeltaHeartbeats()
+comms.BuildPing()
+pingPayloads['delta ping'] = comms.BuildPing()
+
+
+print('Python v{}.{}.{}, {} iterations per measurement'.format(sys.version_info[0], sys.version_info[1], sys.version_info[2], iterations))
+
+if 'msgpack' not in wire_format.GetAvailableFormats():
+  print('(msgpack is not installed, only JSON will be measured)')
+#end if
+
+print('')
+print('{:<12} {:<10} {:>8} {:>14} {:>14}'.format('PAYLOAD', 'FORMAT', 'BYTES', 'ENCODE (us)', 'DECODE (us)'))
+
+for payloadName, pingData in pingPayloads.items():
+  for wireFormat in wire_format.GetAvailableFormats():
+
+    encodedPayload = wire_format.EncodePayload(pingData, wireFormat)
+
+    # This is what actually goes on the wire, paho sends str payloads as UTF-8
+    if isinstance(encodedPayload, str):
+      encodedPayload = encodedPayload.encode()
+    #end if
+
+    encodeSeconds = timeit.timeit(lambda: wire_format.EncodePayload(pingData, wireFormat), number=iterations)
+    decodeSeconds = timeit.timeit(lambda: wire_format.DecodePayload(encodedPayload), number=iterations)
+
+    print('{:<12} {:<10} {:>8} {:>14.2f} {:>14.2f}'.format(payloadName, wireFormat, len(encodedPayload),
+                                                             encodeSeconds / iterations * 1000000,
+                                                             decodeSeconds / iterations * 1000000))
+  #end for
+#end for
@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+
+# Puzzle Callback Executor
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Callbacks registered with RegisterCallback() used to run right inside paho's network
+# thread. A puzzle flashing its LEDs with time.sleep() in Fail() held up keepalives, and
+# on a multi-puzzle host it held up every other puzzle's commands as well.
+#
+# A CallbackExecutor runs callbacks on a small pool of worker threads instead:
+#  - callbacks for the same puzzle ID run one at a time, in the order they were fired
+#  - different puzzle IDs run side by side, so one slow puzzle can't stall the others
+#  - a callback taking longer than SlowAfter seconds is reported as slow when it finishes
+#  - a callback still running after Timeout seconds is reported as timed out and counted
+#    as stalled until it returns. Its puzzle's remaining callbacks keep waiting for it, so
+#    they still run in order. Python can't kill a thread, so a fresh worker takes the stuck
+#    one's place in the pool for the other puzzles, and the stuck one retires when it is done.
+#
+# GetSharedExecutor() hands out one executor per process, shared by every puzzle ID in it.
+# GetOldestWork() is how long the oldest callback has been waiting or running, whichever
+# puzzle it is for, the loop watchdog keeps an eye on it (see loop_watchdog.py).
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import threading
+import time
+import traceback
+
+import queued_log
+
+
+class _RunningCallback:
+
+  __slots__ = ['puzzleID', 'eventName', 'onSlow', 'timestampStarted', 'timedOut', 'threadIdent']
+
+  def __init__(self, puzzleID, eventName, onSlow):
+    self.puzzleID = puzzleID
+    self.eventName = eventName
+    self.onSlow = onSlow
+    self.timestampStarted = time.monotonic()
+    self.timedOut = False
+    self.threadIdent = threading.get_ident()
+  #end def
+
+#end class
+
+
+class CallbackExecutor:
+
+  def __init__(self, Workers = 4, SlowAfter = 1.0, Timeout = 30.0):
+    self.__workerCount = Workers
+    self.__slowAfter   = SlowAfter
+    self.__timeout     = Timeout
+
+    self.timeout = Timeout
+
+    self.__condition = threading.Condition()
+
+    self.__queues = {}                        # puzzleID -> deque of (eventName, callbackFunction, onSlow, timestampQueued)
+    self.__readyPuzzles = collections.deque() # puzzle IDs with work waiting and nothing running
+    self.__running = {}                       # puzzleID -> _RunningCallback
+
+    self.__completedCount = 0
+    self.__slowCount      = 0
+    self.__timedOutCount  = 0
+    self.__errorCount     = 0
+
+    for workerIndex in range(self.__workerCount):
+      self.__startWorker()
+    #end for
+
+    watchdogThread = threading.Thread(target=self.__watchdog, name='CallbackWatchdog', daemon=True)
+    watchdogThread.start()
+  #end def
+
+
+  # onSlow (optional) is called as onSlow(eventName, seconds, timedOut) from a worker or the watchdog thread
+  def Submit(self, puzzleID, eventName, callbackFunction, onSlow = None):
+
+    with self.__condition:
+      puzzleQueue = self.__queues.setdefault(puzzleID, collections.deque())
+      puzzleQueue.append((eventName, callbackFunction, onSlow, time.monotonic()))
+
+      if (len(puzzleQueue) == 1) and (puzzleID not in self.__running):
+        self.__readyPuzzles.append(puzzleID)
+        self.__condition.notify()
+      #end if
+    #end with
+
+  #end def (Submit)
+
+
+  def GetMetrics(self):
+
+    with self.__condition:
+      metrics = {}
+      metrics['queued']    = sum(len(puzzleQueue) for puzzleQueue in self.__queues.values())
+      metrics['running']   = len(self.__running)
+      metrics['stalled']   = sum(1 for runningCallback in self.__running.values() if runningCallback.timedOut is True)
+      metrics['completed'] = self.__completedCount
+      metrics['slow']      = self.__slowCount
+      metrics['timedOut']  = self.__timedOutCount
+      metrics['errors']    = self.__errorCount
+      return metrics
+    #end with
+
+  #end def (GetMetrics)
+
+
+  # (seconds, thread ident) for the callback that has been waiting or running the longest, the thread ident
+  # is the worker running it (None while it is still waiting for one). None when there is nothing to do.
+  def GetOldestWork(self):
+
+    timestampNow = time.monotonic()
+    oldestWork = None
+
+    with self.__condition:
+      for runningCallback in self.__running.values():
+        if (oldestWork is None) or (timestampNow - runningCallback.timestampStarted > oldestWork[0]):
+          oldestWork = (timestampNow - runningCallback.timestampStarted, runningCallback.threadIdent)
+        #end if
+      #end for
+
+      # Only the head of a queue can be the oldest in it
+      for puzzleQueue in self.__queues.values():
+        if (len(puzzleQueue) > 0) and ((oldestWork is None) or (timestampNow - puzzleQueue[0][3] > oldestWork[0])):
+          oldestWork = (timestampNow - puzzleQueue[0][3], None)
+        #end if
+      #end for
+    #end with
+
+    return oldestWork
+  #end def (GetOldestWork)
+
+
+  def __startWorker(self):
+    workerThread = threading.Thread(target=self.__worker, name='CallbackWorker', daemon=True)
+    workerThread.start()
+  #end def (__startWorker)
+
+
+  def __worker(self):
+
+    while True:
+      with self.__condition:
+        while len(self.__readyPuzzles) == 0:
+          self.__condition.wait()
+        #end while
+
+        puzzleID = self.__readyPuzzles.popleft()
+        eventName, callbackFunction, onSlow, timestampQueued = self.__queues[puzzleID].popleft()
+
+        runningCallback = _RunningCallback(puzzleID, eventName, onSlow)
+        self.__running[puzzleID] = runningCallback
+      #end with
+
+      try:
+        callbackFunction()
+
+      except Exception:
+        queued_log.Error('>> Callback [{}] for puzzle ID [{}] raised an exception:\n{}', eventName, puzzleID, traceback.format_exc().rstrip())
+
+        with self.__condition:
+          self.__errorCount += 1
+        #end with
+      #end try
+
+      runSeconds = time.monotonic() - runningCallback.timestampStarted
+
+      with self.__condition:
+        self.__completedCount += 1
+
+        self.__releasePuzzle(puzzleID)
+
+        # The watchdog counted it when it timed out
+        if (runSeconds > self.__slowAfter) and (runningCallback.timedOut is False):
+          self.__slowCount += 1
+        #end if
+      #end with
+
+      if runningCallback.timedOut is True:
+        queued_log.Warning('>> Callback [{}] for puzzle ID [{}] finished after {:.1f} seconds, its puzzle carries on', eventName, puzzleID, runSeconds)
+      #end if
+
+      if (runSeconds > self.__slowAfter) and (onSlow is not None):
+        onSlow(eventName, runSeconds, False)
+      #end if
+
+      # The watchdog has already put a fresh worker in our place
+      if runningCallback.timedOut is True:
+        return
+      #end if
+    #end while
+
+  #end def (__worker)
+
+
+  # Must be called with the lock held
+  def __releasePuzzle(self, puzzleID):
+
+    del self.__running[puzzleID]
+
+    if len(self.__queues[puzzleID]) > 0:
+      self.__readyPuzzles.append(puzzleID)
+      self.__condition.notify()
+    #end if
+
+  #end def (__releasePuzzle)
+
+
+  def __watchdog(self):
+
+    while True:
+      time.sleep(min(self.__timeout / 4, 1.0))
+
+      timedOutCallbacks = []
+
+      with self.__condition:
+        now = time.monotonic()
+
+        for puzzleID, runningCallback in list(self.__running.items()):
+          if (runningCallback.timedOut is False) and (now - runningCallback.timestampStarted > self.__timeout):
+            runningCallback.timedOut = True
+            self.__timedOutCount += 1
+            self.__slowCount += 1
+
+            # The puzzle stays where it is until the callback returns, only the other puzzles get the worker back
+            self.__startWorker()
+
+            timedOutCallbacks.append(runningCallback)
+          #end if
+        #end for
+      #end with
+
+      for runningCallback in timedOutCallbacks:
+        queued_log.Warning('>> Callback [{}] for puzzle ID [{}] is still running after {} seconds, its puzzle is stalled until it returns', runningCallback.eventName, runningCallback.puzzleID, self.__timeout)
+
+        if runningCallback.onSlow is not None:
+          runningCallback.onSlow(runningCallback.eventName, time.monotonic() - runningCallback.timestampStarted, True)
+        #end if
+      #end for
+    #end while
+
+  #end def (__watchdog)
+
+#end class
+
+
+_sharedExecutor = None
+_sharedExecutorLock = threading.Lock()
+
+def GetSharedExecutor():
+
+  global _sharedExecutor
+
+  with _sharedExecutorLock:
+    if _sharedExecutor is None:
+      _sharedExecutor = CallbackExecutor()
+    #end if
+  #end with
+
+  return _sharedExecutor
+#end def (GetSharedExecutor)
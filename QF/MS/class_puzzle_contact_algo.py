@@ -32,13 +32,16 @@
 import gpiozero
 import time
 
+import flight_recorder
+import queued_log
+
 class AlgoMatchPuzzleContacts:
 
-    def __init__(self, Debug = False, AlwaysActive = False):
+    def __init__(self, Debug = False, AlwaysActive = False, PuzzleID = None, Recorder = None):
     
         self.__debugFlag       = Debug
         if Debug is True:
-            print('>> DEBUG is enabled')
+            queued_log.Debug('>> DEBUG is enabled')
 
 #        self.__delayAllowance  = DelayAllowance      # How much time is allowed to elapse (in milliseconds) between the different contact closures
         self.__callbacks       = {}        
@@ -56,6 +59,10 @@ class AlgoMatchPuzzleContacts:
         self.__puzzleActive              = AlwaysActive
         self.__puzzleSolved              = False
         self.__puzzleFailed		 = False
+
+        # What the puzzle did, kept in memory until somebody asks for it (see flight_recorder.py)
+        self.__puzzleID = PuzzleID
+        self.__recorder = Recorder if Recorder is not None else flight_recorder.GetSharedRecorder()
         
     #end def
     
@@ -63,7 +70,7 @@ class AlgoMatchPuzzleContacts:
     def SetAlgorithmInputs(self, inputPins, FailPin = None, ActiveLow = False):
     
         if self.__debugFlag is True:
-            print('>> Added Puzzle Pattern Inputs #[{}], Fail Pin: [{}]'.format(inputPins, FailPin))
+            queued_log.Debug('>> Added Puzzle Pattern Inputs #[{}], Fail Pin: [{}]', inputPins, FailPin)
         #end if
     
         self.__puzzleInputPinObjects.clear()
@@ -94,10 +101,15 @@ class AlgoMatchPuzzleContacts:
                     
     #end def (SetAlgorithmInputs)
 
+
+    def __recordEvent(self, eventName, payload = None):
+        self.__recorder.Record(self.__puzzleID, eventName, payload)
+    #end def (__recordEvent)
+
     
     def SetAlgorithmOutputs(self, outputPins, ActiveLow=False):
         if self.__debugFlag is True:
-            print('>> Added Puzzle Pattern Outputs #[{}]'.format(outputPins))
+            queued_log.Debug('>> Added Puzzle Pattern Outputs #[{}]', outputPins)
         #end if
 
         self.__puzzleOutputPinObjects.clear()
@@ -120,7 +132,7 @@ class AlgoMatchPuzzleContacts:
     
     def AddActiveOutput(self, activeOutputPinNumber, ActiveLow=False):
         if self.__debugFlag is True:
-            print('>> Added Puzzle Active Output Pin #[{}]'.format(activeOutputPinNumber))
+            queued_log.Debug('>> Added Puzzle Active Output Pin #[{}]', activeOutputPinNumber)
         #end if
 
         if ActiveLow is False:
@@ -136,7 +148,7 @@ class AlgoMatchPuzzleContacts:
 
     def AddSolvedOutput(self, solvedOutputPinNumber, ActiveLow=False):
         if self.__debugFlag is True:
-            print('>> Added Puzzle Solved Output Pin #[{}]'.format(solvedOutputPinNumber))
+            queued_log.Debug('>> Added Puzzle Solved Output Pin #[{}]', solvedOutputPinNumber)
         #end if
 
         if ActiveLow is False:
@@ -152,7 +164,7 @@ class AlgoMatchPuzzleContacts:
 
     def AddFailedOutput(self, activeOutputPinNumber, ActiveLow=False):
         if self.__debugFlag is True:
-            print('>> Added Puzzle Failed Output Pin #[{}]'.format(activeOutputPinNumber))
+            queued_log.Debug('>> Added Puzzle Failed Output Pin #[{}]', activeOutputPinNumber)
         #end if
         
         if ActiveLow is False:
@@ -168,8 +180,10 @@ class AlgoMatchPuzzleContacts:
 
     def __handlerContactCallback(self, btnObject):
 
+        self.__recordEvent('contact', {'pin': str(btnObject.pin), 'active': btnObject.is_active, 'position': self.__puzzlePatternPosition})
+
         if self.__debugFlag is True:
-            print('>> Input Contact Pin [{}] is ACTIVE: [{}]'.format(btnObject.pin, btnObject.is_active))
+            queued_log.Debug('>> Input Contact Pin [{}] is ACTIVE: [{}]', btnObject.pin, btnObject.is_active)
         #end if
 
         # We don't want to process any more events when we're in a solved state
@@ -216,9 +230,10 @@ class AlgoMatchPuzzleContacts:
     def Activate(self):
         
         self.__puzzleActive = True
+        self.__recordEvent('activated')
 
         if self.__debugFlag is True:
-            print('>> PUZZLE IS ACTIVE: [{}]'.format(self.__puzzleActive))
+            queued_log.Debug('>> PUZZLE IS ACTIVE: [{}]', self.__puzzleActive)
         #end if
 
         for individualOutputObject in self.__puzzleActiveOutputObjects:
@@ -237,9 +252,10 @@ class AlgoMatchPuzzleContacts:
     def Solve(self):
 
         self.__puzzleSolved = True
+        self.__recordEvent('solved')
         
         if self.__debugFlag is True:
-            print('>> PUZZLE SOLVED!')
+            queued_log.Debug('>> PUZZLE SOLVED!')
         #end if
 
         for individualOutputObject in self.__puzzleActiveOutputObjects:
@@ -259,12 +275,14 @@ class AlgoMatchPuzzleContacts:
 
 
     def Fail(self):
+        self.__recordEvent('failed', {'position': self.__puzzlePatternPosition})
+
         self.__puzzleFailed = True
         self.__puzzleActive = False
         self.__puzzlePatternPosition = 0
 
         if self.__debugFlag is True:
-            print('>> PUZZLE FAILED!')
+            queued_log.Debug('>> PUZZLE FAILED!')
         #end if
 
         try:
@@ -298,7 +316,7 @@ class AlgoMatchPuzzleContacts:
     def Reset(self):
         
         if self.__debugFlag is True:
-            print('>> PUZZLE RESET')
+            queued_log.Debug('>> PUZZLE RESET')
         #end if
 
         self.__puzzlePatternPosition = 0                
@@ -306,6 +324,7 @@ class AlgoMatchPuzzleContacts:
         self.__puzzleSolved = False
         self.__puzzleActive = False
         self.__puzzleFailed = False
+        self.__recordEvent('reset')
 
 
         for individualOutputObjects in self.__puzzleOutputPinObjects:
@@ -342,8 +361,18 @@ class AlgoMatchPuzzleContacts:
     #end def (ProcessEvents)
     
         
+    # Lets go of every pin we claimed, so another puzzle (or this one, rebuilt) can have them
     def Cleanup(self):
-        pass
+
+        for objectList in [self.__puzzleInputPinObjects, self.__puzzleInputFailPinObjects, self.__puzzleOutputPinObjects,
+                           self.__puzzleActiveOutputObjects, self.__puzzleSolvedOutputObjects, self.__puzzleFailedOutputObjects]:
+            for individualObject in objectList:
+                individualObject.close()
+            #end for
+
+            objectList.clear()
+        #end for
+
     #end def (Cleanup)
 
 
@@ -31,9 +31,13 @@
 import gpiozero
 import time
 
+import flight_recorder
+import queued_log
+import timer_wheel
+
 class ANDMatchPuzzleContacts:
 
-    def __init__(self, Debug = False, AlwaysActive = False, DelayAllowance = 1000):
+    def __init__(self, Debug = False, AlwaysActive = False, DelayAllowance = 1000, PuzzleID = None, Recorder = None, Timers = None):
     
         self.__debugFlag       = Debug
         self.__delayAllowance  = DelayAllowance      # How much time is allowed to elapse (in milliseconds) between the different contact closures
@@ -42,13 +46,20 @@ class ANDMatchPuzzleContacts:
         self.__puzzleInputPinObjects     = {}   #FIXME: I need to let you define these as active LO/HI
         self.__puzzleActiveOutputObjects = []   #FIXME: I need to let you define these as active LO/HI
         self.__puzzleSolvedOutputObjects = []   #FIXME: I need to let you define these as active LO/HI
-        self.__puzzleInputPinTimers      = {}
+        self.__puzzleInputPinWindows     = {}   # pin -> timer that closes its delay window, None while the contact is open
         
         self.__puzzleAlwaysActive        = AlwaysActive
         self.__puzzleActive              = AlwaysActive
         self.__puzzleSolved              = False
         self.__puzzleFailed              = False
 
+        # What the puzzle did, kept in memory until somebody asks for it (see flight_recorder.py)
+        self.__puzzleID = PuzzleID
+        self.__recorder = Recorder if Recorder is not None else flight_recorder.GetSharedRecorder()
+
+        # A closed contact's delay window is a timer on the shared wheel (see timer_wheel.py)
+        self.__timers = Timers if Timers is not None else timer_wheel.GetSharedWheel()
+
     #end def
     
 
@@ -56,10 +67,15 @@ class ANDMatchPuzzleContacts:
         self.__delayAllowance = delay
     #end def (SetDelay)
 
+
+    def __recordEvent(self, eventName, payload = None):
+        self.__recorder.Record(self.__puzzleID, eventName, payload)
+    #end def (__recordEvent)
+
     
     def AddActiveOutput(self, activeOutputPinNumber, ActiveLow=False):
         if self.__debugFlag is True:
-            print('>> Added Puzzle Active Output Pin #[{}]'.format(activeOutputPinNumber))
+            queued_log.Debug('>> Added Puzzle Active Output Pin #[{}]', activeOutputPinNumber)
         #end if
         
         if ActiveLow is False:
@@ -75,7 +91,7 @@ class ANDMatchPuzzleContacts:
 
     def AddSolvedOutput(self, solvedOutputPinNumber, ActiveLow=False):
         if self.__debugFlag is True:
-            print('>> Added Puzzle Solved Output Pin #[{}]'.format(solvedOutputPinNumber))
+            queued_log.Debug('>> Added Puzzle Solved Output Pin #[{}]', solvedOutputPinNumber)
         #end if
 
         if ActiveLow is False:
@@ -91,7 +107,7 @@ class ANDMatchPuzzleContacts:
 
     def AddContact(self, inputContactPinNumber, ActiveLow = False):
         if self.__debugFlag is True:
-            print('>> Added Input Contact Pin #[{}]'.format(inputContactPinNumber))
+            queued_log.Debug('>> Added Input Contact Pin #[{}]', inputContactPinNumber)
         #end if
 
         if ActiveLow is False:
@@ -105,28 +121,29 @@ class ANDMatchPuzzleContacts:
 
         self.__puzzleInputPinObjects.update ({ tmpButtonObject.pin : tmpButtonObject } )
         
-        self.__puzzleInputPinTimers.update( { tmpButtonObject.pin :  None } )
+        self.__puzzleInputPinWindows.update( { tmpButtonObject.pin :  None } )
     #end def (AddContact)
 
 
     def __handlerContactCallback(self, btnObject):
 
+        self.__recordEvent('contact', {'pin': str(btnObject.pin), 'active': btnObject.is_active})
+
         if self.__debugFlag is True:
-            print('>> Input Contact Pin [{}] is ACTIVE: [{}]'.format(btnObject.pin, btnObject.is_active))
+            queued_log.Debug('>> Input Contact Pin [{}] is ACTIVE: [{}]', btnObject.pin, btnObject.is_active)
         #end if
         
         # We don't want to process any more events when we're in a solved state
         if ( self.__puzzleActive is True ) and ( self.__puzzleSolved is False ):
 
+            self.__closeWindow(btnObject.pin)
+
             if btnObject.is_active is True:
-                currentMilliseconds = round( time.monotonic_ns() / 1000000 )
-                #currentMilliseconds = round( time.monotonic() / 1000000 ) #FIME-HP
-                self.__puzzleInputPinTimers[btnObject.pin] = currentMilliseconds
+                self.__puzzleInputPinWindows[btnObject.pin] = self.__timers.Schedule(self.__delayAllowance / 1000, self.__handlerWindowExpired, btnObject.pin)
 
                 self.__checkForSolve()
 
             else:
-                self.__puzzleInputPinTimers[btnObject.pin] = None
                 return False
             #end if
         #end if
@@ -135,24 +152,20 @@ class ANDMatchPuzzleContacts:
 
     def __checkForSolve(self):
 
-        currentMilliseconds = round( time.monotonic_ns() / 1000000 )
-
-        for pinName, pinMilliseconds in self.__puzzleInputPinTimers.items():
+        for pinName, pinWindow in self.__puzzleInputPinWindows.items():
             if self.__debugFlag is True:
-                print('>> Pin: [{}], Milliseconds: [{}]'.format(pinName, pinMilliseconds))
+                queued_log.Debug('>> Pin: [{}], Window open: [{}]', pinName, (pinWindow is not None) and (pinWindow.IsPending() is True))
             #end if
 
-            if pinMilliseconds is None:
+            if pinWindow is None:
                 return False
-                
-            elif ( currentMilliseconds - pinMilliseconds ) < self.__delayAllowance:
-                pass
 
-            elif ( currentMilliseconds - pinMilliseconds ) > self.__delayAllowance:
-                self.Fail()
-                return False
+            elif pinWindow.IsPending() is True:
+                pass
 
             else:
+                self.__recordEvent('contact_too_late', {'pin': str(pinName), 'elapsedMs': round((time.monotonic() - pinWindow.scheduledAt) * 1000)})
+                self.Fail()
                 return False
             #end if
         #end for
@@ -164,6 +177,24 @@ class ANDMatchPuzzleContacts:
     #end def (__checkForSolve)
 
     
+    # The contact was let go of (or we're starting over), its window goes with it
+    def __closeWindow(self, pinName):
+        pinWindow = self.__puzzleInputPinWindows.get(pinName)
+
+        if pinWindow is not None:
+            pinWindow.Cancel()
+            self.__puzzleInputPinWindows[pinName] = None
+        #end if
+    #end def (__closeWindow)
+
+
+    # Runs on the timer wheel's thread. The contact is still closed, but too long ago to count with the
+    # others - the next contact to close fails the puzzle (see __checkForSolve).
+    def __handlerWindowExpired(self, pinName):
+        self.__recordEvent('contact_window_expired', {'pin': str(pinName)})
+    #end def (__handlerWindowExpired)
+
+
     def RegisterCallback(self, callback, callbackFunction):
         self.__callbacks[callback] = callbackFunction
     #end def (RegisterCallbacks)
@@ -174,8 +205,10 @@ class ANDMatchPuzzleContacts:
         self.__puzzleActive = True
         self.__puzzleSolved = False
 
+        self.__recordEvent('activated')
+
         if self.__debugFlag is True:
-            print('>> PUZZLE IS ACTIVE: [{}]'.format(self.__puzzleActive))
+            queued_log.Debug('>> PUZZLE IS ACTIVE: [{}]', self.__puzzleActive)
         #end if
 
         for individualOutputObject in self.__puzzleActiveOutputObjects:
@@ -194,9 +227,10 @@ class ANDMatchPuzzleContacts:
     def Solve(self):
 
         self.__puzzleSolved = True
+        self.__recordEvent('solved')
         
         if self.__debugFlag is True:
-            print('>> PUZZLE SOLVED!')
+            queued_log.Debug('>> PUZZLE SOLVED!')
         #end if
 
         for individualOutputObject in self.__puzzleActiveOutputObjects:
@@ -219,10 +253,11 @@ class ANDMatchPuzzleContacts:
         
         self.__puzzleFailed = True
         self.__puzzleActive = False
+        self.__recordEvent('failed')
 
-        # Reset the timestamp on the contacts
-        for pinName, pinMilliseconds in self.__puzzleInputPinTimers.items():
-            self.__puzzleInputPinTimers[pinName] = None
+        # Forget about the contacts' delay windows
+        for pinName in self.__puzzleInputPinWindows:
+            self.__closeWindow(pinName)
         #end for
 
         for individualOutputObject in self.__puzzleActiveOutputObjects:
@@ -244,17 +279,18 @@ class ANDMatchPuzzleContacts:
     def Reset(self):
         
         if self.__debugFlag is True:
-            print('>> PUZZLE RESET')
+            queued_log.Debug('>> PUZZLE RESET')
         #end if
 
         self.__puzzleSolved = False
         self.__puzzleFailed = False
         self.__puzzleActive = False
+        self.__recordEvent('reset')
          
 
-        # Reset the timestamp on the contacts
-        for pinName, pinMilliseconds in self.__puzzleInputPinTimers.items():
-            self.__puzzleInputPinTimers[pinName] = None
+        # Forget about the contacts' delay windows
+        for pinName in self.__puzzleInputPinWindows:
+            self.__closeWindow(pinName)
         #end for
        
         for individualOutputObjects in self.__puzzleActiveOutputObjects:
@@ -283,8 +319,22 @@ class ANDMatchPuzzleContacts:
     #end def (ProcessEvents)
     
         
+    # Lets go of every pin we claimed, so another puzzle (or this one, rebuilt) can have them
     def Cleanup(self):
-        pass
+
+        for pinName in self.__puzzleInputPinWindows:
+            self.__closeWindow(pinName)
+        #end for
+
+        for individualObject in list(self.__puzzleInputPinObjects.values()) + self.__puzzleActiveOutputObjects + self.__puzzleSolvedOutputObjects:
+            individualObject.close()
+        #end for
+
+        self.__puzzleInputPinObjects.clear()
+        self.__puzzleInputPinWindows.clear()
+        self.__puzzleActiveOutputObjects.clear()
+        self.__puzzleSolvedOutputObjects.clear()
+
     #end def (Cleanup)
 
 
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+
+# COPI Command Envelopes
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# COPI/<id>/COMMANDS has always carried bare strings ('RESET', 'SOLVE'..). A QoS 1 redelivery,
+# or the room controller sending again after a reconnect, runs the command twice, and running
+# Solve() twice fires the maglocks twice.
+#
+# A command can now come wrapped in an envelope instead (JSON, or any other wire format, see
+# wire_format.py):
+#
+#   {"command": "SOLVE", "id": "game42-7", "seq": 7}
+#
+# "id" (or, failing that, "seq") identifies the command. A puzzle remembers the last few IDs
+# it has seen in a CommandDedupeCache and runs each one once, a repeat is only acknowledged.
+# Every enveloped command is acknowledged on CIPO/<id>/ACK:
+#
+#   {"id": "game42-7", "seq": 7, "command": "SOLVE", "result": "OK", "latencyMs": 12.5}
+#
+# with result one of OK, ERROR (the callback raised), DUPLICATE or UNKNOWN, and latencyMs the
+# time from the command arriving to its callback finishing.
+#
+# Bare strings keep working exactly as before, they just can't be deduplicated or acknowledged.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import threading
+
+import wire_format
+
+
+RESULT_OK        = 'OK'
+RESULT_ERROR     = 'ERROR'
+RESULT_DUPLICATE = 'DUPLICATE'
+RESULT_UNKNOWN   = 'UNKNOWN'
+
+
+# Returns (command, envelope), envelope is None for a bare string command
+def ParseCommand(payload):
+
+  try:
+    envelope = wire_format.DecodePayload(payload)
+  except ValueError:
+    envelope = None
+  #end try
+
+  if isinstance(envelope, dict) and isinstance(envelope.get('command'), str):
+    return envelope['command'], envelope
+  #end if
+
+  return payload.decode(errors='replace'), None
+#end def (ParseCommand)
+
+
+def GetCommandID(envelope):
+
+  if envelope is None:
+    return None
+  #end if
+
+  for key in ['id', 'seq']:
+    if isinstance(envelope.get(key), (str, int)):
+      return envelope[key]
+    #end if
+  #end for
+
+  return None
+#end def (GetCommandID)
+
+
+def BuildAck(envelope, command, result, latencySeconds):
+
+  ack = {}
+  ack['id']        = envelope.get('id')
+  ack['seq']       = envelope.get('seq')
+  ack['command']   = command
+  ack['result']    = result
+  ack['latencyMs'] = round(latencySeconds * 1000, 1)
+  return ack
+#end def (BuildAck)
+
+
+class CommandDedupeCache:
+
+  def __init__(self, MaxEntries = 64):
+    self.__maxEntries = MaxEntries
+
+    self.__lock = threading.Lock()
+    self.__seenIDs = collections.OrderedDict()
+
+    self.__receivedCount  = 0
+    self.__duplicateCount = 0
+  #end def
+
+
+  # Remembers commandID, returns True if we had already seen it
+  def CheckAndAdd(self, commandID):
+
+    with self.__lock:
+      self.__receivedCount += 1
+
+      if commandID in self.__seenIDs:
+        self.__seenIDs.move_to_end(commandID)
+        self.__duplicateCount += 1
+        return True
+      #end if
+
+      self.__seenIDs[commandID] = True
+
+      while len(self.__seenIDs) > self.__maxEntries:
+        self.__seenIDs.popitem(last=False)
+      #end while
+
+      return False
+    #end with
+
+  #end def (CheckAndAdd)
+
+
+  def GetMetrics(self):
+
+    with self.__lock:
+      metrics = {}
+      metrics['received']   = self.__receivedCount
+      metrics['duplicates'] = self.__duplicateCount
+      return metrics
+    #end with
+
+  #end def (GetMetrics)
+
+#end class
@@ -35,257 +35,874 @@
 #  $> sudo pip3 install paho-mqtt
 
 
-import paho.mqtt.client as mqtt
-import json
+import threading
 import time
-import socket
-import uuid
-import re
-import math
-import sys
+import os
+
+import telemetry
+import callback_executor
+import wire_format
+import mqtt_v5
+import command_envelope
+import flight_recorder
+import link_quality
+import timer_wheel
+import loop_watchdog
+import queued_log
+from heartbeat_delta import HeartbeatEncoder
+from publish_queue import OutboundPublishQueue, PRIORITY_STATE, PRIORITY_ERROR, PRIORITY_HEARTBEAT
+from topic_router import TopicRouter
+from state_journal import StateJournal
+from reconnect_backoff import ReconnectBackoff
+from ping_latency import PingLatencyTracker
+from command_envelope import CommandDedupeCache
+from heartbeat_schedule import HeartbeatSchedule
 
 __version__  = '0.9'
 
-print('\r\n----------------------------------------------------------')
-print('Room Controller Communications Class v{}'.format(__version__))
-print('Room Control and Puzzle Coordination System (RCPCS)')
-print('(c)2019 Joel Caturia <jcaturia@katratech.com>')
-print('----------------------------------------------------------\r\n')
+queued_log.Info('\r\n----------------------------------------------------------')
+queued_log.Info('Room Controller Communications Class v{}', __version__)
+queued_log.Info('Room Control and Puzzle Coordination System (RCPCS)')
+queued_log.Info('(c)2019 Joel Caturia <jcaturia@katratech.com>')
+queued_log.Info('----------------------------------------------------------\r\n')
 
 
 class ControllerCommunications:
 
-  def __init__(self, puzzleID, mqttBroker, mqttPort = 1883):
+  def __init__(self, puzzleID, mqttBroker, mqttPort = 1883, AutoConnect = True, Hub = None, BackgroundConnect = False, MQTTv5 = False, RetainState = False, Bus = None):
     self.mqttBroker = mqttBroker
     self.mqttPort = mqttPort
     self.puzzleID = puzzleID
   
     self.mqttKeepalive = 15
 
-    self.__pingDelay = 3
-    self.__timestampLastPing = time.time()
-    self.__puzzleState = None
-    self.__callbacks = {}
-    self.__MQTTConnected = False
+    self.pingDelay = 3
+    self._timestampLastPing = time.time()
+    self._puzzleState = None
+    self._callbacks = {}
+    self._MQTTConnected = False
+    self._hub = Hub
+    self._heartbeatEncoder = None
+    self._heartbeatSchedule = None
+    self._wireFormat = 'json'
+    self._customTopics = []
+    self._stateJournal = None
+    self._latencyTracker = PingLatencyTracker()
+    self._commandCache = CommandDedupeCache()
+    self._mqttSession = None
+    self._retainState = RetainState
+    self.commandExpiry = 10
+
+    # The correlation ID of the message being handled on this thread, if it had one (see mqtt_v5.py)
+    self._correlation = threading.local()
+
+    # User callbacks never run on paho's network thread (see callback_executor.py)
+    self._callbackExecutor = callback_executor.GetSharedExecutor()
+
+    # Startup timings are measured from when the process started, not from when we were created
+    self._timestampStartup = time.monotonic() - telemetry.getProcessUptime()
+    self._startupTimings = {}
+
+    # Every topic we handle is routed through here, puzzles can add their own (see RegisterTopicHandler)
+    self._router = TopicRouter()
+    self._router.AddRoute('COPI/' + self.puzzleID + '/COMMANDS', self._handleCommand)
+    self._router.AddRoute('COPI/' + self.puzzleID + '/PONG',     self._handlePong)
+    self._router.AddRoute('COPI/' + self.puzzleID + '/FORMAT',   self._handleFormat)
+    self._router.AddRoute('COPI/' + self.puzzleID + '/DUMP',     self._handleDump)
+
+    # Commands and state changes go in the same timeline as the puzzle's own events (see flight_recorder.py)
+    self._flightRecorder = flight_recorder.GetSharedRecorder()
+
+    # Shared by every puzzle ID in this process talking to the same broker
+    self._telemetry = telemetry.GetSharedRegistry(self.mqttBroker, 'RCPCS v{}'.format(__version__))
+
+    # Wi-Fi signal, noise and retries, sampled on a thread of its own (see link_quality.py)
+    self._linkQuality = link_quality.GetSharedSampler()
+
+    # Puzzle timeouts in this process all run off one wheel, its accuracy goes in the heartbeat (see timer_wheel.py)
+    self._timerWheel = timer_wheel.GetSharedWheel()
+
+    # Main loop and worker thread lag, for the heartbeat and the systemd watchdog (see loop_watchdog.py)
+    self._loopWatchdog = loop_watchdog.GetSharedWatchdog()
+    self._loopWatchdog.AddGauge('callbacks', self._callbackExecutor.GetOldestWork, Threshold = self._callbackExecutor.timeout)
+    self._loopWatchdog.AddProbe('timers', lambda probeDone: self._timerWheel.Schedule(0, probeDone))
+
+    # Puzzles in this process reach us over the bus as well as through the broker, or instead of it when
+    # there isn't one (see local_bus.py). Hosted puzzles use the hub's bus.
+    self._localBus = self._hub.localBus if self._hub is not None else Bus
+    self._bridgedBus = (self._localBus is not None) and (self.mqttBroker is not None)
+
+    if (self._localBus is None) and (self.mqttBroker is None):
+      raise ValueError('Puzzle ID [{}] needs an MQTT broker, or a local bus to stand in for one'.format(self.puzzleID))
+    #end if
 
-    
-    
-    def handlerMQTTonConnect(client, userdata, flags, rc):
-      print('>> Puzzle ID [{}] successfully connected to MQTT Broker [{}:{}]..'.format(self.puzzleID, self.mqttBroker, self.mqttPort) )
-      
-      self.__MQTTConnected = True
-      
-      self.mqttClient.subscribe('COPI/' + self.puzzleID + '/#')	# Subscribe to Controller-Out-Puzzle-In		
-      self.mqttClient.subscribe('POPI/' + self.puzzleID + '/#')	# Subscribe to Puzzle-Out-Puzzle-In topic
-      
-      self.PublishState(self.__puzzleState)
-      
-      self.SendPing()
-    #end def (handlerMQTTonConnect)
+    if self._bridgedBus is True:
+      self._localBus.Subscribe('COPI/' + self.puzzleID + '/#', self._handlerLocalMessage, Bridged = True)
+      self._localBus.Subscribe('POPI/' + self.puzzleID + '/#', self._handlerLocalMessage, Bridged = True)
+    #end if
 
+    # In hub mode we ride on the hub's MQTT connection (see ControllerCommunicationsHub), the hub
+    # owns connecting, reconnecting and the last will, and hands us our own messages.
+    if self._hub is not None:
+      self.mqttClient = self._hub.mqttClient
+      self._mqttSession = self._hub.mqttSession
+      self._retainState = self._hub.retainState
+      self._outboundQueue = self._hub.outboundQueue
+      self._reconnectBackoff = self._hub.reconnectBackoff
+      self._hub.AttachPuzzle(self)
+      return
+    #end if
+
+    # Without a broker the bus stands in for one
+    if self.mqttBroker is None:
+      self.mqttClient = self._localBus.CreateClient()
+    else:
+      self.mqttClient = mqtt_v5.CreateClient(MQTTv5)
+    #end if
+
+    self.mqttClient.on_connect    = self.handlerMQTTonConnect
+    self.mqttClient.on_disconnect = self.handlerMQTTonDisconnect
+    self.mqttClient.on_message    = self.handlerMQTTonMessage
+    self.mqttClient.on_connect_fail = self.handlerMQTTonConnectFail
+
+    # Everything we publish goes through here, so a state change never waits behind heartbeats
+    self._outboundQueue = OutboundPublishQueue(self.mqttClient)
+
+    # v5 extras are opt-in, and fall back to 3.1.1 if the broker won't have them (see mqtt_v5.py)
+    if MQTTv5 is True:
+      self._mqttSession = mqtt_v5.MQTTv5Session()
+      self._outboundQueue.protocolSession = self._mqttSession
+    #end if
+
+    if self._bridgedBus is True:
+      self._outboundQueue.localBus = self._localBus
+    #end if
 
-    def handlerMQTTonDisconnect(client, userdata, rc):
+    # With RetainState the broker keeps our last state (or our last will) for anyone who subscribes later on,
+    # a room controller restarted mid-game then knows where every puzzle is without waiting for it to change
+    self.mqttClient.will_set('CIPO/' + self.puzzleID + '/STATE', payload='UNKNOWN', qos=1, retain=self._retainState)
+
+    # Every controller in the room loses the broker at the same time, so they must not all come back at the same time
+    self._reconnectBackoff = ReconnectBackoff()
+    self._scheduleReconnect()
+
+    # Sub-classes that drive the MQTT client themselves (see AsyncControllerCommunications) will
+    # skip this and make their own connection later on.
+    if (AutoConnect is True) and (BackgroundConnect is True):
+      self.connectInBackground()
+    elif AutoConnect is True:
+      self.connect()
+    #end if
         
-      self.__MQTTConnected = False
-
-      if self.__puzzleState == 'REBOOTING':
-        self.mqttClient.loop_stop()
-        self.__callbacks['command_reboot']()
-              
-      else:
-        self.mqttClient.reconnect()
+  #end def
+
+
+  def connect(self):
+
+    while (self._MQTTConnected == False):
+      try:
+        queued_log.Info(">> Attempting MQTT broker connection..")
+        self.mqttClient.connect(self.mqttBroker, self.mqttPort, self.mqttKeepalive)
+        self.mqttClient.loop_start()  
+        time.sleep(1)
+
+      except Exception as connectError:
+        self._reconnectBackoff.OnConnectFailed(str(connectError))
+        backOffDelay = self._reconnectBackoff.NextDelay()
+
+        queued_log.Warning('>> Unable to connect to MQTT broker! Sleeping for {:.1f} seconds..', backOffDelay)
+        time.sleep(backOffDelay)
+      #end try
+    #end while
+
+  #end def (connect)
+
+
+  # Returns straight away and leaves connecting (and retrying) to paho's network thread, so the
+  # puzzle can get on with setting itself up and running locally while the broker is still booting.
+  # Anything published in the meantime waits in the outbound queue until the link comes up.
+  def connectInBackground(self):
+    queued_log.Info('>> Connecting to MQTT broker [{}:{}] in the background..', self.mqttBroker, self.mqttPort)
+    self.mqttClient.connect_async(self.mqttBroker, self.mqttPort, self.mqttKeepalive)
+    self.mqttClient.loop_start()
+  #end def (connectInBackground)
+
+
+  # Puzzle scripts call this once their hardware is set up and the puzzle logic is running
+  def MarkPuzzleReady(self):
+    self.RecordStartupTiming('ready')
+    queued_log.Info('>> Puzzle ID [{}] ready {:.2f} seconds after startup', self.puzzleID, self._startupTimings['ready'])
+  #end def (MarkPuzzleReady)
+
+
+  # Seconds since the process started, reported in the heartbeat's startupTimings under timingName
+  def RecordStartupTiming(self, timingName):
+    self._startupTimings[timingName] = round(time.monotonic() - self._timestampStartup, 3)
+  #end def (RecordStartupTiming)
+
+
+  # paho's network thread does the actual reconnecting, we just tell it how long to wait before the next attempt
+  def _scheduleReconnect(self):
+    reconnectDelay = self._reconnectBackoff.NextDelay()
+    self.mqttClient.reconnect_delay_set(min_delay=reconnectDelay, max_delay=reconnectDelay)
+    return reconnectDelay
+  #end def (_scheduleReconnect)
+
+
+  # Round trip times (p50/p95/p99) and clock offset to the room controller, from our PING/PONGs
+  def GetLatencyMetrics(self):
+    return self._latencyTracker.GetMetrics()
+  #end def (GetLatencyMetrics)
+
+
+  # Protocol in use and topic alias savings, None unless we were asked for MQTT v5
+  def GetProtocolMetrics(self):
+
+    if self._mqttSession is None:
+      return None
+    #end if
+
+    return self._mqttSession.GetMetrics()
+  #end def (GetProtocolMetrics)
+
+
+  # Connection statistics, shared with the other puzzles in hub mode (see reconnect_backoff.py)
+  def GetConnectionMetrics(self):
+    return self._reconnectBackoff.GetMetrics()
+  #end def (GetConnectionMetrics)
+
+
+  def handlerMQTTonConnect(self, client, userdata, flags, rc, properties = None):
+
+    if rc != 0:
+      self._reconnectBackoff.OnConnectFailed(mqtt_v5.ConnackString(rc))
+
+      if mqtt_v5.IsProtocolRefused(rc):
+        mqtt_v5.FallBackToMQTTv311(self.mqttClient)
+        self._mqttSession.Disable()
+        queued_log.Warning('>> MQTT broker does not support MQTT v5, falling back to 3.1.1..')
       #end if
+
+      queued_log.Warning('>> MQTT broker refused the connection [{}], next attempt in {:.1f} seconds..', mqtt_v5.ConnackString(rc), self._scheduleReconnect())
+      return
+    #end if
+
+    queued_log.Info('>> Puzzle ID [{}] successfully connected to MQTT Broker [{}:{}]..', self.puzzleID, self.mqttBroker, self.mqttPort)
     
-    #end def (handlerMQTTonDisconnect)
+    self._MQTTConnected = True
 
-  
-    def handlerMQTTonMessage(client, userdata, message):
-
-      if ('COMMANDS' in message.topic):
-            
-        incomingCommand = message.payload.decode()
-                    
-        if incomingCommand in ['RESET', 'ACTIVATE', 'SOLVE', 'PONG', 'REBOOT', 'FAIL']:
-          print(' -> Received MQTT command: [{}]'.format(incomingCommand))
-                            
-          if incomingCommand == 'RESET':
-            self.__callbacks['command_reset']()
-            
-          elif incomingCommand == 'ACTIVATE':
-            self.__callbacks['command_activate']()
-                            
-          elif incomingCommand == 'SOLVE':
-            self.__callbacks['command_solve']()
-
-          elif incomingCommand == 'FAIL':
-            self.__callbacks['command_fail']()
-
-          elif incomingCommand == 'REBOOT':
-            self.PublishStatus('REBOOTING')
-            self.mqttClient.disconnect()
-            # We fire the command_reboot callback in the on_disconnect event for the MQTT client            
-          #end if
-
-      elif ('PONG' in message.topic):
-            self.__callbacks['pong']()
-                  
-      else:
-        self.mqttClient.publish('CIPO/' + self.puzzleID + '/ERROR', 'Unknown COMMAND received: [{}]'.format(incomingCommand))
-        self.mqttClient.publish('CIPO/' + self.puzzleID + '/STATE', self.__puzzleState)
+    # In hub mode the hub keeps track of its own connection
+    if self._hub is None:
+      self._reconnectBackoff.OnConnected()
+    #end if
+
+    if 'connected' not in self._startupTimings:
+      self._startupTimings['connected'] = round(time.monotonic() - self._timestampStartup, 3)
+    #end if
+
+    # In hub mode the hub owns the queue and has already told it (and the v5 session) we're connected
+    if self._hub is None:
+      if self._mqttSession is not None:
+        self._mqttSession.OnConnect(properties)
       #end if
-                                                                                                                                                                                                                                                                                        
-    #end def (handlerMQTTonMessage)
-## end nested defines (under __init__)
 
+      self._outboundQueue.SetConnected(True)
+    #end if
+
+    # A (re)connect is the one time our address is likely to have changed
+    self._telemetry.Invalidate('ipAddress')
+
+    if self._heartbeatEncoder is not None:
+      self._heartbeatEncoder.Reset()
+    #end if
+    
+    self.mqttClient.subscribe('COPI/' + self.puzzleID + '/#')	# Subscribe to Controller-Out-Puzzle-In		
+    self.mqttClient.subscribe('POPI/' + self.puzzleID + '/#')	# Subscribe to Puzzle-Out-Puzzle-In topic
+
+    for topicPattern in self._customTopics:
+      self.mqttClient.subscribe(topicPattern)
+    #end for
     
-    self.mqttClient = mqtt.Client()
+    # Re-announcing where we are isn't a new transition, so it stays out of the journal
+    if self._puzzleState is not None:
+      self._publish('CIPO/' + self.puzzleID + '/STATE', self._puzzleState, qos=1, retain = self._retainState, priority = PRIORITY_STATE, messageExpiry = None)
 
-    self.mqttClient.on_connect    = handlerMQTTonConnect
-    self.mqttClient.on_disconnect = handlerMQTTonDisconnect
-    self.mqttClient.on_message    = handlerMQTTonMessage
+    # Our birth message, so a retained last will from a previous run doesn't keep saying we're gone
+    elif self._retainState is True:
+      self._publish('CIPO/' + self.puzzleID + '/STATE', 'ONLINE', qos=1, retain = True, priority = PRIORITY_STATE, messageExpiry = None)
+    #end if
+    
+    self.SendPing()
+  #end def (handlerMQTTonConnect)
 
-    self.mqttClient.will_set('CIPO/' + self.puzzleID + '/STATE', payload='UNKNOWN', qos=1)
 
-    backOffTimer = 2
+  def handlerMQTTonDisconnect(self, client, userdata, rc, properties = None):
+      
+    self._MQTTConnected = False
+    self._outboundQueue.SetConnected(False)
 
-    while (self.__MQTTConnected == False):
-      try:
-        print(">> Attempting MQTT broker connection..")
-        self.mqttClient.connect(self.mqttBroker, self.mqttPort, self.mqttKeepalive)
-        self.mqttClient.loop_start()  
-        time.sleep(1)
+    if self._mqttSession is not None:
+      self._mqttSession.OnDisconnect()
+    #end if
 
-      except:
-        print('>> Unable to connect to MQTT broker! Sleeping for {} seconds..'.format(backOffTimer) )
-        time.sleep(backOffTimer)
-        
-        # Incremement the backoff timer util we get over 30, then we just leave it there.
-        # This logic will actually ensure we spend one cycle over 30 (at 64, in fact). I am OK with this.
-        if backOffTimer == 30:
-          pass
-        elif backOffTimer > 30:
-          backOffTimer = 30
+    if self._puzzleState == 'REBOOTING':
+      self.mqttClient.loop_stop()
+      self._fireCallback('command_reboot')
+      return
+    #end if
+
+    if self._hub is not None:
+      return
+    #end if
+
+    # rc 0 means we asked for it (disconnect()), paho won't be reconnecting
+    if rc == 0:
+      self._reconnectBackoff.OnDisconnected()
+      return
+    #end if
+
+    self._reconnectBackoff.OnDisconnected(mqtt_v5.ErrorString(rc))
+
+    # paho's network thread reconnects by itself, after the delay we give it
+    queued_log.Warning('>> Lost MQTT broker connection, next attempt in {:.1f} seconds..', self._scheduleReconnect())
+  
+  #end def (handlerMQTTonDisconnect)
+
+
+  def handlerMQTTonConnectFail(self, client, userdata):
+    self._reconnectBackoff.OnConnectFailed('Unable to connect to MQTT broker')
+    queued_log.Warning('>> Unable to connect to MQTT broker! Next attempt in {:.1f} seconds..', self._scheduleReconnect())
+  #end def (handlerMQTTonConnectFail)
+
+
+  def handlerMQTTonMessage(self, client, userdata, message):
+
+    # The broker's copy of something the bus already handed us
+    if (self._bridgedBus is True) and (self._localBus.IsEcho(self._handlerLocalMessage, message) is True):
+      return
+    #end if
+
+    # Whatever we publish while handling this message carries its correlation ID (v5 only)
+    self._correlation.correlationID = mqtt_v5.GetUserProperty(message, mqtt_v5.CORRELATION_PROPERTY)
+
+    try:
+      if self._router.Route(message.topic, message) > 0:
+        return
+      #end if
+
+      # Nobody is obliged to listen to every puzzle event, but the room controller should hear about a COPI topic we don't know
+      if message.topic.startswith('COPI/'):
+        self._publish('CIPO/' + self.puzzleID + '/ERROR', 'Unknown topic received: [{}]'.format(message.topic))
+        self._publish('CIPO/' + self.puzzleID + '/STATE', self._puzzleState, priority = PRIORITY_STATE)
+      #end if
+
+    finally:
+      self._correlation.correlationID = None
+    #end try
+
+  #end def (handlerMQTTonMessage)
+
+
+  def _handlerLocalMessage(self, message):
+    self.handlerMQTTonMessage(None, None, message)
+  #end def (_handlerLocalMessage)
+
+
+  # Commands are either bare strings or envelopes with an ID, enveloped ones run once and get acknowledged (see command_envelope.py)
+  def _handleCommand(self, message):
+
+    timestampReceived = time.monotonic()
+
+    incomingCommand, envelope = command_envelope.ParseCommand(message.payload)
+    commandID = command_envelope.GetCommandID(envelope)
+
+    onComplete = None
+
+    self._flightRecorder.Record(self.puzzleID, 'command', {'command': incomingCommand, 'id': commandID})
+
+    if commandID is not None:
+      if self._commandCache.CheckAndAdd(commandID) is True:
+        queued_log.Info(' -> Ignoring repeated MQTT command: [{}] ID [{}]', incomingCommand, commandID)
+        self.__ackCommand(envelope, incomingCommand, command_envelope.RESULT_DUPLICATE, timestampReceived)
+        return
+      #end if
+
+      onComplete = lambda result: self.__ackCommand(envelope, incomingCommand, result, timestampReceived)
+    #end if
+
+    if incomingCommand in ['RESET', 'ACTIVATE', 'SOLVE', 'PONG', 'REBOOT', 'FAIL']:
+      queued_log.Info(' -> Received MQTT command: [{}]', incomingCommand)
+
+      if incomingCommand == 'RESET':
+        self._fireCallback('command_reset', onComplete)
+
+      elif incomingCommand == 'ACTIVATE':
+        self._fireCallback('command_activate', onComplete)
+
+      elif incomingCommand == 'SOLVE':
+        self._fireCallback('command_solve', onComplete)
+
+      elif incomingCommand == 'FAIL':
+        self._fireCallback('command_fail', onComplete)
+
+      elif incomingCommand == 'PONG':
+        if onComplete is not None:
+          onComplete(command_envelope.RESULT_OK)
+        #end if
+
+      elif incomingCommand == 'REBOOT':
+        # Acknowledged now, there won't be a connection left to do it once command_reboot has run
+        if onComplete is not None:
+          onComplete(command_envelope.RESULT_OK)
+        #end if
+
+        self.PublishStatus('REBOOTING')
+
+        # A hosted puzzle shares the hub's connection with the others, it is not ours to close
+        if self._hub is not None:
+          self._fireCallback('command_reboot')
         else:
-          backOffTimer = backOffTimer * 2
+          self.mqttClient.disconnect()
+          # We fire the command_reboot callback in the on_disconnect event for the MQTT client
         #end if
-        
-      #end try
-    #end while
-        
-  #end def
+      #end if
+
+    else:
+      if onComplete is not None:
+        onComplete(command_envelope.RESULT_UNKNOWN)
+      #end if
+
+      self._publish('CIPO/' + self.puzzleID + '/ERROR', 'Unknown COMMAND received: [{}]'.format(incomingCommand))
+      self._publish('CIPO/' + self.puzzleID + '/STATE', self._puzzleState, priority = PRIORITY_STATE)
+    #end if
+
+  #end def (_handleCommand)
+
+
+  def __ackCommand(self, envelope, command, result, timestampReceived):
+    ack = command_envelope.BuildAck(envelope, command, result, time.monotonic() - timestampReceived)
+    self._publish('CIPO/' + self.puzzleID + '/ACK', wire_format.EncodePayload(ack, self._wireFormat), qos=1)
+  #end def (__ackCommand)
+
+
+  # The room controller echoes our heartbeat back (see ping_latency.py), older ones send an empty PONG
+  def _handlePong(self, message):
+
+    try:
+      pongData = wire_format.DecodePayload(message.payload)
+    except ValueError:
+      pongData = None
+    #end try
+
+    if isinstance(pongData, dict):
+      self._latencyTracker.OnPong(pongData)
+    #end if
+
+    self._fireCallback('pong')
+  #end def (_handlePong)
+
+
+  def _handleFormat(self, message):
+    self.SetWireFormat(message.payload.decode())
+  #end def (_handleFormat)
+
+
+  # Writing the file is no job for paho's network thread. The reply says where it went, on the
+  # controller itself, or why it didn't.
+  def _handleDump(self, message):
+
+    def dumpFlightRecorder():
+      dumpFileName = self._flightRecorder.TryDump('mqtt')
+
+      reply = {}
+      reply['file']   = dumpFileName
+      reply['events'] = len(self._flightRecorder.GetEvents())
+
+      self._publish('CIPO/' + self.puzzleID + '/DUMP', wire_format.EncodePayload(reply, self._wireFormat), qos=1)
+    #end def
+
+    self._dispatch('dump', dumpFlightRecorder)
+  #end def (_handleDump)
 
 
   def disconnect(self):
+    if self._bridgedBus is True:
+      self._localBus.UnsubscribeAll(self._handlerLocalMessage)
+    #end if
+
+    if self._hub is not None:
+      self._hub.DetachPuzzle(self)
+      return
+    #end if
+
+    # A clean disconnect doesn't fire the last will, and a retained state would outlive us
+    if self._retainState is True:
+      self._publish('CIPO/' + self.puzzleID + '/STATE', 'UNKNOWN', qos=1, retain = True, priority = PRIORITY_STATE, messageExpiry = None)
+    #end if
+
     self.mqttClient.disconnect()
   #end def (disconnect)  
 
 
-  def SendPing(self):
+  def BuildPing(self):
 
-    platform = 'RCPCS v{}/Python v{}.{}.{}/{}'.format(__version__, sys.version_info[0], sys.version_info[1], sys.version_info[2], self.__getRaspberryPiVersion() )
- 
-    #TODO - add wireless signal strength as well
     data = {}
     data['timestamp']    = time.time()
     data['puzzleID']     = self.puzzleID
-    data['ipAddress']    = self.__getIPAddress()
-    data['uptime']       = self.__getUptime()
-    data['MACaddress']   = self.__getMACaddress()
-    data['temperature']  = self.__getTemperature()
+    data['ipAddress']    = self._telemetry.GetMetric('ipAddress')
+    data['uptime']       = self._telemetry.GetMetric('uptime')
+    data['MACaddress']   = self._telemetry.GetMetric('MACaddress')
+    data['temperature']  = self._telemetry.GetMetric('temperature')
+    data['wireless']     = self._linkQuality.GetSummary()
     data['role']         = 'puzzle'
-    data['platform']     = platform
-    data['currentStatus'] = self.__puzzleState
-    json_data = json.dumps(data)
+    data['platform']     = self._telemetry.GetMetric('platform')
+    data['currentStatus'] = self._puzzleState
+    data['protocolVersion'] = wire_format.PROTOCOL_VERSION
+    data['heartbeatInterval'] = self.pingDelay
+    data['wireFormats']  = wire_format.GetAvailableFormats()
+    data['pingID'], data['pingSent'] = self._latencyTracker.NextPing()
+    data['latency']      = self._latencyTracker.GetMetrics()
+    data['callbacks']    = self._callbackExecutor.GetMetrics()
+    data['timers']       = self._timerWheel.GetMetrics()
+    data['loopLag']      = self._loopWatchdog.GetSummary()
+    data['commands']     = self._commandCache.GetMetrics()
+
+    if self._hub is not None:
+      data['hubID']      = self._hub.hubID
+    #end if
+
+    data['outboundQueueDepth'] = self._outboundQueue.GetDepth()
+    data['connection']   = self._reconnectBackoff.GetMetrics()
+
+    if self._mqttSession is not None:
+      data['mqtt']       = self._mqttSession.GetMetrics()
+    #end if
+
+    if self._localBus is not None:
+      data['localBus']   = self._localBus.GetMetrics()
+    #end if
+
+    if len(self._startupTimings) > 0:
+      data['startupTimings'] = dict(self._startupTimings)
+    #end if
+
+    if self._heartbeatEncoder is not None:
+      data = self._heartbeatEncoder.Encode(data)
+    #end if
+
+    return data
+  #end def (BuildPing)
+
+
+  def SendPing(self):
+
+    data = self.BuildPing()
+    payload = wire_format.EncodePayload(data, self._wireFormat)
+
+    # Should the queue coalesce this delta with the beat before it, the full snapshot goes out instead (see heartbeat_delta.py)
+    fullPayload = None
+
+    if data.get('heartbeatType') == 'delta':
+      fullPayload = wire_format.EncodePayload(self._heartbeatEncoder.GetFullSnapshot(), self._wireFormat)
+    #end if
     
-    self.mqttClient.publish('CIPO/PING/' + self.puzzleID, json_data )
+    # A heartbeat is stale by the time the next one is due
+    self._publish('CIPO/PING/' + self.puzzleID, payload, priority = PRIORITY_HEARTBEAT, messageExpiry = self.pingDelay * 2, fullPayload = fullPayload)
+
+    # The full loop lag report is once per process, a hub sends it for all of its puzzles (see loop_watchdog.py)
+    if self._hub is None:
+      loopLagReport = self._loopWatchdog.TakeReport()
+
+      if loopLagReport is not None:
+        self._publish('CIPO/' + self.puzzleID + '/LOOPLAG', wire_format.EncodePayload(loopLagReport, self._wireFormat), priority = PRIORITY_HEARTBEAT)
+      #end if
+    #end if
     
-    self.__callbacks['ping']()
+    self._fireCallback('ping')
   
   #end def
+
+
+  # Structured payloads go out as JSON unless we're asked for something else (see wire_format.py).
+  # Anything we can't produce is refused and we carry on with what we had.
+  def SetWireFormat(self, wireFormat):
+
+    if wireFormat in wire_format.GetAvailableFormats():
+      self._wireFormat = wireFormat
+      return True
+    #end if
+
+    if self._MQTTConnected is True:
+      self._publish('CIPO/' + self.puzzleID + '/ERROR', 'Unsupported wire format requested: [{}]'.format(wireFormat))
+    #end if
+
+    return False
+  #end def (SetWireFormat)
   
 
+  # Delta heartbeats send a full snapshot on connect and every SnapshotInterval beats, and only the
+  # changed fields in between (see heartbeat_delta.py). The room controller has to understand them,
+  # so this is off unless you ask for it.
+  def EnableDeltaHeartbeats(self, SnapshotInterval = 10):
+    self._heartbeatEncoder = HeartbeatEncoder(SnapshotInterval)
+  #end def (EnableDeltaHeartbeats)
+
+
+  def DisableDeltaHeartbeats(self):
+    self._heartbeatEncoder = None
+  #end def (DisableDeltaHeartbeats)
+
+
+  # The heartbeat interval follows the puzzle's state, with a beat straight away on every state change (see
+  # heartbeat_schedule.py). Room controller flows from before heartbeatInterval was advertised give up after
+  # a fixed 15 seconds, keep every interval well under that for them.
+  def EnableAdaptiveHeartbeats(self, Intervals = None):
+    self._heartbeatSchedule = HeartbeatSchedule(Intervals, self.pingDelay)
+    self.pingDelay = self._heartbeatSchedule.GetInterval(self._puzzleState)
+  #end def (EnableAdaptiveHeartbeats)
+
+
+  # Where the heartbeat's wireless summary comes from, /proc/net/wireless and its first interface unless
+  # told otherwise (see link_quality.py)
+  def SetLinkQualitySource(self, Path = '/proc/net/wireless', Interface = None):
+    self._linkQuality = link_quality.GetSharedSampler(Path, Interface)
+  #end def (SetLinkQualitySource)
+
+
+  # ProcessEvents() sends it on its next pass
+  def _requestHeartbeat(self):
+    self._timestampLastPing = 0
+  #end def (_requestHeartbeat)
+
+
   def ProcessEvents(self):
+
+    # In hub mode the hub's ProcessEvents() is the pass through the main loop
+    if self._hub is None:
+      self._loopWatchdog.Tick()
+    #end if
   
-    if time.time() - self.__timestampLastPing > self.__pingDelay:        # send a controller ping periodically
-      self.__timestampLastPing = time.time()
+    if time.time() - self._timestampLastPing > self.pingDelay:        # send a controller ping periodically
+      self._timestampLastPing = time.time()
       self.SendPing()
     #end if
         
   #end def (ProcessLoop)
 
 
+  # The last state we published, None before the first one
+  def GetPuzzleState(self):
+    return self._puzzleState
+  #end def (GetPuzzleState)
+
+
   def PublishStatus(self, newStatus):
     if newStatus in ['RESET', 'ACTIVE', 'SOLVED', 'FAILED', 'REBOOTING']:
-      self.__puzzleState = newStatus
-      self.mqttClient.publish('CIPO/' + self.puzzleID + '/STATE', self.__puzzleState, qos=1)
+      self._puzzleState = newStatus
+      self._flightRecorder.Record(self.puzzleID, 'state', newStatus)
+
+      # The room controller has to hear about the new interval before it starts waiting on it
+      if self._heartbeatSchedule is not None:
+        self.pingDelay = self._heartbeatSchedule.GetInterval(newStatus)
+        self._requestHeartbeat()
+      #end if
+
+      seq = None
+
+      if self._stateJournal is not None:
+        seq = self._stateJournal.Append(newStatus)
+      #end if
+
+      self.__publishState(newStatus, seq, self._retainState)
     #end if
   #end def
+
+
+  # State transitions get written to a local journal before they go out, and anything the broker never
+  # acknowledged is sent again the next time we start (see state_journal.py). Call this straight after
+  # creating the object, before the puzzle publishes its first state.
+  def EnableStateJournal(self, JournalDirectory = '/var/tmp/rcpcs', MaxBytes = 65536):
+
+    os.makedirs(JournalDirectory, exist_ok=True)
+
+    self._stateJournal = StateJournal(os.path.join(JournalDirectory, 'state-' + self.puzzleID + '.journal'), MaxBytes)
+
+    # Whatever a previous run never got out goes first, oldest first. It's history rather than where we are now, so it is never retained.
+    for seq, state, timestamp in self._stateJournal.GetUndelivered():
+      queued_log.Info('>> Replaying undelivered state [{}] for puzzle ID [{}] from {}', state, self.puzzleID, time.ctime(timestamp))
+      self.__publishState(state, seq, False)
+    #end for
+
+  #end def (EnableStateJournal)
+
+
+  def __publishState(self, state, seq, retain):
+
+    onDelivered = None
+
+    if seq is not None:
+      journal = self._stateJournal
+      onDelivered = lambda: journal.MarkDelivered(seq)
+    #end if
+
+    self._outboundQueue.Publish('CIPO/' + self.puzzleID + '/STATE', state, qos=1, retain = retain, priority = PRIORITY_STATE, onDelivered = onDelivered,
+                                publishProperties = self.__buildPublishProperties(None))
+  #end def (__publishState)
+
+
+  # Depth, drops and coalesced heartbeats of the outbound queue (shared with the other puzzles in hub mode)
+  def GetPublishQueueMetrics(self):
+    return self._outboundQueue.GetMetrics()
+  #end def (GetPublishQueueMetrics)
+
+
+  # messageExpiry (seconds) and the correlation ID only go out over MQTT v5, 3.1.1 just sends the message
+  def _publish(self, topic, payload, qos = 0, retain = False, priority = PRIORITY_ERROR, messageExpiry = 60, fullPayload = None):
+    self._outboundQueue.Publish(topic, payload, qos = qos, retain = retain, priority = priority, publishProperties = self.__buildPublishProperties(messageExpiry), fullPayload = fullPayload)
+  #end def (_publish)
+
+
+  def __buildPublishProperties(self, messageExpiry):
+    return mqtt_v5.BuildPublishProperties(self._mqttSession, messageExpiry, getattr(self._correlation, 'correlationID', None))
+  #end def (__buildPublishProperties)
   
       
   # These are the callbacks we will support at the moment:
   # - command_reset 
   # - command_activate
   # - command_solve
+  # - command_fail
   # - command_reboot
+  # - ping
   # - pong
+  #
+  # They run on a worker thread, one at a time and in order for this puzzle ID (see callback_executor.py).
   def RegisterCallback(self, eventName, callbackFunction):
   
     if eventName in ['command_reset', 'command_activate', 'command_solve', 'command_reboot', 'command_fail', 'pong', 'ping']:
-      self.__callbacks[eventName] = callbackFunction
+      self._callbacks[eventName] = callbackFunction
     #end if
         
   #end def (RegisterCallback)
 
 
-  def __getTemperature(self):
-    with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
-      celsius = int(f.readline().strip()) / 1000;
+  def UnregisterCallback(self, eventName):
+    self._callbacks.pop(eventName, None)
+  #end def (UnregisterCallback)
 
-      fahrenheit = math.floor((celsius * 1.8) + 32);
 
-    return fahrenheit
-  #end def (__getTemperature)
-  
-  
-  def __getUptime(self):
-    with open('/proc/uptime', 'r') as f:
-      uptime_seconds = float(f.readline().split()[0])
-              
-    return uptime_seconds
-  #end def (__getUptime)
-  
-  
-  def __getIPAddress(self):
-    try: 
-      s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-      s.connect((self.mqttBroker, 80))  # The server doesn't need to actually be listening on this port for this to work BTW
+  # Puzzle-Out-Puzzle-In: puzzles signal each other directly over POPI/<puzzleID>/<eventName>,
+  # no room controller in the middle. The handler is called as handlerFunction(eventName, payload).
+  def RegisterPuzzleEventHandler(self, eventName, handlerFunction):
+    self._router.AddRoute('POPI/' + self.puzzleID + '/' + eventName,
+                          lambda message: self._dispatch('POPI ' + message.topic, lambda: handlerFunction(message.topic.rsplit('/', 1)[1], message.payload.decode())))
+  #end def (RegisterPuzzleEventHandler)
 
-      host_ip = s.getsockname()[0]
 
-      s.close()
-    
-      return host_ip
-    
-    except:
-      return None
-    #end try
-    
-  #end def (__getIPAddress)
+  # Over MQTT v5 an event that can't be delivered within commandExpiry seconds is dropped by the broker, rather than acted on late
+  def SendPuzzleEvent(self, targetPuzzleID, eventName, payload = ''):
+    self._publish('POPI/' + targetPuzzleID + '/' + eventName, payload, messageExpiry = self.commandExpiry)
+  #end def (SendPuzzleEvent)
 
-  def __getMACaddress(self):
-    return ':'.join(re.findall('..', '%012x' % uuid.getnode() ))
-  #end def (__getMACaddress)
-    
-  
-  def __getRaspberryPiVersion(self):
-  
-    # Only Raspberry Pi's will have this, so we catch the error to mean we're running on some other platform (Simu-Puzzle perhaps?)
-#    try:
-    with open('/proc/device-tree/model', 'r') as f:
-      model = f.readline()
-      return model
-        
-#    except:
-#      return 'Unknown'
+
+  # Any other topic a puzzle wants to hear about (MQTT wildcards are fine). We subscribe to it
+  # on every (re)connect, and the handler is called with the paho message.
+  def RegisterTopicHandler(self, topicPattern, handlerFunction):
+
+    self._router.AddRoute(topicPattern, lambda message: self._dispatch('TOPIC ' + message.topic, lambda: handlerFunction(message)))
+
+    if topicPattern in self._customTopics:
+      return
+    #end if
+
+    self._customTopics.append(topicPattern)
+
+    if self._bridgedBus is True:
+      self._localBus.Subscribe(topicPattern, self._handlerLocalMessage, Bridged = True)
+    #end if
+
+    # The hub hands us only what it knows is ours
+    if self._hub is not None:
+      self._hub.AddPuzzleTopic(self, topicPattern)
+    #end if
+
+    if self._MQTTConnected is True:
+      self.mqttClient.subscribe(topicPattern)
+    #end if
+
+  #end def (RegisterTopicHandler)
+
+
+  # Callbacks are optional, a puzzle that doesn't care about (say) pings just never registers one.
+  # This also covers the connect handler firing 'ping' before the script has registered anything.
+  #
+  # onComplete (optional) is called as onComplete(result) once the callback has run, or straight away if there isn't one.
+  def _fireCallback(self, eventName, onComplete = None):
+
+    if eventName not in self._callbacks:
+      if onComplete is not None:
+        onComplete(command_envelope.RESULT_OK)
+      #end if
+
+      return
+    #end if
+
+    callbackFunction = self._callbacks[eventName]
+
+    if onComplete is None:
+      self._dispatch(eventName, callbackFunction)
+      return
+    #end if
+
+    def callbackWithResult():
+      try:
+        callbackFunction()
+      except Exception:
+        onComplete(command_envelope.RESULT_ERROR)
+        raise
       #end try
-  #end def (__getRaspberryPiVersion)
\ No newline at end of file
+
+      onComplete(command_envelope.RESULT_OK)
+    #end def
+
+    self._dispatch(eventName, callbackWithResult)
+  #end def (_fireCallback)
+
+
+  def _dispatch(self, eventName, callbackFunction):
+
+    correlationID = getattr(self._correlation, 'correlationID', None)
+
+    # The callback runs on a worker thread, take the correlation ID of the message that fired it along
+    if correlationID is not None:
+      def correlatedCallback():
+        self._correlation.correlationID = correlationID
+
+        try:
+          callbackFunction()
+        finally:
+          self._correlation.correlationID = None
+        #end try
+      #end def
+
+      self._callbackExecutor.Submit(self.puzzleID, eventName, correlatedCallback, self.__handlerSlowCallback)
+      return
+    #end if
+
+    self._callbackExecutor.Submit(self.puzzleID, eventName, callbackFunction, self.__handlerSlowCallback)
+  #end def (_dispatch)
+
+
+  def __handlerSlowCallback(self, eventName, runSeconds, timedOut):
+
+    if timedOut is True:
+      errorMessage = 'Callback [{}] still running after {:.1f} seconds, later callbacks for this puzzle wait for it'.format(eventName, runSeconds)
+    else:
+      errorMessage = 'Callback [{}] took {:.1f} seconds'.format(eventName, runSeconds)
+    #end if
+
+    if self._MQTTConnected is True:
+      self._publish('CIPO/' + self.puzzleID + '/ERROR', errorMessage)
+    #end if
+
+  #end def (__handlerSlowCallback)
@@ -0,0 +1,381 @@
+#!/usr/bin/python3
+
+# Room Controller Communications Hub
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# A single physical puzzle controller very often hosts more than one logical puzzle
+# (the Mad Scientist multi controller runs six of them). Giving every one of those its
+# own ControllerCommunications object means six paho clients, six network threads, six
+# keepalives and six reconnect loops all talking to the same broker.
+#
+# The hub owns exactly one MQTT connection and hosts any number of puzzle IDs on it:
+#
+#   hub  = ControllerCommunicationsHub('ms-multi', 'ms-roomcontroller.local')
+#   fuel = hub.AddPuzzle('fuel')
+#   keys = hub.AddPuzzle('keys')
+#
+# Each object handed back is a regular ControllerCommunications (RegisterCallback,
+# PublishStatus, SendPing, ProcessEvents all work the same), it just shares the hub's
+# connection. Every puzzle ID keeps its own COPI/POPI subscriptions, state and heartbeat.
+#
+# MQTT only allows one last will per connection, so the hub's will goes to
+# CIPO/HUB/<hubID>/STATE and every heartbeat from a hosted puzzle carries a 'hubID'
+# field so the room controller can tell which puzzles went away with it. On a clean
+# shutdown the hub publishes UNKNOWN for every hosted puzzle itself.
+#
+# Hosted puzzles signalling each other (POPI events, custom topics) go through the broker
+# and back unless the hub is given a LocalBus (Bus = ..., see local_bus.py), which hands
+# them over in-process and still bridges everything to the broker. Without a broker
+# (mqttBroker None) the bus stands in for it altogether.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Python3 Dependencies:
+#  - paho-mqtt-client
+#  $> sudo pip3 install paho-mqtt
+
+
+import json
+import time
+
+import loop_watchdog
+import mqtt_v5
+import queued_log
+from controller_communications import ControllerCommunications
+from publish_queue import OutboundPublishQueue, PRIORITY_STATE
+from topic_router import TopicRouter
+from reconnect_backoff import ReconnectBackoff
+
+
+class ControllerCommunicationsHub:
+
+  def __init__(self, hubID, mqttBroker, mqttPort = 1883, AutoConnect = True, BackgroundConnect = False, MQTTv5 = False, RetainState = False, Bus = None):
+    self.hubID = hubID
+    self.mqttBroker = mqttBroker
+    self.mqttPort = mqttPort
+
+    self.mqttKeepalive = 15
+    self.pingDelay = 3
+
+    self.__puzzles = {}
+    self.__puzzleTopics = {}   # puzzleID -> every topic pattern routed to it
+    self.__adminTopics = []    # see RegisterAdminHandler
+    self.__router = TopicRouter()
+    self.__MQTTConnected = False
+    self.__disconnecting = False
+
+    # Hosted puzzles follow the hub (see RetainState in controller_communications.py). We only get one last will,
+    # so if the hub dies its puzzles' retained states are left as they were, CIPO/HUB/<hubID>/STATE says whether to trust them.
+    self.retainState = RetainState
+
+    # Hosted puzzles pick this up (see local_bus.py)
+    self.localBus = Bus
+
+    # One pass of ProcessEvents() is one pass of the main loop, however many puzzles we host (see loop_watchdog.py)
+    self.__loopWatchdog = loop_watchdog.GetSharedWatchdog()
+
+    if self.mqttBroker is None:
+      self.mqttClient = self.localBus.CreateClient()
+    else:
+      self.mqttClient = mqtt_v5.CreateClient(MQTTv5)
+    #end if
+
+    self.mqttClient.on_connect    = self.handlerMQTTonConnect
+    self.mqttClient.on_disconnect = self.handlerMQTTonDisconnect
+    self.mqttClient.on_message    = self.handlerMQTTonMessage
+    self.mqttClient.on_connect_fail = self.handlerMQTTonConnectFail
+
+    # One queue for the whole connection, so one puzzle's heartbeats never hold up another's state change
+    self.outboundQueue = OutboundPublishQueue(self.mqttClient)
+
+    if (self.localBus is not None) and (self.mqttBroker is not None):
+      self.outboundQueue.localBus = self.localBus
+    #end if
+
+    # Hosted puzzles share this too (see mqtt_v5.py)
+    self.mqttSession = None
+
+    if MQTTv5 is True:
+      self.mqttSession = mqtt_v5.MQTTv5Session()
+      self.outboundQueue.protocolSession = self.mqttSession
+    #end if
+
+    self.mqttClient.will_set('CIPO/HUB/' + self.hubID + '/STATE', payload='UNKNOWN', qos=1, retain=self.retainState)
+
+    # Jittered, so we don't come back at the same instant as every other controller in the room
+    self.reconnectBackoff = ReconnectBackoff()
+    self.__scheduleReconnect()
+
+    if (AutoConnect is True) and (BackgroundConnect is True):
+      self.connectInBackground()
+    elif AutoConnect is True:
+      self.connect()
+    #end if
+
+  #end def
+
+
+  def connect(self):
+
+    while (self.__MQTTConnected == False):
+      try:
+        queued_log.Info(">> Attempting MQTT broker connection for hub [{}]..", self.hubID)
+        self.mqttClient.connect(self.mqttBroker, self.mqttPort, self.mqttKeepalive)
+        self.mqttClient.loop_start()
+        time.sleep(1)
+
+      except Exception as connectError:
+        self.reconnectBackoff.OnConnectFailed(str(connectError))
+        backOffDelay = self.reconnectBackoff.NextDelay()
+
+        queued_log.Warning('>> Unable to connect to MQTT broker! Sleeping for {:.1f} seconds..', backOffDelay)
+        time.sleep(backOffDelay)
+      #end try
+    #end while
+
+  #end def (connect)
+
+
+  # Returns straight away, paho's network thread keeps trying until the broker is there
+  def connectInBackground(self):
+    queued_log.Info('>> Connecting hub [{}] to MQTT broker [{}:{}] in the background..', self.hubID, self.mqttBroker, self.mqttPort)
+    self.mqttClient.connect_async(self.mqttBroker, self.mqttPort, self.mqttKeepalive)
+    self.mqttClient.loop_start()
+  #end def (connectInBackground)
+
+
+  def disconnect(self):
+
+    # Stand in for the per-puzzle last wills we can't have on a shared connection
+    for puzzleID in self.__puzzles.keys():
+      self.outboundQueue.Publish('CIPO/' + puzzleID + '/STATE', 'UNKNOWN', qos=1, retain = self.retainState, priority = PRIORITY_STATE)
+    #end for
+
+    self.__disconnecting = True
+
+    self.outboundQueue.Publish('CIPO/HUB/' + self.hubID + '/STATE', 'OFFLINE', qos=1, retain = self.retainState, priority = PRIORITY_STATE)
+    self.mqttClient.disconnect()
+  #end def (disconnect)
+
+
+  def AddPuzzle(self, puzzleID):
+    return ControllerCommunications(puzzleID, self.mqttBroker, self.mqttPort, Hub = self)
+  #end def (AddPuzzle)
+
+
+  # Called by ControllerCommunications when it is built in hub mode
+  def AttachPuzzle(self, puzzleComms):
+
+    if puzzleComms.puzzleID in self.__puzzles:
+      raise ValueError('Puzzle ID [{}] is already hosted on hub [{}]'.format(puzzleComms.puzzleID, self.hubID))
+    #end if
+
+    puzzleComms.pingDelay = self.pingDelay
+    self.__puzzles[puzzleComms.puzzleID] = puzzleComms
+    self.__puzzleTopics[puzzleComms.puzzleID] = []
+
+    self.AddPuzzleTopic(puzzleComms, 'COPI/' + puzzleComms.puzzleID + '/#')
+    self.AddPuzzleTopic(puzzleComms, 'POPI/' + puzzleComms.puzzleID + '/#')
+
+    self.__staggerHeartbeats()
+
+    if self.__MQTTConnected is True:
+      puzzleComms.handlerMQTTonConnect(self.mqttClient, None, {}, 0)
+    #end if
+
+  #end def (AttachPuzzle)
+
+
+  def DetachPuzzle(self, puzzleComms):
+
+    if self.__puzzles.pop(puzzleComms.puzzleID, None) is None:
+      return
+    #end if
+
+    puzzleTopics = self.__puzzleTopics.pop(puzzleComms.puzzleID)
+
+    for topicPattern in puzzleTopics:
+      self.__router.RemoveRoute(topicPattern, puzzleComms.handlerMQTTonMessage)
+    #end for
+
+    # Another hosted puzzle might still want a custom topic, so only drop ours
+    self.mqttClient.unsubscribe(['COPI/' + puzzleComms.puzzleID + '/#', 'POPI/' + puzzleComms.puzzleID + '/#'])
+    self.outboundQueue.Publish('CIPO/' + puzzleComms.puzzleID + '/STATE', 'UNKNOWN', qos=1, retain = self.retainState, priority = PRIORITY_STATE)
+
+    puzzleComms._MQTTConnected = False
+
+    self.__staggerHeartbeats()
+  #end def (DetachPuzzle)
+
+
+  # Route everything matching topicPattern to this hosted puzzle, the puzzle subscribes to it itself
+  def AddPuzzleTopic(self, puzzleComms, topicPattern):
+    self.__router.AddRoute(topicPattern, puzzleComms.handlerMQTTonMessage)
+    self.__puzzleTopics[puzzleComms.puzzleID].append(topicPattern)
+  #end def (AddPuzzleTopic)
+
+
+  # Hub-wide requests from the room controller arrive on COPI/HUB/<hubID>/<requestName>, the handler is called
+  # with the paho message on paho's network thread. Replies go out with PublishHubEvent().
+  def RegisterAdminHandler(self, requestName, handlerFunction):
+
+    topic = 'COPI/HUB/' + self.hubID + '/' + requestName
+
+    self.__router.AddRoute(topic, lambda client, userdata, message: handlerFunction(message))
+    self.__adminTopics.append(topic)
+
+    if self.__MQTTConnected is True:
+      self.mqttClient.subscribe(topic)
+    #end if
+
+  #end def (RegisterAdminHandler)
+
+
+  def PublishHubEvent(self, eventName, payload):
+    self.outboundQueue.Publish('CIPO/HUB/' + self.hubID + '/' + eventName, payload, qos=1, priority = PRIORITY_STATE)
+  #end def (PublishHubEvent)
+
+
+  def GetPuzzleIDs(self):
+    return list(self.__puzzles.keys())
+  #end def (GetPuzzleIDs)
+
+
+  def ProcessEvents(self):
+    self.__loopWatchdog.Tick()
+
+    for puzzleComms in self.__puzzles.values():
+      puzzleComms.ProcessEvents()
+    #end for
+
+    # The hosted puzzles' heartbeats only carry a summary, the full loop lag report goes out once for all of them
+    loopLagReport = self.__loopWatchdog.TakeReport()
+
+    if loopLagReport is not None:
+      self.PublishHubEvent('LOOPLAG', json.dumps(loopLagReport))
+    #end if
+  #end def (ProcessEvents)
+
+
+  # Spread the hosted puzzles' heartbeats evenly across the ping interval,
+  # so the broker sees a trickle instead of N pings in the same instant.
+  def __staggerHeartbeats(self):
+
+    if len(self.__puzzles) == 0:
+      return
+    #end if
+
+    now = time.time()
+    spacing = self.pingDelay / len(self.__puzzles)
+
+    for index, puzzleComms in enumerate(self.__puzzles.values()):
+      puzzleComms._timestampLastPing = now - self.pingDelay + (spacing * (index + 1))
+    #end for
+
+  #end def (__staggerHeartbeats)
+
+
+  # paho's network thread does the actual reconnecting, we just tell it how long to wait before the next attempt
+  def __scheduleReconnect(self):
+    reconnectDelay = self.reconnectBackoff.NextDelay()
+    self.mqttClient.reconnect_delay_set(min_delay=reconnectDelay, max_delay=reconnectDelay)
+    return reconnectDelay
+  #end def (__scheduleReconnect)
+
+
+  def handlerMQTTonConnect(self, client, userdata, flags, rc, properties = None):
+
+    if rc != 0:
+      self.reconnectBackoff.OnConnectFailed(mqtt_v5.ConnackString(rc))
+
+      if mqtt_v5.IsProtocolRefused(rc):
+        mqtt_v5.FallBackToMQTTv311(self.mqttClient)
+        self.mqttSession.Disable()
+        queued_log.Warning('>> MQTT broker does not support MQTT v5, hub [{}] falling back to 3.1.1..', self.hubID)
+      #end if
+
+      queued_log.Warning('>> MQTT broker refused hub [{}] [{}], next attempt in {:.1f} seconds..', self.hubID, mqtt_v5.ConnackString(rc), self.__scheduleReconnect())
+      return
+    #end if
+
+    queued_log.Info('>> Hub [{}] connected to MQTT Broker [{}:{}] hosting {}..', self.hubID, self.mqttBroker, self.mqttPort, self.GetPuzzleIDs())
+
+    self.__MQTTConnected = True
+    self.reconnectBackoff.OnConnected()
+
+    if self.mqttSession is not None:
+      self.mqttSession.OnConnect(properties)
+    #end if
+
+    self.outboundQueue.SetConnected(True)
+
+    self.outboundQueue.Publish('CIPO/HUB/' + self.hubID + '/STATE', 'ONLINE', qos=1, retain = self.retainState, priority = PRIORITY_STATE)
+
+    for topic in self.__adminTopics:
+      self.mqttClient.subscribe(topic)
+    #end for
+
+    # Every hosted puzzle subscribes to its own COPI/POPI topics and announces its state
+    for puzzleComms in list(self.__puzzles.values()):
+      puzzleComms.handlerMQTTonConnect(client, userdata, flags, rc, properties)
+    #end for
+
+  #end def (handlerMQTTonConnect)
+
+
+  def handlerMQTTonDisconnect(self, client, userdata, rc, properties = None):
+
+    self.__MQTTConnected = False
+    self.outboundQueue.SetConnected(False)
+
+    if self.mqttSession is not None:
+      self.mqttSession.OnDisconnect()
+    #end if
+
+    for puzzleComms in self.__puzzles.values():
+      puzzleComms._MQTTConnected = False
+    #end for
+
+    # A hosted puzzle's REBOOT fires its command_reboot straight away, it never closes our connection
+    if self.__disconnecting is True:
+      self.reconnectBackoff.OnDisconnected()
+      self.mqttClient.loop_stop()
+
+    else:
+      self.reconnectBackoff.OnDisconnected(mqtt_v5.ErrorString(rc))
+
+      # paho's network thread reconnects by itself, after the delay we give it
+      queued_log.Warning('>> Hub [{}] lost the MQTT broker connection, next attempt in {:.1f} seconds..', self.hubID, self.__scheduleReconnect())
+    #end if
+
+  #end def (handlerMQTTonDisconnect)
+
+
+  def handlerMQTTonConnectFail(self, client, userdata):
+    self.reconnectBackoff.OnConnectFailed('Unable to connect to MQTT broker')
+    queued_log.Warning('>> Hub [{}] unable to connect to MQTT broker! Next attempt in {:.1f} seconds..', self.hubID, self.__scheduleReconnect())
+  #end def (handlerMQTTonConnectFail)
+
+
+  # Every hosted puzzle has its COPI/POPI topics (and any custom ones) routed to it,
+  # so each message reaches its puzzle no matter how many puzzles we host.
+  def handlerMQTTonMessage(self, client, userdata, message):
+    self.__router.Route(message.topic, client, userdata, message)
+  #end def (handlerMQTTonMessage)
+
+#end class
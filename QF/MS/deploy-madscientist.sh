@@ -3,6 +3,28 @@
 #class_puzzle_contact_algo.py
 #class_puzzle_contact_and.py
 #controller_communications.py
+#async_controller_communications.py
+#controller_communications_hub.py
+#telemetry.py
+#heartbeat_delta.py
+#wire_format.py
+#publish_queue.py
+#topic_router.py
+#state_journal.py
+#reconnect_backoff.py
+#ping_latency.py
+#callback_executor.py
+#flight_recorder.py
+#local_bus.py
+#mqtt_v5.py
+#command_envelope.py
+#heartbeat_schedule.py
+#queued_log.py
+#link_quality.py
+#timer_wheel.py
+#loop_watchdog.py
+#room_config.py
+#ms-room.json
 #ms_puzzle_ctrl_reactor.py
 #ms_puzzle_ctrl_multi.py
 
@@ -10,10 +32,10 @@ USERNAME="pi"
 PASSWORD="raspberry"
 
 echo "Deploying the multi puzzle controller.."
-sshpass -p${PASSWORD} scp class_puzzle_contact_and.py controller_communications.py ms_puzzle_ctrl_multi.py ${USERNAME}@192.168.1.31:/opt/questfactor/puzzle
+sshpass -p${PASSWORD} scp class_puzzle_contact_and.py class_puzzle_contact_algo.py controller_communications.py controller_communications_hub.py telemetry.py heartbeat_delta.py wire_format.py publish_queue.py topic_router.py state_journal.py reconnect_backoff.py ping_latency.py callback_executor.py flight_recorder.py local_bus.py mqtt_v5.py command_envelope.py heartbeat_schedule.py queued_log.py link_quality.py timer_wheel.py loop_watchdog.py room_config.py puzzle_supervisor.py ms-room.json ms_puzzle_ctrl_multi.py ${USERNAME}@192.168.1.31:/opt/questfactor/puzzle
 
 echo "Deploying to the reactor puzzle controller.."
-sshpass -p${PASSWORD} scp class_puzzle_contact_algo.py controller_communications.py ms_puzzle_ctrl_reactor.py ${USERNAME}@192.168.1.30:/opt/questfactor/puzzle
+sshpass -p${PASSWORD} scp class_puzzle_contact_algo.py controller_communications.py async_controller_communications.py telemetry.py heartbeat_delta.py wire_format.py publish_queue.py topic_router.py state_journal.py reconnect_backoff.py ping_latency.py callback_executor.py flight_recorder.py local_bus.py mqtt_v5.py command_envelope.py heartbeat_schedule.py queued_log.py link_quality.py timer_wheel.py loop_watchdog.py ms_puzzle_ctrl_reactor.py ${USERNAME}@192.168.1.30:/opt/questfactor/puzzle
 
 echo "Deploying to the media controller (countdown TVs)"
-sshpass -p${PASSWORD} scp start-chromium.sh media.service media_communications.py ${USERNAME}@192.168.1.111:/opt/questfactor/media
+sshpass -p${PASSWORD} scp start-chromium.sh media.service media_communications.py wire_format.py reconnect_backoff.py mqtt_v5.py heartbeat_schedule.py queued_log.py link_quality.py timer_wheel.py loop_watchdog.py ${USERNAME}@192.168.1.111:/opt/questfactor/media
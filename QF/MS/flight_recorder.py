@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+# Puzzle Flight Recorder
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# The only record of what a puzzle did used to be its print() output, and only if it was
+# running with Debug on and someone kept the console. Verbose logging to the SD card all
+# game long is slow and wears the card out.
+#
+# Puzzle classes record structured events into a FlightRecorder instead:
+#
+#   recorder.Record('fuel', 'contact', {'pin': 'GPIO17', 'active': True})
+#
+# Every event is (sequence, monotonic timestamp, puzzle ID, event, payload) and goes into a
+# fixed-size ring buffer in memory, the oldest events fall off the end. Recording is a
+# single deque append, no lock and no I/O, so it is safe from GPIO callbacks and never blocks.
+#
+# The buffer only reaches the disk when somebody asks for it:
+#  - the process crashes (an uncaught exception on any thread)
+#  - it gets a SIGUSR1 ($> pkill -USR1 -f ms_puzzle_ctrl_multi.py)
+#  - the room controller asks over MQTT (COPI/<puzzleID>/DUMP, see controller_communications.py)
+#
+# Each dump is a JSON lines file in DumpDirectory: a header line, then one line per event
+# oldest first, with the wall clock time worked out from the monotonic one.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+import queued_log
+
+
+_sharedRecorder = None
+_sharedRecorderLock = threading.Lock()
+
+
+# One recorder for every puzzle in the process, with the crash and SIGUSR1 dumps hooked up the first time it is asked for
+def GetSharedRecorder():
+
+  global _sharedRecorder
+
+  with _sharedRecorderLock:
+    if _sharedRecorder is None:
+      _sharedRecorder = FlightRecorder()
+      _sharedRecorder.InstallDumpTriggers()
+    #end if
+
+    return _sharedRecorder
+  #end with
+
+#end def (GetSharedRecorder)
+
+
+class FlightRecorder:
+
+  def __init__(self, Capacity = 2048, DumpDirectory = '/var/tmp/rcpcs'):
+    self.dumpDirectory = DumpDirectory
+
+    self.__events = collections.deque(maxlen=Capacity)
+    self.__sequence = itertools.count()   # next() on it is atomic, unlike += on an int
+    self.__dumpLock = threading.Lock()
+    self.__triggersInstalled = False
+  #end def
+
+
+  # Never blocks, payload should be something json can cope with (anything else is dumped as its str())
+  def Record(self, puzzleID, eventName, payload = None):
+    self.__events.append((next(self.__sequence), time.monotonic(), puzzleID, eventName, payload))
+  #end def (Record)
+
+
+  # Oldest first, as (sequence, timestamp, puzzleID, eventName, payload)
+  def GetEvents(self):
+
+    # Copying the deque is one C call, a Record() from another thread can't get in the middle of it
+    return list(self.__events)
+  #end def (GetEvents)
+
+
+  # Writes the buffer out and returns the file name, the buffer itself is left as it was
+  def Dump(self, reason = 'request'):
+
+    with self.__dumpLock:
+      events = self.GetEvents()
+      timestampMonotonic = time.monotonic()
+      timestampWall = time.time()
+
+      os.makedirs(self.dumpDirectory, exist_ok=True)
+
+      dumpFileName = os.path.join(self.dumpDirectory, 'flight-{}-{}-{}.jsonl'.format(os.getpid(), time.strftime('%Y%m%d-%H%M%S'), reason))
+
+      header = {}
+      header['reason']    = reason
+      header['pid']       = os.getpid()
+      header['dumped']    = timestampWall
+      header['monotonic'] = timestampMonotonic
+      header['events']    = len(events)
+      header['lost']      = events[0][0] if len(events) > 0 else 0   # everything before the oldest one we still have
+
+      with open(dumpFileName, 'w') as dumpFile:
+        dumpFile.write(json.dumps(header) + '\n')
+
+        for sequence, timestamp, puzzleID, eventName, payload in events:
+          event = {}
+          event['seq']       = sequence
+          event['monotonic'] = timestamp
+          event['time']      = timestampWall - (timestampMonotonic - timestamp)
+          event['puzzleID']  = puzzleID
+          event['event']     = eventName
+          event['payload']   = payload
+
+          dumpFile.write(json.dumps(event, default=str) + '\n')
+        #end for
+      #end with
+
+      return dumpFileName
+    #end with
+
+  #end def (Dump)
+
+
+  # Like Dump(), but never raises. The triggers use this, a failed dump mustn't take anything else down with it.
+  def TryDump(self, reason):
+
+    try:
+      dumpFileName = self.Dump(reason)
+      queued_log.Info('>> Flight recorder dumped to [{}]', dumpFileName)
+      return dumpFileName
+
+    except Exception as dumpError:
+      queued_log.Warning('>> Unable to dump the flight recorder: [{}]', dumpError)
+      return None
+    #end try
+
+  #end def (TryDump)
+
+
+  # Dumps on an uncaught exception (any thread) and on SIGUSR1. Signal handlers can only be set from the
+  # main thread, from anywhere else we go without SIGUSR1.
+  def InstallDumpTriggers(self):
+
+    if self.__triggersInstalled is True:
+      return
+    #end if
+
+    self.__triggersInstalled = True
+
+    previousExceptHook = sys.excepthook
+
+    def crashExceptHook(exceptionType, exceptionValue, exceptionTraceback):
+
+      # Ctrl-C is somebody stopping us, not a crash
+      if not issubclass(exceptionType, KeyboardInterrupt):
+        self.Record(None, 'crash', {'thread': 'main', 'exception': repr(exceptionValue)})
+        self.TryDump('crash')
+      #end if
+
+      previousExceptHook(exceptionType, exceptionValue, exceptionTraceback)
+    #end def
+
+    sys.excepthook = crashExceptHook
+
+    # Python 3.8 and up
+    if hasattr(threading, 'excepthook'):
+      previousThreadExceptHook = threading.excepthook
+
+      def crashThreadExceptHook(hookArgs):
+        threadName = hookArgs.thread.name if hookArgs.thread is not None else None
+        self.Record(None, 'crash', {'thread': threadName, 'exception': repr(hookArgs.exc_value)})
+        self.TryDump('crash')
+        previousThreadExceptHook(hookArgs)
+      #end def
+
+      threading.excepthook = crashThreadExceptHook
+    #end if
+
+    if threading.current_thread() is threading.main_thread():
+      # The handler interrupts whatever the main thread was doing, so the file is written elsewhere
+      signal.signal(signal.SIGUSR1, lambda signalNumber, stackFrame: threading.Thread(target=self.TryDump, args=('signal',), daemon=True).start())
+    #end if
+
+  #end def (InstallDumpTriggers)
+
+#end class
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+# Delta-Encoded Heartbeats
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# A heartbeat repeats the same MAC address, platform, puzzle ID, role and IP address
+# every few seconds. With a few dozen devices on a weak wireless link that adds up.
+#
+# In delta mode a sender publishes a full snapshot when it (re)connects and every
+# SnapshotInterval beats. In between it only sends the fields that changed. Every
+# payload carries a sequence number so the receiving side can tell when it missed one:
+#
+#   {"heartbeatSeq": 12, "heartbeatType": "full",  ...every field...}
+#   {"heartbeatSeq": 13, "heartbeatType": "delta", "timestamp": ..., "uptime": ...}
+#
+# Fields that disappear from the heartbeat are listed in "heartbeatRemoved".
+#
+# A delta is only any good to a receiver that saw the beat before it. When the outbound queue
+# coalesces heartbeats (see publish_queue.py) the one that goes out in place of the others is
+# sent as GetFullSnapshot() instead: the same beat and sequence number, with every field.
+#
+# HeartbeatDecoder is the receiving half. Feed it every payload from one sender and
+# it hands back the rebuilt full heartbeat, or None while it is waiting for the next
+# snapshot after a gap. Payloads without a sequence number (every controller that
+# has not been switched to delta mode) are passed straight through.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+class HeartbeatEncoder:
+
+  def __init__(self, SnapshotInterval = 10):
+    self.__snapshotInterval = SnapshotInterval
+    self.__sequenceNumber   = 0
+    self.__beatsSinceFull   = None
+    self.__lastSent         = {}
+  #end def
+
+
+  # Forces the next heartbeat to be a full snapshot (we call this on every (re)connect)
+  def Reset(self):
+    self.__beatsSinceFull = None
+  #end def (Reset)
+
+
+  def Encode(self, heartbeatData):
+
+    self.__sequenceNumber += 1
+
+    if (self.__beatsSinceFull is None) or (self.__beatsSinceFull + 1 >= self.__snapshotInterval):
+      payload = dict(heartbeatData)
+      payload['heartbeatType'] = 'full'
+
+      self.__beatsSinceFull = 0
+
+    else:
+      payload = {}
+
+      for fieldName, fieldValue in heartbeatData.items():
+        if (fieldName not in self.__lastSent) or (self.__lastSent[fieldName] != fieldValue):
+          payload[fieldName] = fieldValue
+        #end if
+      #end for
+
+      removedFields = [fieldName for fieldName in self.__lastSent if fieldName not in heartbeatData]
+
+      if len(removedFields) > 0:
+        payload['heartbeatRemoved'] = removedFields
+      #end if
+
+      payload['heartbeatType'] = 'delta'
+
+      self.__beatsSinceFull += 1
+    #end if
+
+    payload['heartbeatSeq'] = self.__sequenceNumber
+
+    self.__lastSent = dict(heartbeatData)
+
+    return payload
+  #end def (Encode)
+
+
+  # The beat Encode() was last given, as a full snapshot under its sequence number
+  def GetFullSnapshot(self):
+
+    payload = dict(self.__lastSent)
+    payload['heartbeatType'] = 'full'
+    payload['heartbeatSeq'] = self.__sequenceNumber
+
+    return payload
+  #end def (GetFullSnapshot)
+
+#end class
+
+
+class HeartbeatDecoder:
+
+  def __init__(self):
+    self.__state          = None
+    self.__sequenceNumber = None
+
+    self.gapCount = 0
+  #end def
+
+
+  def GetState(self):
+    return self.__state
+  #end def (GetState)
+
+
+  def Decode(self, payload):
+
+    if 'heartbeatSeq' not in payload:
+      self.__state = dict(payload)
+      self.__sequenceNumber = None
+      return dict(self.__state)
+    #end if
+
+    sequenceNumber = payload['heartbeatSeq']
+    fields = {fieldName: fieldValue for fieldName, fieldValue in payload.items() if fieldName not in ['heartbeatSeq', 'heartbeatType', 'heartbeatRemoved']}
+
+    if payload.get('heartbeatType') == 'full':
+      self.__state = fields
+      self.__sequenceNumber = sequenceNumber
+      return dict(self.__state)
+    #end if
+
+    # A delta is only any good if we saw the beat right before it
+    if (self.__state is None) or (self.__sequenceNumber is None) or (sequenceNumber != self.__sequenceNumber + 1):
+      if self.__state is not None:
+        self.gapCount += 1
+      #end if
+
+      self.__state = None
+      self.__sequenceNumber = None
+      return None
+    #end if
+
+    self.__state.update(fields)
+
+    for fieldName in payload.get('heartbeatRemoved', []):
+      self.__state.pop(fieldName, None)
+    #end for
+
+    self.__sequenceNumber = sequenceNumber
+
+    return dict(self.__state)
+  #end def (Decode)
+
+#end class
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+# Adaptive Heartbeat Schedule
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Every controller used to send a heartbeat every 3 seconds, whether the room was sitting
+# idle overnight or in the middle of a game.
+#
+# A HeartbeatSchedule picks the interval from the puzzle's state instead: slow while it's
+# reset and waiting for players, fast while it is ACTIVE and a dead puzzle would ruin a
+# game. Controllers beat straight away on every state change and advertise the interval
+# they are on in every heartbeat (heartbeatInterval, in seconds), so the room controller can
+# call a controller lost after a few missed beats instead of after a fixed timeout.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Seconds between heartbeats in each state, None is "hasn't published a state yet"
+DEFAULT_INTERVALS = {
+  None:        10,
+  'ONLINE':    10,
+  'RESET':     10,
+  'ACTIVE':    2,
+  'SOLVED':    5,
+  'FAILED':    5,
+  'REBOOTING': 1,
+}
+
+
+class HeartbeatSchedule:
+
+  # Intervals (optional) overrides some or all of DEFAULT_INTERVALS, any other state gets DefaultInterval
+  def __init__(self, Intervals = None, DefaultInterval = 3):
+    self.__intervals = dict(DEFAULT_INTERVALS)
+    self.__defaultInterval = DefaultInterval
+
+    if Intervals is not None:
+      self.__intervals.update(Intervals)
+    #end if
+  #end def
+
+
+  def GetInterval(self, state):
+    return self.__intervals.get(state, self.__defaultInterval)
+  #end def (GetInterval)
+
+#end class
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+# Wi-Fi Link Quality Sampler
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# A puzzle on a marginal Wi-Fi link looks perfectly healthy right up until the SOLVE it
+# publishes never makes it to the room controller. The kernel already knows the link is
+# going bad, it just needs reading:
+#
+#   $> cat /proc/net/wireless
+#   Inter-| sta-|   Quality        |   Discarded packets               | Missed | WE
+#    face | tus | link level noise |  nwid  crypt   frag  retry   misc | beacon | 22
+#    wlan0: 0000   70.  -40.  -256        0      0      0     12      0        0
+#
+# A LinkQualitySampler reads that file on its own thread every SampleInterval seconds and
+# keeps the last Window seconds worth of samples. GetSummary() hands back the rolling
+# min/avg/max of link quality, signal level and noise, and how many retries and missed
+# beacons the window saw (those two are counters since boot, we report the increase).
+#
+# The summary is worked out on the sampling thread and swapped in whole, so GetSummary()
+# is a plain attribute read - the heartbeat never waits on the file or on us.
+#
+# GetSummary() is None when there is nothing to report (no wireless interface, or not
+# running on Linux at all), which is what a wired controller sends.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import threading
+import time
+
+
+# Drivers that can't measure noise report this instead
+_NOISE_NOT_AVAILABLE = -256
+
+
+_sharedSamplers = {}
+_sharedSamplersLock = threading.Lock()
+
+
+# One sampler (and one thread) per file and interface, however many puzzle IDs the process is hosting
+def GetSharedSampler(Path = '/proc/net/wireless', Interface = None):
+
+  samplerKey = (Path, Interface)
+
+  with _sharedSamplersLock:
+    if samplerKey not in _sharedSamplers:
+      _sharedSamplers[samplerKey] = LinkQualitySampler(Path, Interface)
+    #end if
+
+    return _sharedSamplers[samplerKey]
+  #end with
+
+#end def (GetSharedSampler)
+
+
+# Returns {interface: (link, level, noise, retries, missedBeacons)}, empty if there is no such file
+def ReadWirelessFile(path):
+
+  interfaces = {}
+
+  try:
+    with open(path, 'r') as f:
+      lines = f.readlines()
+    #end with
+
+  except OSError:
+    return interfaces
+  #end try
+
+  # The first two lines are the column headings
+  for line in lines[2:]:
+    if ':' not in line:
+      continue
+    #end if
+
+    interfaceName, fields = line.split(':', 1)
+    fields = fields.split()
+
+    if len(fields) < 10:
+      continue
+    #end if
+
+    try:
+      # Quality values may have a trailing '.' (or '*'), depending on the driver
+      link, level, noise = [float(field.rstrip('.*')) for field in fields[1:4]]
+      retries = int(fields[7])
+      missedBeacons = int(fields[9])
+
+    except ValueError:
+      continue
+    #end try
+
+    interfaces[interfaceName.strip()] = (link, level, None if noise == _NOISE_NOT_AVAILABLE else noise, retries, missedBeacons)
+  #end for
+
+  return interfaces
+#end def (ReadWirelessFile)
+
+
+class LinkQualitySampler:
+
+  def __init__(self, Path = '/proc/net/wireless', Interface = None, SampleInterval = 5.0, Window = 60.0):
+    self.path = Path
+    self.interface = Interface   # None is whichever interface the file lists first
+
+    self.__sampleInterval = SampleInterval
+    self.__samples = collections.deque(maxlen=max(2, int(Window / SampleInterval) + 1))   # sampling thread only
+
+    self.__summary = None
+    self.__stopped = threading.Event()
+
+    self.__samplerThread = threading.Thread(target=self.__run, name='link-quality', daemon=True)
+    self.__samplerThread.start()
+  #end def
+
+
+  # The latest summary, never blocks
+  def GetSummary(self):
+    return self.__summary
+  #end def (GetSummary)
+
+
+  def Stop(self):
+    self.__stopped.set()
+  #end def (Stop)
+
+
+  # Takes one sample and rebuilds the summary, the thread calls this every SampleInterval seconds
+  def Sample(self):
+
+    interfaces = ReadWirelessFile(self.path)
+
+    interfaceName = self.interface
+
+    if (interfaceName is None) and (len(interfaces) > 0):
+      interfaceName = next(iter(interfaces))
+    #end if
+
+    if interfaceName not in interfaces:
+      self.__samples.clear()
+      self.__summary = None
+      return
+    #end if
+
+    self.__samples.append((time.monotonic(), interfaceName) + interfaces[interfaceName])
+    self.__summary = self.__summarize(interfaceName)
+  #end def (Sample)
+
+
+  def __run(self):
+
+    while True:
+      try:
+        self.Sample()
+      except Exception:
+        self.__summary = None   # a sampler that fell over mustn't keep reporting a link that looked fine
+      #end try
+
+      if self.__stopped.wait(self.__sampleInterval) is True:
+        return
+      #end if
+    #end while
+
+  #end def (__run)
+
+
+  def __summarize(self, interfaceName):
+
+    # Only the samples from this interface, in case it changed under us
+    samples = [sample for sample in self.__samples if sample[1] == interfaceName]
+
+    summary = {}
+    summary['interface']     = interfaceName
+    summary['samples']       = len(samples)
+    summary['window']        = round(samples[-1][0] - samples[0][0], 1)
+    summary['link']          = self.__rollingStats([sample[2] for sample in samples])
+    summary['signal']        = self.__rollingStats([sample[3] for sample in samples])
+    summary['noise']         = self.__rollingStats([sample[4] for sample in samples if sample[4] is not None])
+    summary['retries']       = max(0, samples[-1][5] - samples[0][5])   # a driver reload starts the counters over
+    summary['missedBeacons'] = max(0, samples[-1][6] - samples[0][6])
+
+    return summary
+  #end def (__summarize)
+
+
+  def __rollingStats(self, values):
+
+    if len(values) == 0:
+      return None
+    #end if
+
+    return {'min': min(values), 'avg': round(sum(values) / len(values), 1), 'max': max(values)}
+  #end def (__rollingStats)
+
+#end class
@@ -0,0 +1,450 @@
+#!/usr/bin/python3
+
+# In-Process Message Bus
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Puzzles hosted in the same process (the Mad Scientist multi controller runs six) used to
+# reach each other through the broker, a POPI event from one to the next went out over TCP
+# to mosquitto and straight back in again.
+#
+# A LocalBus carries those messages in-process instead. It is the transport underneath
+# ControllerCommunications in one of two ways:
+#
+#  - bridged (Bus = bus, with a broker): everything we publish is handed to the subscribers
+#    in this process straight away, broker or no broker, and still goes out to the broker for
+#    everyone else. The broker's copy of something a local subscriber already had is
+#    recognised (IsEcho()) and dropped, so nothing runs twice.
+#
+#      hub  = ControllerCommunicationsHub('multi', 'ms-roomcontroller.local', Bus = local_bus.GetSharedBus())
+#
+#  - broker-free (Bus = bus, mqttBroker None): CreateClient() hands out a LocalClient that
+#    looks enough like a paho client for ControllerCommunications (and the hub) to run on
+#    without a broker at all, for tests and benchmarks (see bench_local_bus.py).
+#
+#      bus   = local_bus.LocalBus()
+#      fuel  = ControllerCommunications('fuel', None, Bus = bus)
+#      probe = bus.CreateClient()
+#
+# Subscribers are called on the publisher's thread, in the order they subscribed. The bus
+# keeps retained messages for its broker-free subscribers, bridged ones get those from
+# the broker. There are no last wills, a crash takes the whole bus with it.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import itertools
+import threading
+import time
+import paho.mqtt.client as mqtt
+
+from topic_router import TopicRouter
+
+
+_sharedBus = None
+_sharedBusLock = threading.Lock()
+
+
+# One bus for every ControllerCommunications in the process that asks for it
+def GetSharedBus():
+
+  global _sharedBus
+
+  with _sharedBusLock:
+    if _sharedBus is None:
+      _sharedBus = LocalBus()
+    #end if
+
+    return _sharedBus
+  #end with
+
+#end def (GetSharedBus)
+
+
+# Quacks like a paho MQTTMessage as far as our handlers are concerned
+class LocalMessage:
+
+  def __init__(self, topic, payload, qos = 0, retain = False, properties = None):
+    self.topic = topic
+    self.payload = payload
+    self.qos = qos
+    self.retain = retain
+    self.properties = properties
+    self.mid = 0
+  #end def
+
+#end class
+
+
+class LocalBus:
+
+  # A broker copy turning up later than EchoTimeout seconds after we delivered it locally is treated as a new message
+  def __init__(self, EchoTimeout = 30):
+    self.__echoTimeout = EchoTimeout
+
+    self.__lock = threading.Lock()
+    self.__router = TopicRouter()
+    self.__subscriptions = collections.defaultdict(set)   # handler -> topic patterns
+    self.__bridgedHandlers = set()
+    self.__pendingEchoes = {}                             # bridged handler -> deque of (topic, payload, timestamp)
+    self.__retained = {}                                  # topic -> LocalMessage
+
+    self.__publishedCount = 0
+    self.__deliveredCount = 0
+    self.__echoCount      = 0
+  #end def
+
+
+  # handlerFunction is called as handlerFunction(message). Bridged subscribers also get the same topics from a
+  # broker, and have to check every message from there with IsEcho().
+  def Subscribe(self, topicPattern, handlerFunction, Bridged = False):
+
+    self.__router.AddRoute(topicPattern, handlerFunction)
+
+    with self.__lock:
+      self.__subscriptions[handlerFunction].add(topicPattern)
+
+      if Bridged is True:
+        self.__bridgedHandlers.add(handlerFunction)
+        self.__pendingEchoes.setdefault(handlerFunction, collections.deque(maxlen=64))
+        return
+      #end if
+
+      retainedMessages = [message for topic, message in self.__retained.items() if mqtt.topic_matches_sub(topicPattern, topic)]
+    #end with
+
+    for message in retainedMessages:
+      handlerFunction(message)
+    #end for
+
+  #end def (Subscribe)
+
+
+  def Unsubscribe(self, topicPattern, handlerFunction):
+
+    self.__router.RemoveRoute(topicPattern, handlerFunction)
+
+    with self.__lock:
+      topicPatterns = self.__subscriptions.get(handlerFunction, set())
+      topicPatterns.discard(topicPattern)
+
+      if len(topicPatterns) == 0:
+        self.__forget(handlerFunction)
+      #end if
+    #end with
+
+  #end def (Unsubscribe)
+
+
+  def UnsubscribeAll(self, handlerFunction):
+
+    with self.__lock:
+      topicPatterns = list(self.__subscriptions.get(handlerFunction, []))
+      self.__forget(handlerFunction)
+    #end with
+
+    for topicPattern in topicPatterns:
+      self.__router.RemoveRoute(topicPattern, handlerFunction)
+    #end for
+
+  #end def (UnsubscribeAll)
+
+
+  # Hands the message to every matching subscriber, returns how many there were
+  def Publish(self, topic, payload, qos = 0, retain = False, properties = None):
+
+    message = LocalMessage(topic, self.__toBytes(payload), qos, False, properties)
+    handlerFunctions = self.__router.GetHandlers(topic)
+    timestampNow = time.monotonic()
+
+    with self.__lock:
+      self.__publishedCount += 1
+      self.__deliveredCount += len(handlerFunctions)
+
+      if retain is True:
+        if len(message.payload) == 0:
+          self.__retained.pop(topic, None)
+        else:
+          self.__retained[topic] = LocalMessage(topic, message.payload, qos, True, properties)
+        #end if
+      #end if
+
+      for handlerFunction in handlerFunctions:
+        if handlerFunction in self.__bridgedHandlers:
+          self.__pendingEchoes[handlerFunction].append((topic, message.payload, timestampNow))
+        #end if
+      #end for
+    #end with
+
+    for handlerFunction in handlerFunctions:
+      handlerFunction(message)
+    #end for
+
+    return len(handlerFunctions)
+  #end def (Publish)
+
+
+  # True if a message from the broker is its copy of one we already handed to this (bridged) subscriber
+  def IsEcho(self, handlerFunction, message):
+
+    # A retained message is the broker catching us up on a subscribe, never a copy of something we just sent
+    if isinstance(message, LocalMessage) or (message.retain is True):
+      return False
+    #end if
+
+    with self.__lock:
+      pendingEchoes = self.__pendingEchoes.get(handlerFunction)
+
+      if not pendingEchoes:
+        return False
+      #end if
+
+      oldestValid = time.monotonic() - self.__echoTimeout
+
+      while (len(pendingEchoes) > 0) and (pendingEchoes[0][2] < oldestValid):
+        pendingEchoes.popleft()
+      #end while
+
+      for index, (topic, payload, timestamp) in enumerate(pendingEchoes):
+        if (topic == message.topic) and (payload == message.payload):
+          del pendingEchoes[index]
+          self.__echoCount += 1
+          return True
+        #end if
+      #end for
+
+      return False
+    #end with
+
+  #end def (IsEcho)
+
+
+  def CreateClient(self):
+    return LocalClient(self)
+  #end def (CreateClient)
+
+
+  def GetMetrics(self):
+    with self.__lock:
+      metrics = {}
+      metrics['published']     = self.__publishedCount
+      metrics['delivered']     = self.__deliveredCount
+      metrics['echoesDropped'] = self.__echoCount
+      metrics['subscribers']   = len(self.__subscriptions)
+      return metrics
+    #end with
+  #end def (GetMetrics)
+
+
+  # Must be called with the lock held
+  def __forget(self, handlerFunction):
+    self.__subscriptions.pop(handlerFunction, None)
+    self.__bridgedHandlers.discard(handlerFunction)
+    self.__pendingEchoes.pop(handlerFunction, None)
+  #end def (__forget)
+
+
+  # The same conversions paho makes before a payload goes on the wire
+  def __toBytes(self, payload):
+
+    if payload is None:
+      return b''
+    #end if
+
+    if isinstance(payload, str):
+      return payload.encode('utf-8')
+    #end if
+
+    if isinstance(payload, (int, float)):
+      return str(payload).encode('ascii')
+    #end if
+
+    return bytes(payload)
+  #end def (__toBytes)
+
+#end class
+
+
+class LocalPublishInfo:
+
+  def __init__(self, mid, rc):
+    self.mid = mid
+    self.rc = rc
+  #end def
+
+#end class
+
+
+# The part of paho's Client that ControllerCommunications and ControllerCommunicationsHub use, on top of a
+# LocalBus. Connecting always works and happens on the spot, there is no network thread.
+class LocalClient:
+
+  def __init__(self, localBus):
+    self.__bus = localBus
+    self.__connected = False
+    self.__connectPending = False
+    self.__subscriptions = set()
+    self.__messageIDs = itertools.count(1)
+
+    self.will = None   # kept for anyone curious, it never fires
+
+    self.on_connect      = None
+    self.on_disconnect   = None
+    self.on_message      = None
+    self.on_publish      = None
+    self.on_connect_fail = None
+  #end def
+
+
+  def will_set(self, topic, payload = None, qos = 0, retain = False, properties = None):
+    self.will = (topic, payload, qos, retain)
+  #end def (will_set)
+
+
+  def reconnect_delay_set(self, min_delay = 1, max_delay = 120):
+    pass
+  #end def (reconnect_delay_set)
+
+
+  def connect(self, host = None, port = 1883, keepalive = 60, *connectArgs, **connectKeywords):
+    self.__connect()
+    return mqtt.MQTT_ERR_SUCCESS
+  #end def (connect)
+
+
+  # Like paho, nothing happens until loop_start()
+  def connect_async(self, host = None, port = 1883, keepalive = 60, *connectArgs, **connectKeywords):
+    self.__connectPending = True
+  #end def (connect_async)
+
+
+  def loop_start(self):
+
+    if self.__connectPending is True:
+      self.__connectPending = False
+      self.__connect()
+    #end if
+
+    return mqtt.MQTT_ERR_SUCCESS
+  #end def (loop_start)
+
+
+  def loop_stop(self, force = False):
+    return mqtt.MQTT_ERR_SUCCESS
+  #end def (loop_stop)
+
+
+  def disconnect(self, reasoncode = None, properties = None):
+
+    if self.__connected is False:
+      return mqtt.MQTT_ERR_NO_CONN
+    #end if
+
+    self.__connected = False
+
+    # Clean session, whatever we subscribed to goes with the connection
+    for topicPattern in list(self.__subscriptions):
+      self.__bus.Unsubscribe(topicPattern, self.__deliver)
+    #end for
+
+    self.__subscriptions = set()
+
+    if self.on_disconnect is not None:
+      self.on_disconnect(self, None, mqtt.MQTT_ERR_SUCCESS)
+    #end if
+
+    return mqtt.MQTT_ERR_SUCCESS
+  #end def (disconnect)
+
+
+  def is_connected(self):
+    return self.__connected
+  #end def (is_connected)
+
+
+  def subscribe(self, topic, qos = 0, options = None, properties = None):
+
+    if self.__connected is False:
+      return (mqtt.MQTT_ERR_NO_CONN, None)
+    #end if
+
+    if topic not in self.__subscriptions:
+      self.__subscriptions.add(topic)
+      self.__bus.Subscribe(topic, self.__deliver)
+    #end if
+
+    return (mqtt.MQTT_ERR_SUCCESS, next(self.__messageIDs))
+  #end def (subscribe)
+
+
+  def unsubscribe(self, topic, properties = None):
+
+    topicPatterns = [topic] if isinstance(topic, str) else topic
+
+    for topicPattern in topicPatterns:
+      if topicPattern in self.__subscriptions:
+        self.__subscriptions.discard(topicPattern)
+        self.__bus.Unsubscribe(topicPattern, self.__deliver)
+      #end if
+    #end for
+
+    return (mqtt.MQTT_ERR_SUCCESS, next(self.__messageIDs))
+  #end def (unsubscribe)
+
+
+  def publish(self, topic, payload = None, qos = 0, retain = False, properties = None):
+
+    messageID = next(self.__messageIDs)
+
+    if self.__connected is False:
+      return LocalPublishInfo(messageID, mqtt.MQTT_ERR_NO_CONN)
+    #end if
+
+    self.__bus.Publish(topic, payload, qos, retain, properties)
+
+    if self.on_publish is not None:
+      self.on_publish(self, None, messageID)
+    #end if
+
+    return LocalPublishInfo(messageID, mqtt.MQTT_ERR_SUCCESS)
+  #end def (publish)
+
+
+  def __connect(self):
+
+    if self.__connected is True:
+      return
+    #end if
+
+    self.__connected = True
+
+    if self.on_connect is not None:
+      self.on_connect(self, None, {}, 0)
+    #end if
+
+  #end def (__connect)
+
+
+  def __deliver(self, message):
+
+    if (self.__connected is True) and (self.on_message is not None):
+      self.on_message(self, None, message)
+    #end if
+
+  #end def (__deliver)
+
+#end class
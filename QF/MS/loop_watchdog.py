@@ -0,0 +1,621 @@
+#!/usr/bin/python3
+
+# Event Loop Lag Monitor and systemd Watchdog
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Restart=always brings a controller back after it crashes, but nothing notices one that
+# hangs: a wedged NFC read or a callback stuck in time.sleep() leaves the process running,
+# connected even (paho keeps the keepalives going on its own thread), and doing nothing.
+#
+# A LoopWatchdog keeps an eye on the threads that do the work:
+#
+#  - main loops call Tick() once per pass (ControllerCommunications, the hub and the media
+#    controller do it in ProcessEvents()), and the time between passes goes into a histogram
+#
+#  - probes check the threads we hand work to. Every ProbeInterval seconds the watchdog
+#    thread hands a probe a no-op to run on its thread (the timer wheel, an asyncio event
+#    loop), and how long it took to get run goes into a histogram of its own:
+#
+#      watchdog.AddProbe('timers', lambda probeDone: wheel.Schedule(0, probeDone))
+#
+#  - gauges check work that is queued up per puzzle, where a no-op of our own would only show
+#    how busy the other puzzles are. Every ProbeInterval seconds the watchdog asks the gauge how
+#    old the oldest piece of work is, and that goes into the histogram:
+#
+#      watchdog.AddGauge('callbacks', executor.GetOldestWork, Threshold = executor.timeout)
+#
+# A loop that hasn't ticked, or a probe that hasn't run, for Threshold seconds is stalled, and so
+# is a gauge whose oldest work is older than its own threshold. The first time it happens the
+# stalled thread's stack is logged (where there is one), so the log says where it is stuck.
+#
+# Under systemd with WatchdogSec= set (and Type=notify, see media.service) the watchdog thread
+# sends WATCHDOG=1 every WatchdogSec/2 seconds, but only while nothing is stalled. A stalled
+# controller stops pinging, and systemd restarts it. Without systemd there is nothing to ping
+# and the watchdog only measures. NotifyReady() tells systemd we are up (Type=notify waits for it).
+#
+# Every heartbeat carries GetSummary(), the largest lag seen and whether anything is stalled
+# right now. The whole of GetMetrics() (per loop and probe the percentiles and the largest lag,
+# the histogram's bucket counts, and how many times it stalled) is the same for every puzzle in
+# the process, so it goes out once per process every REPORT_INTERVAL seconds instead: whoever
+# asks TakeReport() first when one is due gets it (the hub as a LOOPLAG hub event, a controller
+# of its own or the media controller on <prefix>/<ID>/LOOPLAG).
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import bisect
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import queued_log
+
+
+# Upper limits of the histogram's buckets in milliseconds, anything past the last one goes in one more bucket
+BUCKET_LIMITS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# Seconds between the full reports, see TakeReport()
+REPORT_INTERVAL = 60
+
+
+_sharedWatchdog = None
+_sharedWatchdogLock = threading.Lock()
+
+def GetSharedWatchdog():
+
+  global _sharedWatchdog
+
+  with _sharedWatchdogLock:
+    if _sharedWatchdog is None:
+      _sharedWatchdog = LoopWatchdog()
+    #end if
+  #end with
+
+  return _sharedWatchdog
+#end def (GetSharedWatchdog)
+
+
+# A forked child (see puzzle_supervisor.py) gets a copy of the parent's watchdog without its thread, it starts one of its own
+def _forgetSharedWatchdog():
+
+  global _sharedWatchdog, _sharedWatchdogLock
+
+  _sharedWatchdog = None
+  _sharedWatchdogLock = threading.Lock()
+#end def (_forgetSharedWatchdog)
+
+# Python 3.7 and up
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_forgetSharedWatchdog)
+#end if
+
+
+def NotifyReady():
+  GetSharedWatchdog().NotifyReady()
+#end def (NotifyReady)
+
+
+# Where systemd wants to hear from us, None when it doesn't (or when it is listening for another process, a fork of ours say)
+def _getNotifySocket():
+
+  notifySocket = os.environ.get('NOTIFY_SOCKET')
+
+  if (notifySocket is None) or (len(notifySocket) == 0):
+    return None
+  #end if
+
+  if os.environ.get('WATCHDOG_PID', str(os.getpid())) != str(os.getpid()):
+    return None
+  #end if
+
+  # An abstract socket
+  if notifySocket.startswith('@'):
+    notifySocket = '\0' + notifySocket[1:]
+  #end if
+
+  return notifySocket
+#end def (_getNotifySocket)
+
+
+# Half of WatchdogSec=, as systemd recommends, None without it
+def _getWatchdogInterval():
+
+  try:
+    return int(os.environ['WATCHDOG_USEC']) / 2000000.0
+  except (KeyError, ValueError):
+    return None
+  #end try
+
+#end def (_getWatchdogInterval)
+
+
+class LagHistogram:
+
+  def __init__(self):
+    self.__counts = [0] * (len(BUCKET_LIMITS_MS) + 1)
+    self.__maxSeconds = 0.0
+  #end def
+
+
+  def Record(self, seconds):
+    self.__counts[bisect.bisect_left(BUCKET_LIMITS_MS, seconds * 1000)] += 1
+
+    if seconds > self.__maxSeconds:
+      self.__maxSeconds = seconds
+    #end if
+
+  #end def (Record)
+
+
+  def GetMaxMs(self):
+    return round(self.__maxSeconds * 1000, 1)
+  #end def (GetMaxMs)
+
+
+  def GetMetrics(self):
+
+    counts = list(self.__counts)
+    count = sum(counts)
+
+    metrics = {}
+    metrics['count']   = count
+    metrics['maxMs']   = round(self.__maxSeconds * 1000, 1)
+    metrics['buckets'] = counts
+
+    if count > 0:
+      metrics['p50Ms'] = self.__percentile(counts, count, 50)
+      metrics['p99Ms'] = self.__percentile(counts, count, 99)
+    #end if
+
+    return metrics
+  #end def (GetMetrics)
+
+
+  # Nearest rank, as the upper limit of the bucket it falls in (or the largest lag seen, past the last one)
+  def __percentile(self, counts, count, percentile):
+
+    rank = max(1, -(-percentile * count // 100))
+    seen = 0
+
+    for bucketIndex, bucketCount in enumerate(counts):
+      seen += bucketCount
+
+      if seen >= rank:
+        break
+      #end if
+    #end for
+
+    if bucketIndex < len(BUCKET_LIMITS_MS):
+      return min(BUCKET_LIMITS_MS[bucketIndex], round(self.__maxSeconds * 1000, 1))
+    #end if
+
+    return round(self.__maxSeconds * 1000, 1)
+  #end def (__percentile)
+
+#end class
+
+
+class _MonitoredLoop:
+
+  def __init__(self, threadIdent, timestampTick):
+    self.threadIdent = threadIdent
+    self.timestampTick = timestampTick
+    self.histogram = LagHistogram()
+    self.stalled = False
+    self.stallCount = 0
+  #end def
+
+#end class
+
+
+class _Probe:
+
+  def __init__(self, submitFunction):
+    self.submitFunction = submitFunction
+    self.timestampSent = None   # while a probe is waiting to be run
+    self.timestampLastSent = 0.0
+    self.histogram = LagHistogram()
+    self.stalled = False
+    self.stallCount = 0
+  #end def
+
+#end class
+
+
+class _Gauge:
+
+  def __init__(self, gaugeFunction, threshold):
+    self.gaugeFunction = gaugeFunction
+    self.threshold = threshold
+    self.age = None             # how old the oldest work was when we last looked, None when there was none
+    self.threadIdent = None
+    self.timestampSampled = 0.0
+    self.histogram = LagHistogram()
+    self.stalled = False
+    self.stallCount = 0
+  #end def
+
+#end class
+
+
+class LoopWatchdog:
+
+  def __init__(self, Threshold = 5.0, ProbeInterval = 1.0, NotifySocket = None, WatchdogInterval = None):
+    self.threshold = Threshold
+
+    self.__probeInterval = ProbeInterval
+
+    self.__notifySocket = NotifySocket if NotifySocket is not None else _getNotifySocket()
+    self.__watchdogInterval = WatchdogInterval if WatchdogInterval is not None else _getWatchdogInterval()
+
+    # Nobody to ping
+    if self.__notifySocket is None:
+      self.__watchdogInterval = None
+    #end if
+
+    self.__lock = threading.Lock()
+
+    self.__loops = {}    # loop name -> _MonitoredLoop
+    self.__probes = {}   # probe name -> _Probe
+    self.__gauges = {}   # gauge name -> _Gauge
+
+    self.__pingsSent = 0
+    self.__pingsWithheld = 0
+    self.__timestampLastPing = 0.0
+    self.__timestampLastWithheld = 0.0
+    self.__timestampLastReport = None
+
+    self.__watchdogThread = threading.Thread(target=self.__run, name='loop-watchdog', daemon=True)
+    self.__watchdogThread.start()
+  #end def
+
+
+  # Once per pass of a main loop, from that loop's thread. No lock, only this thread ever writes to its loop.
+  def Tick(self, LoopName = 'main'):
+
+    timestampNow = time.monotonic()
+
+    monitoredLoop = self.__loops.get(LoopName)
+
+    if monitoredLoop is None:
+      with self.__lock:
+        self.__loops[LoopName] = _MonitoredLoop(threading.get_ident(), timestampNow)
+      #end with
+
+      return
+    #end if
+
+    monitoredLoop.histogram.Record(timestampNow - monitoredLoop.timestampTick)
+    monitoredLoop.timestampTick = timestampNow
+
+  #end def (Tick)
+
+
+  # submitFunction(probeDone) has to arrange for probeDone() to be called on the thread being watched.
+  # A probe that is already there is left as it is.
+  def AddProbe(self, probeName, submitFunction):
+
+    with self.__lock:
+      if probeName not in self.__probes:
+        self.__probes[probeName] = _Probe(submitFunction)
+      #end if
+    #end with
+
+  #end def (AddProbe)
+
+
+  # gaugeFunction() returns (seconds, thread ident or None) for the oldest work it is waiting on, or None when
+  # there isn't any. Threshold defaults to ours. A gauge that is already there is left as it is.
+  def AddGauge(self, gaugeName, gaugeFunction, Threshold = None):
+
+    with self.__lock:
+      if gaugeName not in self.__gauges:
+        self.__gauges[gaugeName] = _Gauge(gaugeFunction, Threshold if Threshold is not None else self.threshold)
+      #end if
+    #end with
+
+  #end def (AddGauge)
+
+
+  # Type=notify units wait for this before they count as started
+  def NotifyReady(self):
+    self.__notify('READY=1')
+  #end def (NotifyReady)
+
+
+  def IsHealthy(self):
+
+    with self.__lock:
+      return self.__checkStalls(time.monotonic()) == []
+    #end with
+
+  #end def (IsHealthy)
+
+
+  def GetMetrics(self):
+
+    timestampNow = time.monotonic()
+
+    metrics = {}
+    metrics['thresholdMs'] = round(self.threshold * 1000)
+
+    with self.__lock:
+      for loopName, monitoredLoop in self.__loops.items():
+        loopMetrics = monitoredLoop.histogram.GetMetrics()
+        loopMetrics['sinceTickMs'] = round((timestampNow - monitoredLoop.timestampTick) * 1000, 1)
+        loopMetrics['stalls'] = monitoredLoop.stallCount
+
+        metrics[loopName] = loopMetrics
+      #end for
+
+      for probeName, probe in self.__probes.items():
+        probeMetrics = probe.histogram.GetMetrics()
+        probeMetrics['stalls'] = probe.stallCount
+
+        metrics[probeName] = probeMetrics
+      #end for
+
+      for gaugeName, gauge in self.__gauges.items():
+        gaugeMetrics = gauge.histogram.GetMetrics()
+        gaugeMetrics['stalls'] = gauge.stallCount
+
+        metrics[gaugeName] = gaugeMetrics
+      #end for
+
+      if self.__watchdogInterval is not None:
+        metrics['watchdog'] = {'intervalMs': round(self.__watchdogInterval * 1000), 'pings': self.__pingsSent, 'withheld': self.__pingsWithheld}
+      #end if
+    #end with
+
+    return metrics
+  #end def (GetMetrics)
+
+
+  # What every heartbeat carries
+  def GetSummary(self):
+
+    with self.__lock:
+      watchedList = list(self.__loops.values()) + list(self.__probes.values()) + list(self.__gauges.values())
+      maxLag = max([watched.histogram.GetMaxMs() for watched in watchedList], default = 0)
+      stalled = len(self.__checkStalls(time.monotonic())) > 0
+    #end with
+
+    return {'maxLagMs': maxLag, 'stalled': stalled}
+  #end def (GetSummary)
+
+
+  # GetMetrics() when a full report is due (the first call, then every Interval seconds), None otherwise.
+  # Only one caller in the process gets each report, so it goes out once however many puzzles we host.
+  def TakeReport(self, Interval = REPORT_INTERVAL):
+
+    timestampNow = time.monotonic()
+
+    with self.__lock:
+      if (self.__timestampLastReport is not None) and (timestampNow - self.__timestampLastReport < Interval):
+        return None
+      #end if
+
+      self.__timestampLastReport = timestampNow
+    #end with
+
+    return self.GetMetrics()
+  #end def (TakeReport)
+
+
+  def __run(self):
+
+    while True:
+      if self.__watchdogInterval is not None:
+        time.sleep(min(self.__probeInterval, self.__watchdogInterval))
+      else:
+        time.sleep(self.__probeInterval)
+      #end if
+
+      try:
+        self.__sendProbes()
+        self.__sampleGauges()
+        self.__checkHealth()
+      except Exception:
+        queued_log.Error('>> Loop watchdog raised an exception:\n{}', traceback.format_exc().rstrip())
+      #end try
+    #end while
+
+  #end def (__run)
+
+
+  def __sendProbes(self):
+
+    timestampNow = time.monotonic()
+    sending = []
+
+    with self.__lock:
+      for probeName, probe in self.__probes.items():
+        if (probe.timestampSent is None) and (timestampNow - probe.timestampLastSent >= self.__probeInterval):
+          probe.timestampSent = timestampNow
+          probe.timestampLastSent = timestampNow
+          sending.append((probeName, probe))
+        #end if
+      #end for
+    #end with
+
+    for probeName, probe in sending:
+      probe.submitFunction(lambda probe = probe: self.__handlerProbeDone(probe))
+    #end for
+
+  #end def (__sendProbes)
+
+
+  # The gauges are asked without our lock held, they have locks of their own
+  def __sampleGauges(self):
+
+    with self.__lock:
+      gauges = list(self.__gauges.values())
+    #end with
+
+    for gauge in gauges:
+      oldestWork = gauge.gaugeFunction()
+
+      with self.__lock:
+        gauge.timestampSampled = time.monotonic()
+
+        if oldestWork is None:
+          gauge.age, gauge.threadIdent = None, None
+        else:
+          gauge.age, gauge.threadIdent = oldestWork
+          gauge.histogram.Record(gauge.age)
+        #end if
+      #end with
+    #end for
+
+  #end def (__sampleGauges)
+
+
+  def __handlerProbeDone(self, probe):
+
+    with self.__lock:
+      probe.histogram.Record(time.monotonic() - probe.timestampSent)
+      probe.timestampSent = None
+    #end with
+
+  #end def (__handlerProbeDone)
+
+
+  # Must be called with the lock held. Returns (name, stalled for, thread ident or None) for everything stalled right now.
+  def __checkStalls(self, timestampNow):
+
+    stalls = []
+
+    for loopName, monitoredLoop in self.__loops.items():
+      if timestampNow - monitoredLoop.timestampTick > self.threshold:
+        stalls.append((loopName, monitoredLoop, timestampNow - monitoredLoop.timestampTick, monitoredLoop.threadIdent))
+      #end if
+    #end for
+
+    for probeName, probe in self.__probes.items():
+      if (probe.timestampSent is not None) and (timestampNow - probe.timestampSent > self.threshold):
+        stalls.append((probeName, probe, timestampNow - probe.timestampSent, None))
+      #end if
+    #end for
+
+    for gaugeName, gauge in self.__gauges.items():
+      if (gauge.age is not None) and (gauge.age + (timestampNow - gauge.timestampSampled) > gauge.threshold):
+        stalls.append((gaugeName, gauge, gauge.age + (timestampNow - gauge.timestampSampled), gauge.threadIdent))
+      #end if
+    #end for
+
+    return stalls
+  #end def (__checkStalls)
+
+
+  def __checkHealth(self):
+
+    timestampNow = time.monotonic()
+
+    with self.__lock:
+      stalls = self.__checkStalls(timestampNow)
+      stalledNow = {id(watched) for stallName, watched, stalledFor, threadIdent in stalls}
+
+      newStalls = []
+
+      for stallName, watched, stalledFor, threadIdent in stalls:
+        if watched.stalled is False:
+          watched.stalled = True
+          watched.stallCount += 1
+          newStalls.append((stallName, stalledFor, threadIdent))
+        #end if
+      #end for
+
+      recovered = []
+
+      for watchedName, watched in list(self.__loops.items()) + list(self.__probes.items()) + list(self.__gauges.items()):
+        if (watched.stalled is True) and (id(watched) not in stalledNow):
+          watched.stalled = False
+          recovered.append(watchedName)
+        #end if
+      #end for
+
+      pingDue = (self.__watchdogInterval is not None) and (timestampNow - self.__timestampLastPing >= self.__watchdogInterval * 0.9)
+
+      if (pingDue is True) and (len(stalls) > 0):
+        pingDue = False
+
+        # Counted once per ping we would have sent, not once per check
+        if timestampNow - self.__timestampLastWithheld >= self.__watchdogInterval * 0.9:
+          self.__timestampLastWithheld = timestampNow
+          self.__pingsWithheld += 1
+        #end if
+      #end if
+    #end with
+
+    for stallName, stalledFor, threadIdent in newStalls:
+      queued_log.Warning('>> [{}] has been stalled for {:.1f} seconds{}:\n{}', stallName, stalledFor,
+                         ', holding back the systemd watchdog' if self.__watchdogInterval is not None else '', self.__formatStack(threadIdent))
+    #end for
+
+    for watchedName in recovered:
+      queued_log.Info('>> [{}] is moving again', watchedName)
+    #end for
+
+    if pingDue is True:
+      self.__timestampLastPing = timestampNow
+
+      if self.__notify('WATCHDOG=1') is True:
+        with self.__lock:
+          self.__pingsSent += 1
+        #end with
+      #end if
+    #end if
+
+  #end def (__checkHealth)
+
+
+  # Where the stalled thread is right now
+  def __formatStack(self, threadIdent):
+
+    stackFrame = sys._current_frames().get(threadIdent) if threadIdent is not None else None
+
+    if stackFrame is None:
+      return '  (no stack for it)'
+    #end if
+
+    return ''.join(traceback.format_stack(stackFrame)).rstrip()
+  #end def (__formatStack)
+
+
+  def __notify(self, message):
+
+    if self.__notifySocket is None:
+      return False
+    #end if
+
+    try:
+      with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notifySocket:
+        notifySocket.sendto(message.encode('utf-8'), self.__notifySocket)
+      #end with
+
+    except OSError as notifyError:
+      queued_log.Warning('>> Unable to notify systemd [{}]: {}', message, notifyError)
+      return False
+    #end try
+
+    return True
+  #end def (__notify)
+
+#end class
@@ -35,27 +35,35 @@
 #  $> sudo pip3 install paho-mqtt
 
 
-import paho.mqtt.client as mqtt
-import json
+import os
 import time
 import socket
 import uuid
 import re
 import math
 import sys
+import threading
+
+import wire_format
+import mqtt_v5
+import link_quality
+import loop_watchdog
+import queued_log
+from reconnect_backoff import ReconnectBackoff
+from heartbeat_schedule import HeartbeatSchedule
 
 __version__  = '0.9'
 
-print('\r\n----------------------------------------------------------------')
-print('Media Controller <-> Room Controller Communications Class v{}'.format(__version__))
-print('Room Control and Puzzle Coordination System (RCPCS)')
-print('(c)2019 Joel Caturia <jcaturia@katratech.com>')
-print('----------------------------------------------------------------\r\n')
+queued_log.Info('\r\n----------------------------------------------------------------')
+queued_log.Info('Media Controller <-> Room Controller Communications Class v{}', __version__)
+queued_log.Info('Room Control and Puzzle Coordination System (RCPCS)')
+queued_log.Info('(c)2019 Joel Caturia <jcaturia@katratech.com>')
+queued_log.Info('----------------------------------------------------------------\r\n')
 
 
 class ControllerCommunications:
 
-  def __init__(self, mediaID, mqttBroker, mqttPort = 1883):
+  def __init__(self, mediaID, mqttBroker, mqttPort = 1883, MQTTv5 = False, RetainState = False):
     self.mqttBroker = mqttBroker
     self.mqttPort = mqttPort
     self.mediaID = mediaID
@@ -64,51 +72,130 @@ class ControllerCommunications:
     self.__puzzleState = 'ONLINE'
 
     self.__pingDelay = 3
+    self.__heartbeatSchedule = None
     self.__timestampLastPing = time.time()
     self.__callbacks = {}
     self.__MQTTConnected = False
+    self.__wireFormat = 'json'
+
+    # Only with MQTTv5 = True, and it falls back to 3.1.1 by itself (see mqtt_v5.py)
+    self.__mqttSession = mqtt_v5.MQTTv5Session() if MQTTv5 is True else None
+    self.__correlation = threading.local()
+
+    # The broker keeps our last state (or our last will) for a room controller that subscribes later on
+    self.__retainState = RetainState
+
+    # Every controller in the room loses the broker at the same time, so they must not all come back at the same time
+    self.__reconnectBackoff = ReconnectBackoff()
+
+    # Wi-Fi signal, noise and retries for the heartbeat, sampled on a thread of its own (see link_quality.py)
+    self.__linkQuality = link_quality.GetSharedSampler()
 
+    # Main loop lag for the heartbeat, and the systemd watchdog (see loop_watchdog.py and media.service)
+    self.__loopWatchdog = loop_watchdog.GetSharedWatchdog()
     
     
-    def handlerMQTTonConnect(client, userdata, flags, rc):
-      print('>> Media Controller ID [{}] successfully connected to MQTT Broker [{}:{}]..'.format(self.mediaID, self.mqttBroker, self.mqttPort) )
+    def handlerMQTTonConnect(client, userdata, flags, rc, properties = None):
+
+      if rc != 0:
+        self.__reconnectBackoff.OnConnectFailed(mqtt_v5.ConnackString(rc))
+
+        if mqtt_v5.IsProtocolRefused(rc):
+          mqtt_v5.FallBackToMQTTv311(self.mqttClient)
+          self.__mqttSession.Disable()
+          queued_log.Warning('>> MQTT broker does not support MQTT v5, falling back to 3.1.1..')
+        #end if
+
+        queued_log.Warning('>> MQTT broker refused the connection [{}], next attempt in {:.1f} seconds..', mqtt_v5.ConnackString(rc), scheduleReconnect())
+        return
+      #end if
+
+      queued_log.Info('>> Media Controller ID [{}] successfully connected to MQTT Broker [{}:{}]..', self.mediaID, self.mqttBroker, self.mqttPort)
       
       self.__MQTTConnected = True
+      self.__reconnectBackoff.OnConnected()
+
+      if self.__mqttSession is not None:
+        self.__mqttSession.OnConnect(properties)
+      #end if
       
       self.mqttClient.subscribe('COMI/' + self.mediaID + '/#')	# Subscribe to Controller-Out-Media-In		
       
-      self.PublishState(self.__puzzleState)
+      # With RetainState this is our birth message (ONLINE until the media script says otherwise), it replaces a retained last will from a previous run
+      if self.__retainState is True:
+        self.__publish('CIMO/' + self.mediaID + '/STATE', self.__puzzleState, qos=1, retain=True, messageExpiry=None)
+      else:
+        self.PublishStatus(self.__puzzleState)
+      #end if
       
       self.SendPing()
     #end def (handlerMQTTonConnect)
 
 
-    def handlerMQTTonDisconnect(client, userdata, rc):
+    def handlerMQTTonDisconnect(client, userdata, rc, properties = None):
         
       self.__MQTTConnected = False
 
+      if self.__mqttSession is not None:
+        self.__mqttSession.OnDisconnect()
+      #end if
+
       if self.__puzzleState == 'REBOOTING':
         self.mqttClient.loop_stop()
-        self.__callbacks['command_reboot']()
-              
+        self.__fireCallback('command_reboot')
+
+      elif rc == 0:
+        self.__reconnectBackoff.OnDisconnected()
+
       else:
-        self.mqttClient.reconnect()
+        self.__reconnectBackoff.OnDisconnected(mqtt_v5.ErrorString(rc))
+
+        # paho's network thread reconnects by itself, after the delay we give it
+        queued_log.Warning('>> Lost MQTT broker connection, next attempt in {:.1f} seconds..', scheduleReconnect())
       #end if
     
     #end def (handlerMQTTonDisconnect)
 
+
+    def handlerMQTTonConnectFail(client, userdata):
+      self.__reconnectBackoff.OnConnectFailed('Unable to connect to MQTT broker')
+      queued_log.Warning('>> Unable to connect to MQTT broker! Next attempt in {:.1f} seconds..', scheduleReconnect())
+    #end def (handlerMQTTonConnectFail)
+
+
+    # paho's network thread does the actual reconnecting, we just tell it how long to wait before the next attempt
+    def scheduleReconnect():
+      reconnectDelay = self.__reconnectBackoff.NextDelay()
+      self.mqttClient.reconnect_delay_set(min_delay=reconnectDelay, max_delay=reconnectDelay)
+      return reconnectDelay
+    #end def (scheduleReconnect)
+
   
     def handlerMQTTonMessage(client, userdata, message):
 
+      # Whatever we publish while handling this message carries its correlation ID (v5 only)
+      self.__correlation.correlationID = mqtt_v5.GetUserProperty(message, mqtt_v5.CORRELATION_PROPERTY)
+
+      try:
+        handleMessage(message)
+      finally:
+        self.__correlation.correlationID = None
+      #end try
+
+    #end def (handlerMQTTonMessage)
+
+
+    def handleMessage(message):
+
       if ('COMMANDS' in message.topic):
             
         incomingCommand = message.payload.decode()
                     
         if incomingCommand in ['RESET', 'PONG', 'REBOOT']:
-          print(' -> Received MQTT command: [{}]'.format(incomingCommand))
+          queued_log.Info(' -> Received MQTT command: [{}]', incomingCommand)
                             
           if incomingCommand == 'RESET':
-            self.__callbacks['command_reset']()
+            self.__fireCallback('command_reset')
                                         
           elif incomingCommand == 'REBOOT':
             self.PublishStatus('REBOOTING')
@@ -117,48 +204,44 @@ class ControllerCommunications:
           #end if
 
       elif ('PONG' in message.topic):
-            self.__callbacks['pong']()
+            self.__fireCallback('pong')
+
+      elif message.topic.endswith('/FORMAT'):
+        self.SetWireFormat(message.payload.decode())
                   
       else:
-        self.mqttClient.publish('CIMO/' + self.mediaID + '/ERROR', 'Unknown COMMAND received: [{}]'.format(incomingCommand))
-        self.mqttClient.publish('CIMO/' + self.mediaID + '/STATE', self.__puzzleState)
+        self.__publish('CIMO/' + self.mediaID + '/ERROR', 'Unknown COMMAND received: [{}]'.format(incomingCommand))
+        self.__publish('CIMO/' + self.mediaID + '/STATE', self.__puzzleState)
       #end if
                                                                                                                                                                                                                                                                                         
-    #end def (handlerMQTTonMessage)
+    #end def (handleMessage)
 ## end nested defines (under __init__)
 
     
-    self.mqttClient = mqtt.Client()
+    self.mqttClient = mqtt_v5.CreateClient(MQTTv5)
 
     self.mqttClient.on_connect    = handlerMQTTonConnect
     self.mqttClient.on_disconnect = handlerMQTTonDisconnect
     self.mqttClient.on_message    = handlerMQTTonMessage
+    self.mqttClient.on_connect_fail = handlerMQTTonConnectFail
 
-    self.mqttClient.will_set('CIMO/' + self.mediaID + '/STATE', payload='UNKNOWN', qos=1)
+    self.mqttClient.will_set('CIMO/' + self.mediaID + '/STATE', payload='UNKNOWN', qos=1, retain=self.__retainState)
 
-    backOffTimer = 2
+    scheduleReconnect()
 
     while (self.__MQTTConnected == False):
       try:
-        print(">> Attempting MQTT broker connection..")
+        queued_log.Info(">> Attempting MQTT broker connection..")
         self.mqttClient.connect(self.mqttBroker, self.mqttPort, self.mqttKeepalive)
         self.mqttClient.loop_start()  
         time.sleep(1)
 
-      except:
-        print('>> Unable to connect to MQTT broker! Sleeping for {} seconds..'.format(backOffTimer) )
-        time.sleep(backOffTimer)
-        
-        # Incremement the backoff timer util we get over 30, then we just leave it there.
-        # This logic will actually ensure we spend one cycle over 30 (at 64, in fact). I am OK with this.
-        if backOffTimer == 30:
-          pass
-        elif backOffTimer > 30:
-          backOffTimer = 30
-        else:
-          backOffTimer = backOffTimer * 2
-        #end if
-        
+      except Exception as connectError:
+        self.__reconnectBackoff.OnConnectFailed(str(connectError))
+        backOffDelay = self.__reconnectBackoff.NextDelay()
+
+        queued_log.Warning('>> Unable to connect to MQTT broker! Sleeping for {:.1f} seconds..', backOffDelay)
+        time.sleep(backOffDelay)
       #end try
     #end while
         
@@ -166,6 +249,12 @@ class ControllerCommunications:
 
 
   def disconnect(self):
+
+    # A clean disconnect doesn't fire the last will, and a retained state would outlive us
+    if self.__retainState is True:
+      self.__publish('CIMO/' + self.mediaID + '/STATE', 'UNKNOWN', qos=1, retain=True, messageExpiry=None)
+    #end if
+
     self.mqttClient.disconnect()
   #end def (disconnect)  
 
@@ -174,7 +263,6 @@ class ControllerCommunications:
 
     platform = 'RCPCS v{}/Python v{}.{}.{}/{}'.format(__version__, sys.version_info[0], sys.version_info[1], sys.version_info[2], self.__getRaspberryPiVersion() )
  
-    #TODO - add wireless signal strength as well
     data = {}
     data['timestamp']    = time.time()
     data['puzzleID']     = self.mediaID
@@ -182,20 +270,58 @@ class ControllerCommunications:
     data['uptime']       = self.__getUptime()
     data['MACaddress']   = self.__getMACaddress()
     data['temperature']  = self.__getTemperature()
+    data['wireless']     = self.__linkQuality.GetSummary()
+    data['loopLag']      = self.__loopWatchdog.GetSummary()
     data['role']         = 'media'
     data['platform']     = platform
     data['currentStatus'] = 'n/a'
-    self.__puzzleState
-    json_data = json.dumps(data)
+    data['protocolVersion'] = wire_format.PROTOCOL_VERSION
+    data['heartbeatInterval'] = self.__pingDelay
+    data['wireFormats']  = wire_format.GetAvailableFormats()
+    data['connection']   = self.__reconnectBackoff.GetMetrics()
+
+    if self.__mqttSession is not None:
+      data['mqtt']       = self.__mqttSession.GetMetrics()
+    #end if
+
+    payload = wire_format.EncodePayload(data, self.__wireFormat)
     
-    self.mqttClient.publish('CIMO/PING/' + self.mediaID, json_data )
+    self.__publish('CIMO/PING/' + self.mediaID, payload, messageExpiry = self.__pingDelay * 2)
+
+    # The full loop lag report goes out on its own, once a minute (see loop_watchdog.py)
+    loopLagReport = self.__loopWatchdog.TakeReport()
+
+    if loopLagReport is not None:
+      self.__publish('CIMO/' + self.mediaID + '/LOOPLAG', wire_format.EncodePayload(loopLagReport, self.__wireFormat))
+    #end if
     
-    self.__callbacks['ping']()
+    self.__fireCallback('ping')
   
   #end def
   
 
+  # See wire_format.py, anything we can't produce is refused and we stay on what we had
+  def SetWireFormat(self, wireFormat):
+
+    if wireFormat in wire_format.GetAvailableFormats():
+      self.__wireFormat = wireFormat
+      return True
+    #end if
+
+    self.__publish('CIMO/' + self.mediaID + '/ERROR', 'Unsupported wire format requested: [{}]'.format(wireFormat))
+    return False
+  #end def (SetWireFormat)
+
+
+  # Connection statistics (see reconnect_backoff.py)
+  def GetConnectionMetrics(self):
+    return self.__reconnectBackoff.GetMetrics()
+  #end def (GetConnectionMetrics)
+
+
   def ProcessEvents(self):
+
+    self.__loopWatchdog.Tick()
   
     if time.time() - self.__timestampLastPing > self.__pingDelay:        # send a controller ping periodically
       self.__timestampLastPing = time.time()
@@ -205,12 +331,33 @@ class ControllerCommunications:
   #end def (ProcessLoop)
 
 
+  # The heartbeat interval follows our state, with a beat straight away on every state change (see heartbeat_schedule.py)
+  def EnableAdaptiveHeartbeats(self, Intervals = None):
+    self.__heartbeatSchedule = HeartbeatSchedule(Intervals, self.__pingDelay)
+    self.__pingDelay = self.__heartbeatSchedule.GetInterval(self.__puzzleState)
+  #end def (EnableAdaptiveHeartbeats)
+
+
   def PublishStatus(self, newStatus):
     if newStatus in ['RESET', 'ACTIVE', 'REBOOTING']:
       self.__puzzleState = newStatus
-      self.mqttClient.publish('CIMO/' + self.mediaID + '/STATE', self.__puzzleState, qos=1)
+
+      # ProcessEvents() sends the next heartbeat (with the new interval) on its next pass
+      if self.__heartbeatSchedule is not None:
+        self.__pingDelay = self.__heartbeatSchedule.GetInterval(newStatus)
+        self.__timestampLastPing = 0
+      #end if
+
+      self.__publish('CIMO/' + self.mediaID + '/STATE', self.__puzzleState, qos=1, retain=self.__retainState, messageExpiry = None)
     #end if
   #end def
+
+
+  # messageExpiry (seconds), topic aliases and the correlation ID only apply over MQTT v5
+  def __publish(self, topic, payload, qos = 0, retain = False, messageExpiry = 60):
+    publishProperties = mqtt_v5.BuildPublishProperties(self.__mqttSession, messageExpiry, getattr(self.__correlation, 'correlationID', None))
+    return mqtt_v5.Publish(self.mqttClient, self.__mqttSession, topic, payload, qos, retain, publishProperties)
+  #end def (__publish)
   
       
   # These are the callbacks we will support at the moment:
@@ -227,6 +374,14 @@ class ControllerCommunications:
   #end def (RegisterCallback)
 
 
+  # Callbacks are optional, and the connect handler fires 'ping' before the script has registered anything
+  def __fireCallback(self, eventName):
+    if eventName in self.__callbacks:
+      self.__callbacks[eventName]()
+    #end if
+  #end def (__fireCallback)
+
+
   def __getTemperature(self):
 
     # If we are running on anyting other than a Raspberry Pi, this file will probably not exist.
@@ -295,10 +450,15 @@ MQTTserver = 'ms-roomcontroller.local'
 MediaID    = 'media1'
 DebugFlag = True
 
+# Type=notify, systemd counts us as started from here (see media.service). Connecting to the broker can take
+# as long as the broker takes to turn up, and until we are up systemd would give up on us after TimeoutStartSec.
+loop_watchdog.NotifyReady()
+
 RoomController = ControllerCommunications(MediaID, MQTTserver)
+RoomController.EnableAdaptiveHeartbeats()
 
 def handlerRoomControllerReboot():
-  print('>> Processing a remote reboot command!')
+  queued_log.Info('>> Processing a remote reboot command!')
   os.system('sudo reboot')
 #end def
 
@@ -329,7 +489,7 @@ try:
   
 except (KeyboardInterrupt, SystemExit):
 
-  print("\r\nExiting..")
+  queued_log.Info("\r\nExiting..")
   quit()
 
 except:
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+
+# Optional MQTT v5 Support
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Controllers speak MQTT 3.1.1 unless they are asked for v5 (MQTTv5 = True). With v5 we get:
+#
+#  - topic aliases: a heartbeat goes out with its full topic once per connection, after
+#    that with an empty topic and a two byte alias, as long as the broker allows aliases
+#    (TopicAliasMaximum in its CONNACK). Only QoS 0 messages are aliased, paho re-sends
+#    QoS>0 messages after a reconnect and an alias doesn't survive the connection it was
+#    set up on.
+#  - message expiry: heartbeats, errors and POPI events carry a MessageExpiryInterval, so a
+#    broker holding them for a subscriber that's away drops them instead of delivering
+#    them late. COPI commands expire the same way once the room controller sets it.
+#  - correlation IDs: a message that comes in with a "correlationID" user property has it
+#    copied onto whatever we publish while handling it (errors, state changes made by the
+#    callbacks it fires).
+#
+# A broker that doesn't do v5 answers our CONNECT with "unsupported protocol version", at
+# which point FallBackToMQTTv311() switches the client over and the next attempt is a
+# plain 3.1.1 connection. Everything above then quietly turns itself off.
+#
+# There are no shared subscriptions ($share/<group>/...). Every topic we subscribe to belongs to
+# exactly one controller (COPI/<puzzle ID>/.., COLI/<light ID>/..), and a command or a cue has to
+# reach the controller it names, not whichever member of a group the broker picks.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.reasoncodes import ReasonCodes
+
+
+# CONNACK reason code of a v5 broker that won't talk v5, paho also reports a 3.1.1 broker's "unacceptable protocol version"
+# as this (as a plain number, there are no reason codes in a 3.1.1 CONNACK)
+REASON_UNSUPPORTED_PROTOCOL = 132
+
+CORRELATION_PROPERTY = 'correlationID'
+
+
+def CreateClient(UseMQTTv5 = False):
+
+  if UseMQTTv5 is True:
+    return mqtt.Client(protocol=mqtt.MQTTv5)
+  #end if
+
+  return mqtt.Client()
+#end def (CreateClient)
+
+
+# paho has no way to change the protocol of a client it already built, and the callbacks,
+# last will and outbound queue are all hanging off this one, so we switch it over in place
+# (the same way paho itself drops from 3.1.1 to 3.1). 3.1.1 needs a clean session with our
+# empty client ID, v5 left that unset.
+def FallBackToMQTTv311(mqttClient):
+  mqttClient._protocol = mqtt.MQTTv311
+  mqttClient._clean_session = True
+#end def (FallBackToMQTTv311)
+
+
+def IsProtocolRefused(rc):
+  return rc == REASON_UNSUPPORTED_PROTOCOL
+#end def (IsProtocolRefused)
+
+
+# v5 hands us ReasonCodes where 3.1.1 hands us plain numbers
+def ConnackString(rc):
+
+  if isinstance(rc, ReasonCodes):
+    return str(rc)
+  #end if
+
+  if rc == REASON_UNSUPPORTED_PROTOCOL:
+    return 'Unsupported protocol version'
+  #end if
+
+  return mqtt.connack_string(rc)
+#end def (ConnackString)
+
+
+def ErrorString(rc):
+
+  if isinstance(rc, ReasonCodes):
+    return str(rc)
+  #end if
+
+  return mqtt.error_string(rc)
+#end def (ErrorString)
+
+
+# Returns None for 3.1.1 messages and for v5 messages without it
+def GetUserProperty(message, propertyName):
+
+  for name, value in getattr(getattr(message, 'properties', None), 'UserProperty', []):
+    if name == propertyName:
+      return value
+    #end if
+  #end for
+
+  return None
+#end def (GetUserProperty)
+
+
+# The v5 PUBLISH properties for a message: its expiry (None for one that never expires) and the correlation ID
+# of the message being handled, if it had one. None when there is no v5 session.
+def BuildPublishProperties(mqttSession, messageExpiry, correlationID = None):
+
+  if mqttSession is None:
+    return None
+  #end if
+
+  publishProperties = {}
+
+  if messageExpiry is not None:
+    publishProperties['MessageExpiryInterval'] = int(messageExpiry)
+  #end if
+
+  if correlationID is not None:
+    publishProperties['UserProperty'] = [(CORRELATION_PROPERTY, correlationID)]
+  #end if
+
+  return publishProperties
+#end def (BuildPublishProperties)
+
+
+# Hands one message to paho, through the session's topic aliases and properties when there is one.
+# Returns paho's MQTTMessageInfo.
+def Publish(mqttClient, mqttSession, topic, payload, qos = 0, retain = False, publishProperties = None):
+
+  if mqttSession is None:
+    return mqttClient.publish(topic, payload, qos = qos, retain = retain)
+  #end if
+
+  # QoS>0 is never aliased, and paho holds its message lock while it tells us one of those was acknowledged
+  if qos > 0:
+    topic, mqttProperties = mqttSession.PreparePublish(topic, qos, publishProperties)
+    return mqttClient.publish(topic, payload, qos = qos, retain = retain, properties = mqttProperties)
+  #end if
+
+  with mqttSession.publishLock:
+    topic, mqttProperties = mqttSession.PreparePublish(topic, qos, publishProperties)
+    return mqttClient.publish(topic, payload, qos = qos, retain = retain, properties = mqttProperties)
+  #end with
+
+#end def (Publish)
+
+
+class MQTTv5Session:
+
+  def __init__(self, TopicAliases = True):
+    self.__topicAliases = TopicAliases
+
+    # Held across picking an alias and handing the message to paho, so the message that sets an
+    # alias up always goes out before the first one relying on it
+    self.publishLock = threading.RLock()
+
+    self.enabled = True
+    self.__topicAliasMaximum = 0
+    self.__aliases = {}   # topic -> alias, for this connection only
+
+    self.__aliasedCount = 0
+    self.__bytesSaved   = 0
+  #end def
+
+
+  # CONNACK properties tell us how many aliases the broker will keep for us
+  def OnConnect(self, connackProperties):
+
+    with self.publishLock:
+      self.__aliases = {}
+      self.__topicAliasMaximum = getattr(connackProperties, 'TopicAliasMaximum', 0) if self.enabled else 0
+    #end with
+
+  #end def (OnConnect)
+
+
+  def OnDisconnect(self):
+
+    with self.publishLock:
+      self.__aliases = {}
+      self.__topicAliasMaximum = 0
+    #end with
+
+  #end def (OnDisconnect)
+
+
+  def Disable(self):
+    self.enabled = False
+    self.OnDisconnect()
+  #end def (Disable)
+
+
+  # For QoS 0 call with publishLock held, and keep holding it until paho has the message.
+  # publishProperties is a dict of v5 PUBLISH properties (MessageExpiryInterval, UserProperty..), returns (topic, properties).
+  def PreparePublish(self, topic, qos, publishProperties = None):
+
+    if self.enabled is False:
+      return topic, None
+    #end if
+
+    mqttProperties = Properties(PacketTypes.PUBLISH)
+
+    for name, value in (publishProperties or {}).items():
+      setattr(mqttProperties, name, value)
+    #end for
+
+    if (self.__topicAliases is True) and (qos == 0) and (self.__topicAliasMaximum > 0):
+      alias = self.__aliases.get(topic)
+
+      if alias is not None:
+        mqttProperties.TopicAlias = alias
+        self.__aliasedCount += 1
+        self.__bytesSaved += len(topic.encode()) - 3   # the alias property costs us three bytes
+        topic = ''
+
+      elif len(self.__aliases) < self.__topicAliasMaximum:
+        alias = len(self.__aliases) + 1
+        self.__aliases[topic] = alias
+        mqttProperties.TopicAlias = alias
+      #end if
+    #end if
+
+    if mqttProperties.isEmpty():
+      return topic, None
+    #end if
+
+    return topic, mqttProperties
+  #end def (PreparePublish)
+
+
+  def GetMetrics(self):
+
+    with self.publishLock:
+      metrics = {}
+      metrics['protocol']          = '5' if self.enabled else '3.1.1'
+      metrics['topicAliasMaximum'] = self.__topicAliasMaximum
+      metrics['topicAliases']      = len(self.__aliases)
+      metrics['aliasedPublishes']  = self.__aliasedCount
+      metrics['aliasBytesSaved']   = self.__bytesSaved
+      return metrics
+    #end with
+
+  #end def (GetMetrics)
+
+#end class
@@ -48,7 +48,7 @@
 #  - pulse "countdown" pin to LO
 #  - turn ON "tower lights"
 #  - RAISE tower
-#  - start a 120 second timer using a threading.Timer object
+#  - start a 120 second timer on the shared timer wheel (see timer_wheel.py)
 #
 # SOLVED:
 #  - cancel the 120 second probe timer
@@ -67,15 +67,20 @@
 
 import os
 import time
-import threading
+import asyncio
 import gpiozero
 
 from class_puzzle_contact_algo import AlgoMatchPuzzleContacts as AlgoMatchPuzzleContacts
-from controller_communications import ControllerCommunications
+from async_controller_communications import AsyncControllerCommunications
+import queued_log
+import timer_wheel
 
 #FIXME - let's move this to a config file and/or command-line arguments someday
 MQTTserver = 'ms-roomcontroller.local'
 DebugFlag  = True
+
+# Console output goes through queued_log, the puzzle classes' DEBUG lines only with DebugFlag on
+queued_log.SetLevel(queued_log.DEBUG if DebugFlag is True else queued_log.INFO)
 ProbeTimeout = 120
 #ProbeTimeout = 10
 
@@ -111,11 +116,9 @@ def handlerReactorPuzzleReset():
   ReactorRoomController.PublishStatus('RESET')
 
   # Cancel our internal probe timer
-  try:
-    probeTimer.cancel()
-  except:
-    pass
-  #end try
+  if probeTimer is not None:
+    probeTimer.Cancel()
+  #end if
 
   # Reset the timer subassemly - it will just show "ALERT"
   timerAssemblyOutputs['reset'].blink(on_time=.2, n=1)
@@ -128,8 +131,7 @@ def handlerReactorPuzzleActivated():
   ReactorRoomController.PublishStatus('ACTIVE')
 
   # Trigger our internal countdown timer
-  probeTimer = threading.Timer(ProbeTimeout, handlerReactorPuzzleFailed)
-  probeTimer.start()
+  probeTimer = timer_wheel.GetSharedWheel().Schedule(ProbeTimeout, handlerReactorPuzzleFailed)
 
   # Start the countdown from the timer subassemly
   timerAssemblyOutputs['countdown'].blink(on_time=.2, n=1)
@@ -140,11 +142,9 @@ def handlerReactorPuzzleSolved():
   ReactorRoomController.PublishStatus('SOLVED')
 
   # Stop our internal countdown timer
-  try:
-    probeTimer.cancel()
-  except:
-    pass
-  #end try
+  if probeTimer is not None:
+    probeTimer.Cancel()
+  #end if
   
 
   # Show "SUCCESS" on the timer subassemly
@@ -155,16 +155,14 @@ def handlerReactorPuzzleSolved():
 
 def handlerReactorPuzzleFailed():
   
-  print('FAILED!')
+  queued_log.Info('FAILED!')
   
   ReactorRoomController.PublishStatus('FAILED')
 
-  # Stop our internal countdown timer
-  try:
-    probeTimer.cancel()
-  except:
-    pass
-  #end try
+  # Stop our internal countdown timer (a no-op when it is the timer that got us here)
+  if probeTimer is not None:
+    probeTimer.Cancel()
+  #end if
 
 
   # Show "FAIL" on the timer subassemly
@@ -172,7 +170,7 @@ def handlerReactorPuzzleFailed():
 
 #end def
 
-ReactorPuzzle = AlgoMatchPuzzleContacts(Debug = DebugFlag, AlwaysActive = False)
+ReactorPuzzle = AlgoMatchPuzzleContacts(Debug = DebugFlag, AlwaysActive = False, PuzzleID = 'reactor')
 ReactorPuzzle.SetAlgorithmInputs (  [13, 20, 12 , 6,  5, 19, 21], FailPin = 26, ActiveLow = False)
 #ReactorPuzzle.SetAlgorithmInputs ( [13, 20, 12 , 6,  5, 19, 21, 16], FailPin = 26, ActiveLow = False)
 #                    16 is number 8 and appears to be broken?? ^^
@@ -196,7 +194,7 @@ ReactorPuzzle.RegisterCallback('reset',     handlerReactorPuzzleReset)
 ## ROOM CONTROL COMMUNICATION -> REACTOR PUZZLE ##
 ##################################################
 def handlerReactorRoomControllerReboot():
-  print('>> Processing a remote reboot command!')
+  queued_log.Info('>> Processing a remote reboot command!')
   os.system('sudo reboot')
 #end def
 
@@ -224,7 +222,9 @@ def handlerReactorRoomControllerPong():
   pass
 #end def
 
-ReactorRoomController = ControllerCommunications('reactor', MQTTserver)
+ReactorRoomController = AsyncControllerCommunications('reactor', MQTTserver)
+ReactorRoomController.EnableStateJournal()
+ReactorRoomController.EnableAdaptiveHeartbeats()
 
 ReactorRoomController.RegisterCallback('command_reboot',   handlerReactorRoomControllerReboot)
 ReactorRoomController.RegisterCallback('command_reset',    handlerReactorRoomControllerReset)
@@ -248,15 +248,14 @@ ReactorRoomController.RegisterCallback('pong',             handlerReactorRoomCon
 try:
 
   ReactorPuzzle.Reset()
+  ReactorRoomController.MarkPuzzleReady()
 
-  while True:
-    ReactorPuzzle.ProcessEvents()
-
-    ReactorRoomController.ProcessEvents()
-  #end while
+  # The contact inputs are all gpiozero callbacks, so the only thing left to run is the room
+  # controller communications. Whatever state we are in gets published as soon as we connect.
+  asyncio.run(ReactorRoomController.Run())
   
 except (KeyboardInterrupt, SystemExit):
-  print("\r\nExiting..")
+  queued_log.Info("\r\nExiting..")
   quit()
 
 except:
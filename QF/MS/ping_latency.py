@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+# PING/PONG Latency and Clock Offset
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# The room controller answers every CIPO/PING/<id> heartbeat on COPI/<id>/PONG, echoing
+# the heartbeat back. Every heartbeat now carries a pingID and the monotonic time it was
+# sent (pingSent), so when the PONG comes back we know exactly how long the round trip
+# through the broker and the room controller took.
+#
+# PingLatencyTracker keeps the last WindowSize round trips and reports p50/p95/p99 of
+# them, so a slow or flaky Wi-Fi link shows up in the heartbeat well before a game.
+#
+# If the room controller adds its own wall clock time to the PONG ("controllerTimestamp",
+# the Node-RED flows do this) we also estimate how far our clock is from the room
+# controller's, NTP style: offset = controllerTimestamp - (sent + received) / 2. The round
+# trip with the smallest RTT in the window gives the most trustworthy estimate.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import threading
+import time
+
+
+class PingLatencyTracker:
+
+  def __init__(self, WindowSize = 100, PendingLimit = 16):
+    self.__pendingLimit = PendingLimit
+
+    self.__lock = threading.Lock()
+    self.__nextPingID = 1
+
+    self.__pendingPings = collections.OrderedDict()   # pingID -> (monotonic sent, wall clock sent)
+    self.__samples = collections.deque(maxlen=WindowSize)   # (RTT, clock offset or None)
+
+    self.__pongCount = 0
+    self.__lostCount = 0
+  #end def
+
+
+  # Returns the (pingID, pingSent) pair to stamp on the next heartbeat
+  def NextPing(self):
+
+    with self.__lock:
+      pingID = self.__nextPingID
+      self.__nextPingID += 1
+
+      pingSent = time.monotonic()
+      self.__pendingPings[pingID] = (pingSent, time.time())
+
+      # A ping that has fallen this far behind isn't coming back
+      while len(self.__pendingPings) > self.__pendingLimit:
+        self.__pendingPings.popitem(last=False)
+        self.__lostCount += 1
+      #end while
+    #end with
+
+    return pingID, pingSent
+  #end def (NextPing)
+
+
+  # Feed it the decoded PONG payload, returns the round trip time in seconds (None if it wasn't one of ours)
+  def OnPong(self, pongData):
+
+    timestampReceived = time.monotonic()
+    wallReceived = time.time()
+
+    with self.__lock:
+      pendingPing = self.__pendingPings.pop(pongData.get('pingID'), None)
+
+      if pendingPing is None:
+        return None
+      #end if
+
+      # Anything older than this one was overtaken, so it's not coming back either
+      for pingID in list(self.__pendingPings.keys()):
+        if pingID < pongData['pingID']:
+          del self.__pendingPings[pingID]
+          self.__lostCount += 1
+        #end if
+      #end for
+
+      roundTrip = timestampReceived - pendingPing[0]
+      clockOffset = None
+
+      if isinstance(pongData.get('controllerTimestamp'), (int, float)):
+        clockOffset = pongData['controllerTimestamp'] - ((pendingPing[1] + wallReceived) / 2)
+      #end if
+
+      self.__samples.append((roundTrip, clockOffset))
+      self.__pongCount += 1
+    #end with
+
+    return roundTrip
+  #end def (OnPong)
+
+
+  def GetMetrics(self):
+
+    with self.__lock:
+      metrics = {}
+      metrics['pongs'] = self.__pongCount
+      metrics['lost']  = self.__lostCount
+
+      if len(self.__samples) == 0:
+        return metrics
+      #end if
+
+      roundTrips = sorted(sample[0] for sample in self.__samples)
+
+      metrics['rttLastMs'] = round(self.__samples[-1][0] * 1000, 1)
+      metrics['rttP50Ms']  = round(self.__percentile(roundTrips, 50) * 1000, 1)
+      metrics['rttP95Ms']  = round(self.__percentile(roundTrips, 95) * 1000, 1)
+      metrics['rttP99Ms']  = round(self.__percentile(roundTrips, 99) * 1000, 1)
+
+      offsetSamples = [sample for sample in self.__samples if sample[1] is not None]
+
+      if len(offsetSamples) > 0:
+        metrics['clockOffsetMs'] = round(min(offsetSamples)[1] * 1000, 1)
+      #end if
+
+      return metrics
+    #end with
+
+  #end def (GetMetrics)
+
+
+  # Nearest-rank percentile of an already sorted list
+  def __percentile(self, sortedValues, percentile):
+    rank = max(1, -(-percentile * len(sortedValues) // 100))
+    return sortedValues[int(rank) - 1]
+  #end def (__percentile)
+
+#end class
@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+
+# Prioritised Outbound Publish Queue
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Everything a controller publishes used to go straight into paho, first come first
+# served. On a congested link that means a SOLVED state can sit behind a pile of
+# heartbeats that nobody cares about anymore.
+#
+# Every publish now goes through an OutboundPublishQueue first, in one of three
+# priority classes:
+#   PRIORITY_STATE     - state transitions, always handed to paho straight away
+#   PRIORITY_ERROR     - errors and everything else
+#   PRIORITY_HEARTBEAT - heartbeats, only the newest one per topic is kept. A heartbeat can
+#                        come with a fullPayload as well, which goes out instead when an
+#                        earlier heartbeat on its topic never did (see heartbeat_delta.py)
+#
+# Errors and heartbeats are only handed to paho while fewer than MaxInFlight of our
+# messages are still waiting to go out (paho tells us through on_publish), so under
+# backpressure they wait here where they can still be re-ordered and coalesced.
+# While we are disconnected everything waits here and goes out states-first on connect.
+#
+# The queue is bounded at MaxDepth, when it overflows the oldest heartbeat goes, then the
+# oldest error. State transitions are never dropped, however long the broker is away: the
+# room controller has to hear every one of them, and there are only ever a handful.
+# GetMetrics() reports depth, drops and coalesced heartbeats.
+#
+# Publish() optionally takes an onDelivered function, called once paho reports the
+# message as sent (for QoS>0 that means the broker acknowledged it), and a dict of MQTT v5
+# publishProperties, which only go out when protocolSession is set (see mqtt_v5.py).
+#
+# With a localBus set, subscribers in this process get every message the moment it is
+# published, connected or not, before it joins the queue for the broker (see local_bus.py).
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import threading
+import paho.mqtt.client as mqtt
+
+import mqtt_v5
+
+
+PRIORITY_STATE     = 0
+PRIORITY_ERROR     = 1
+PRIORITY_HEARTBEAT = 2
+
+
+class OutboundPublishQueue:
+
+  def __init__(self, mqttClient, MaxDepth = 32, MaxInFlight = 4):
+    self.mqttClient = mqttClient
+    self.protocolSession = None   # an MQTTv5Session when the connection speaks v5
+    self.localBus = None          # a LocalBus bridged to this connection's broker
+
+    self.__maxDepth    = MaxDepth
+    self.__maxInFlight = MaxInFlight
+
+    self.__lock = threading.Lock()
+    self.__connected = False
+    self.__inFlight = 0
+
+    self.__stateQueue     = collections.deque()
+    self.__errorQueue     = collections.deque()
+    self.__heartbeatQueue = collections.OrderedDict()   # topic -> newest heartbeat for that topic
+    self.__fullHeartbeats = {}                         # topic -> fullPayload of the heartbeat waiting for that topic
+    self.__heartbeatGaps  = set()                      # topics whose last heartbeat was coalesced or dropped
+
+    self.__deliveryCallbacks = {}                     # paho message ID -> onDelivered
+    self.__completedMIDs     = collections.deque(maxlen=64)
+
+    self.__droppedCount   = 0
+    self.__coalescedCount = 0
+    self.__maxDepthSeen   = 0
+
+    self.mqttClient.on_publish = self.handlerMQTTonPublish
+  #end def
+
+
+  def Publish(self, topic, payload, qos = 0, retain = False, priority = PRIORITY_ERROR, onDelivered = None, publishProperties = None, fullPayload = None):
+
+    queueEntry = (topic, payload, qos, retain, priority, onDelivered, publishProperties)
+
+    if self.localBus is not None:
+      self.localBus.Publish(topic, payload, qos, retain)
+    #end if
+
+    with self.__lock:
+      if priority == PRIORITY_STATE:
+        self.__stateQueue.append(queueEntry)
+
+      elif priority == PRIORITY_HEARTBEAT:
+        if topic in self.__heartbeatQueue:
+          del self.__heartbeatQueue[topic]
+          self.__heartbeatGaps.add(topic)
+          self.__coalescedCount += 1
+        #end if
+
+        self.__heartbeatQueue[topic] = queueEntry
+        self.__fullHeartbeats.pop(topic, None)
+
+        if fullPayload is not None:
+          self.__fullHeartbeats[topic] = fullPayload
+        #end if
+
+      else:
+        self.__errorQueue.append(queueEntry)
+      #end if
+
+      self.__enforceMaxDepth()
+    #end with
+
+    self.Drain()
+  #end def (Publish)
+
+
+  def SetConnected(self, connected):
+
+    with self.__lock:
+      self.__connected = connected
+
+      # paho re-sends its own un-acknowledged QoS>0 messages after a reconnect, so our window starts over
+      self.__inFlight = 0
+    #end with
+
+    if connected is True:
+      self.Drain()
+    #end if
+  #end def (SetConnected)
+
+
+  def Drain(self):
+
+    while True:
+      with self.__lock:
+        queueEntry = self.__nextEntry()
+
+        if queueEntry is None:
+          return
+        #end if
+
+        self.__inFlight += 1
+      #end with
+
+      # Never call into paho while holding our lock, paho holds its own locks while it calls on_publish
+      topic, payload, qos, retain, priority, onDelivered, publishProperties = queueEntry
+      messageInfo = self.__publish(topic, payload, qos, retain, publishProperties)
+
+      # paho keeps QoS>0 messages even when it couldn't send them yet, so it will tell us when they make it
+      if (onDelivered is not None) and ((qos > 0) or (messageInfo.rc == mqtt.MQTT_ERR_SUCCESS)):
+        self.__trackDelivery(messageInfo.mid, onDelivered)
+      #end if
+
+      if messageInfo.rc != mqtt.MQTT_ERR_SUCCESS:
+        with self.__lock:
+          self.__inFlight -= 1
+
+          # QoS>0 messages are still held by paho and will go out on reconnect, anything else we keep
+          if qos == 0:
+            self.__requeue(queueEntry)
+          #end if
+        #end with
+
+        return
+      #end if
+    #end while
+
+  #end def (Drain)
+
+
+  def GetDepth(self):
+    with self.__lock:
+      return len(self.__stateQueue) + len(self.__errorQueue) + len(self.__heartbeatQueue)
+    #end with
+  #end def (GetDepth)
+
+
+  def GetMetrics(self):
+    with self.__lock:
+      metrics = {}
+      metrics['depth']          = len(self.__stateQueue) + len(self.__errorQueue) + len(self.__heartbeatQueue)
+      metrics['depthState']     = len(self.__stateQueue)
+      metrics['depthError']     = len(self.__errorQueue)
+      metrics['depthHeartbeat'] = len(self.__heartbeatQueue)
+      metrics['maxDepthSeen']   = self.__maxDepthSeen
+      metrics['inFlight']       = self.__inFlight
+      metrics['dropped']        = self.__droppedCount
+      metrics['coalesced']      = self.__coalescedCount
+      return metrics
+    #end with
+  #end def (GetMetrics)
+
+
+  def handlerMQTTonPublish(self, client, userdata, mid):
+
+    with self.__lock:
+      if self.__inFlight > 0:
+        self.__inFlight -= 1
+      #end if
+
+      onDelivered = self.__deliveryCallbacks.pop(mid, None)
+
+      if onDelivered is None:
+        self.__completedMIDs.append(mid)
+      #end if
+    #end with
+
+    if onDelivered is not None:
+      onDelivered()
+    #end if
+
+    self.Drain()
+  #end def (handlerMQTTonPublish)
+
+
+  def __trackDelivery(self, mid, onDelivered):
+
+    # paho's network thread can finish a message before publish() has even returned to us
+    with self.__lock:
+      alreadyDelivered = mid in self.__completedMIDs
+
+      if alreadyDelivered is False:
+        self.__deliveryCallbacks[mid] = onDelivered
+      #end if
+    #end with
+
+    if alreadyDelivered is True:
+      onDelivered()
+    #end if
+
+  #end def (__trackDelivery)
+
+
+  def __publish(self, topic, payload, qos, retain, publishProperties):
+    return mqtt_v5.Publish(self.mqttClient, self.protocolSession, topic, payload, qos, retain, publishProperties)
+  #end def (__publish)
+
+
+  # Must be called with the lock held
+  def __nextEntry(self):
+
+    if self.__connected is False:
+      return None
+    #end if
+
+    # State transitions never wait for the in-flight window
+    if len(self.__stateQueue) > 0:
+      return self.__stateQueue.popleft()
+    #end if
+
+    if self.__inFlight >= self.__maxInFlight:
+      return None
+    #end if
+
+    if len(self.__errorQueue) > 0:
+      return self.__errorQueue.popleft()
+    #end if
+
+    if len(self.__heartbeatQueue) > 0:
+      topic, queueEntry = self.__heartbeatQueue.popitem(last=False)
+      fullPayload = self.__fullHeartbeats.pop(topic, None)
+
+      # The heartbeat before this one never went out, a delta from it would be no use to anybody
+      if topic in self.__heartbeatGaps:
+        self.__heartbeatGaps.discard(topic)
+
+        if fullPayload is not None:
+          queueEntry = (topic, fullPayload) + queueEntry[2:]
+        #end if
+      #end if
+
+      return queueEntry
+    #end if
+
+    return None
+  #end def (__nextEntry)
+
+
+  # Must be called with the lock held
+  def __requeue(self, queueEntry):
+
+    topic, payload, qos, retain, priority, onDelivered, publishProperties = queueEntry
+
+    if priority == PRIORITY_STATE:
+      self.__stateQueue.appendleft(queueEntry)
+
+    elif priority == PRIORITY_HEARTBEAT:
+      if topic not in self.__heartbeatQueue:
+        self.__heartbeatQueue[topic] = queueEntry
+        self.__heartbeatQueue.move_to_end(topic, last=False)
+
+      # A newer heartbeat for this topic is already waiting, and now it goes out after a gap
+      else:
+        self.__heartbeatGaps.add(topic)
+        self.__coalescedCount += 1
+      #end if
+
+    else:
+      self.__errorQueue.appendleft(queueEntry)
+    #end if
+
+  #end def (__requeue)
+
+
+  # Must be called with the lock held
+  def __enforceMaxDepth(self):
+
+    depth = len(self.__stateQueue) + len(self.__errorQueue) + len(self.__heartbeatQueue)
+
+    while depth > self.__maxDepth:
+      if len(self.__heartbeatQueue) > 0:
+        topic, queueEntry = self.__heartbeatQueue.popitem(last=False)
+        self.__fullHeartbeats.pop(topic, None)
+        self.__heartbeatGaps.add(topic)
+      elif len(self.__errorQueue) > 0:
+        self.__errorQueue.popleft()
+      else:
+        break
+      #end if
+
+      self.__droppedCount += 1
+      depth -= 1
+    #end while
+
+    if depth > self.__maxDepthSeen:
+      self.__maxDepthSeen = depth
+    #end if
+
+  #end def (__enforceMaxDepth)
+
+#end class
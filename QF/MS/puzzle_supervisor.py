@@ -0,0 +1,599 @@
+#!/usr/bin/python3
+
+# Puzzle Worker Supervisor
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Every puzzle in a room runs in the one process, so anything that takes that process down
+# (an exception out of the main loop, a library that segfaults, a callback that wedges the
+# interpreter) takes every prop in the room down with it.
+#
+# With "supervised": true in the room file, the process that reads the file claims no pins
+# and opens no connections. It forks a worker process per group of puzzles instead, each
+# one a Room (see room_config.py) of its own, and keeps an eye on them:
+#
+#   {"hubID": "multi", "supervised": true, "puzzles": [
+#     {"puzzleID": "fuel",  "worker": "engine", ...},
+#     {"puzzleID": "power", "worker": "engine", ...},
+#     {"puzzleID": "keys", ...}                        <- no worker, a process of its own
+#   ]}
+#
+# Each worker has its own hub connection (hub ID <hubID>-<worker>, so its last will speaks
+# for its own puzzles only) and tells us over a pipe every time one of its puzzles changes
+# state. When a worker dies we fork a new one straight away, and its puzzles start where
+# the last one left them (SOLVED stays solved, cues go back on) rather than from RESET. A
+# worker that keeps dying is held off CrashLoopDelay seconds between tries, so a puzzle that
+# can't start doesn't spin the CPU.
+#
+# The forks are cheap because everything a worker needs is already imported, nothing has to
+# be loaded from the SD card again.
+#
+# Puzzle events between puzzles in different workers go through the broker, puzzles in the
+# same worker still hear each other in-process (see local_bus.py).
+#
+# SIGHUP, or a RELOAD published to any worker's hub, reloads the room file here: workers
+# whose puzzles changed are stopped and forked again (puzzles that didn't change keep their
+# state), every other worker is left alone. How it went (or why the file wasn't used) goes back
+# down the pipe to the worker that asked, or the first one running for a SIGHUP, and that worker
+# publishes it as its hub's RELOAD event, the same as an unsupervised room does.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import json
+import multiprocessing
+import multiprocessing.connection
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import flight_recorder
+import local_bus
+import loop_watchdog
+import queued_log
+import room_config
+
+
+# Splits a (validated) room config into one config per worker, in the order the file has them
+def GroupPuzzles(config):
+
+  workerConfigs = collections.OrderedDict()
+
+  for puzzleConfig in config['puzzles']:
+    workerName = puzzleConfig.get('worker', puzzleConfig['puzzleID'])
+
+    if workerName not in workerConfigs:
+      workerConfig = dict(config)
+      workerConfig['hubID'] = config['hubID'] + '-' + workerName
+      workerConfig['supervised'] = False
+      workerConfig['puzzles'] = []
+
+      workerConfigs[workerName] = workerConfig
+    #end if
+
+    workerConfigs[workerName]['puzzles'].append(puzzleConfig)
+  #end for
+
+  return workerConfigs
+#end def (GroupPuzzles)
+
+
+# A worker's Room, reporting its puzzles' states up the pipe and handing reloads to the supervisor.
+# The supervisor only ever sends one thing down the pipe, the outcome of a reload.
+class _WorkerRoom(room_config.Room):
+
+  def __init__(self, config, supervisorConnection, Bus = None):
+    self.__supervisorConnection = supervisorConnection
+    self.__sendLock = threading.Lock()   # reloads are asked for from paho's thread
+    self.__reportedStates = None
+
+    room_config.Room.__init__(self, config, Bus = Bus)
+  #end def
+
+
+  def RequestReload(self, reason = 'request'):
+    self.__send(('reload', reason))
+  #end def (RequestReload)
+
+
+  # Cheap enough for every pass of the loop, the pipe only hears about changes
+  def ReportStates(self):
+
+    puzzleStates = self.GetPuzzleStates()
+
+    if puzzleStates != self.__reportedStates:
+      self.__reportedStates = puzzleStates
+      self.__send(('states', puzzleStates))
+    #end if
+
+  #end def (ReportStates)
+
+
+  def ReceiveReloadResults(self):
+
+    try:
+      while self.__supervisorConnection.poll() is True:
+        pipeMessage = self.__supervisorConnection.recv()
+
+        if pipeMessage[0] == 'reloaded':
+          self.hub.PublishHubEvent('RELOAD', pipeMessage[1])
+        #end if
+      #end while
+
+    # The supervisor is gone, and nobody would restart us or hear about our states any more
+    except EOFError:
+      sys.exit(0)
+    #end try
+
+  #end def (ReceiveReloadResults)
+
+
+  def __send(self, pipeMessage):
+    with self.__sendLock:
+      self.__supervisorConnection.send(pipeMessage)
+    #end with
+  #end def (__send)
+
+#end class
+
+
+# Runs in the forked worker. Exits 0 when the supervisor stops it, anything else is a crash.
+def _runWorker(workerName, workerConfig, restoreStates, supervisorConnection):
+
+  # The supervisor deals with these for the whole room, and stops us itself
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGHUP, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, lambda signalNumber, stackFrame: sys.exit(0))
+
+  room = None
+
+  try:
+    room = _WorkerRoom(workerConfig, supervisorConnection, Bus = local_bus.GetSharedBus())
+    room.Start(RestoreStates = restoreStates)
+
+    while True:
+      room.ProcessEvents()
+      room.ReportStates()
+      room.ReceiveReloadResults()
+    #end while
+
+  except SystemExit:
+    if room is not None:
+      room.disconnect()
+    #end if
+
+  except BaseException:
+    # multiprocessing catches this before sys.excepthook would, so the flight recorder is told here
+    queued_log.Error('>> Worker [{}] crashed:\n{}', workerName, traceback.format_exc().rstrip())
+
+    recorder = flight_recorder.GetSharedRecorder()
+    recorder.Record(None, 'crash', {'worker': workerName, 'exception': repr(sys.exc_info()[1])})
+    recorder.TryDump('crash')
+
+    sys.exit(1)
+
+  finally:
+    # A forked child never gets to atexit
+    queued_log.Flush()
+  #end try
+
+#end def (_runWorker)
+
+
+class _Worker:
+
+  def __init__(self, workerName, config):
+    self.workerName = workerName
+    self.config = config
+
+    self.process = None
+    self.connection = None
+
+    self.restarts = 0
+    self.lastExitCode = None
+    self.lastRestartMs = None
+    self.timestampExited = None           # until the new one reports in
+    self.timestampRestartDue = None       # held off after too many crashes, None when it isn't
+
+    self.crashTimestamps = collections.deque()
+  #end def
+
+#end class
+
+
+class PuzzleSupervisor:
+
+  def __init__(self, roomFileName, CrashLoopLimit = 5, CrashLoopWindow = 60.0, CrashLoopDelay = 10.0, StopTimeout = 5.0):
+    self.roomFileName = roomFileName
+
+    self.__crashLoopLimit  = CrashLoopLimit      # crashes within CrashLoopWindow seconds before we start holding a worker off
+    self.__crashLoopWindow = CrashLoopWindow
+    self.__crashLoopDelay  = CrashLoopDelay
+    self.__stopTimeout     = StopTimeout
+
+    # fork, so a worker starts with everything already imported
+    self.__context = multiprocessing.get_context('fork')
+
+    self.config = room_config.ValidateRoomConfig(room_config.LoadRoomConfig(roomFileName))
+    self.hubID = self.config['hubID']
+    self.debugFlag = self.config['debug']
+
+    queued_log.SetLevel(queued_log.DEBUG if self.debugFlag is True else queued_log.INFO)
+
+    self.__workers = collections.OrderedDict()
+    self.__puzzleStates = {}   # puzzleID -> the last state its worker told us about
+
+    self.__reloadRequested = threading.Event()
+    self.__reloadReason = None
+    self.__reloadWorkerName = None   # the worker that asked for the reload, None for a SIGHUP
+  #end def
+
+
+  def GetPuzzleStates(self):
+    return dict(self.__puzzleStates)
+  #end def (GetPuzzleStates)
+
+
+  def GetWorkerMetrics(self):
+
+    workerMetrics = {}
+
+    for workerName, worker in self.__workers.items():
+      metrics = {}
+      metrics['pid']           = worker.process.pid if worker.process is not None else None
+      metrics['alive']         = (worker.process is not None) and (worker.process.is_alive() is True)
+      metrics['puzzles']       = [puzzleConfig['puzzleID'] for puzzleConfig in worker.config['puzzles']]
+      metrics['restarts']      = worker.restarts
+      metrics['lastExitCode']  = worker.lastExitCode
+      metrics['lastRestartMs'] = worker.lastRestartMs
+
+      workerMetrics[workerName] = metrics
+    #end for
+
+    return workerMetrics
+  #end def (GetWorkerMetrics)
+
+
+  def Start(self):
+
+    for workerName, workerConfig in GroupPuzzles(self.config).items():
+      self.__workers[workerName] = _Worker(workerName, workerConfig)
+      self.__startWorker(self.__workers[workerName])
+    #end for
+
+    queued_log.Info('>> Supervisor for room [{}] started {} workers: {}', self.hubID, len(self.__workers),
+                    {workerName: worker.process.pid for workerName, worker in self.__workers.items()})
+  #end def (Start)
+
+
+  # Safe from a signal handler or any thread, the reload itself happens on the next ProcessEvents()
+  def RequestReload(self, reason = 'request', WorkerName = None):
+    self.__reloadReason = reason
+    self.__reloadWorkerName = WorkerName
+    self.__reloadRequested.set()
+  #end def (RequestReload)
+
+
+  # Waits up to Timeout seconds for a worker to say something (or die), and deals with it
+  def ProcessEvents(self, Timeout = 0.5):
+
+    # Under systemd we are the main PID, so it's our loop that keeps the watchdog happy
+    loop_watchdog.GetSharedWatchdog().Tick()
+
+    if self.__reloadRequested.is_set() is True:
+      self.__reloadRequested.clear()
+      self.__reloadRoomFile()
+    #end if
+
+    timestampNow = time.monotonic()
+
+    for worker in self.__workers.values():
+      if (worker.timestampRestartDue is not None) and (worker.timestampRestartDue <= timestampNow):
+        self.__startWorker(worker)
+      #end if
+
+      if worker.timestampRestartDue is not None:
+        Timeout = min(Timeout, worker.timestampRestartDue - timestampNow)
+      #end if
+    #end for
+
+    waitingOn = {}   # what we wait on -> (worker, the process it was for)
+
+    for worker in self.__workers.values():
+      if worker.process is not None:
+        waitingOn[worker.connection] = (worker, worker.process)
+        waitingOn[worker.process.sentinel] = (worker, worker.process)
+      #end if
+    #end for
+
+    if len(waitingOn) == 0:
+      time.sleep(max(0.0, Timeout))
+      return
+    #end if
+
+    for ready in multiprocessing.connection.wait(list(waitingOn), max(0.0, Timeout)):
+      worker, process = waitingOn[ready]
+
+      # Already dealt with, and perhaps replaced, earlier in this batch
+      if worker.process is not process:
+        continue
+      #end if
+
+      if ready is worker.connection:
+        self.__receive(worker)
+      else:
+        self.__handleExit(worker)
+      #end if
+    #end for
+
+  #end def (ProcessEvents)
+
+
+  # Stops every worker (each one disconnects on the way out), named to match Room
+  def disconnect(self):
+
+    for worker in self.__workers.values():
+      self.__stopWorker(worker)
+    #end for
+
+  #end def (disconnect)
+
+
+  def __startWorker(self, worker):
+
+    restoreStates = {puzzleConfig['puzzleID']: self.__puzzleStates.get(puzzleConfig['puzzleID']) for puzzleConfig in worker.config['puzzles']}
+
+    supervisorConnection, workerConnection = self.__context.Pipe()
+
+    # The log's writer mustn't be part way through a write (holding stdout's lock) when we fork
+    queued_log.Flush()
+
+    worker.process = self.__context.Process(target = _runWorker, name = 'worker-' + worker.workerName,
+                                            args = (worker.workerName, worker.config, restoreStates, workerConnection))
+    worker.process.start()
+
+    # The worker has its own copy of its end
+    workerConnection.close()
+
+    worker.connection = supervisorConnection
+    worker.timestampRestartDue = None
+  #end def (__startWorker)
+
+
+  def __receive(self, worker):
+
+    try:
+      while worker.connection.poll() is True:
+        pipeMessage = worker.connection.recv()
+
+        if pipeMessage[0] == 'states':
+          self.__puzzleStates.update(pipeMessage[1])
+
+          # A worker's first report is the one that says it is back up
+          if worker.timestampExited is not None:
+            worker.lastRestartMs = round((time.monotonic() - worker.timestampExited) * 1000, 1)
+            worker.timestampExited = None
+
+            queued_log.Info('>> Worker [{}] back up {:.1f} ms after it exited, with states {}', worker.workerName, worker.lastRestartMs, pipeMessage[1])
+          #end if
+
+        elif pipeMessage[0] == 'reload':
+          self.RequestReload(pipeMessage[1], WorkerName = worker.workerName)
+        #end if
+      #end while
+
+    # The worker died part way through a message, the sentinel will tell us the rest
+    except (EOFError, OSError):
+      pass
+    #end try
+
+  #end def (__receive)
+
+
+  def __handleExit(self, worker):
+
+    # Whatever it managed to tell us before it went
+    self.__receive(worker)
+
+    worker.process.join()
+    worker.lastExitCode = worker.process.exitcode
+    worker.connection.close()
+
+    worker.process = None
+    worker.connection = None
+
+    timestampNow = time.monotonic()
+
+    worker.timestampExited = timestampNow
+    worker.crashTimestamps.append(timestampNow)
+
+    while worker.crashTimestamps[0] < timestampNow - self.__crashLoopWindow:
+      worker.crashTimestamps.popleft()
+    #end while
+
+    puzzleIDs = [puzzleConfig['puzzleID'] for puzzleConfig in worker.config['puzzles']]
+    worker.restarts += 1
+
+    if len(worker.crashTimestamps) >= self.__crashLoopLimit:
+      worker.timestampRestartDue = timestampNow + self.__crashLoopDelay
+      queued_log.Error('>> Worker [{}] {} exited [{}], {} times in {:.0f} seconds, restarting it in {:.0f} seconds',
+                       worker.workerName, puzzleIDs, worker.lastExitCode, len(worker.crashTimestamps), self.__crashLoopWindow, self.__crashLoopDelay)
+      return
+    #end if
+
+    queued_log.Warning('>> Worker [{}] {} exited [{}], restarting it', worker.workerName, puzzleIDs, worker.lastExitCode)
+
+    self.__startWorker(worker)
+  #end def (__handleExit)
+
+
+  def __stopWorker(self, worker):
+
+    worker.timestampRestartDue = None
+    worker.timestampExited = None
+
+    if worker.process is None:
+      return
+    #end if
+
+    worker.process.terminate()
+    worker.process.join(self.__stopTimeout)
+
+    if worker.process.is_alive() is True:
+      queued_log.Warning('>> Worker [{}] did not stop within {:.0f} seconds, killing it', worker.workerName, self.__stopTimeout)
+      worker.process.kill()
+      worker.process.join()
+    #end if
+
+    self.__receive(worker)
+    worker.connection.close()
+
+    worker.process = None
+    worker.connection = None
+  #end def (__stopWorker)
+
+
+  # Restarts only the workers whose puzzles changed, a bad file changes nothing. Either way the room
+  # controller hears about it, through one of the workers (the supervisor has no hub of its own).
+  def __reloadRoomFile(self):
+
+    reloadReason = self.__reloadReason
+    reloadWorkerName = self.__reloadWorkerName
+
+    try:
+      reloadResult = self.__reloadWorkers()
+
+    except (OSError, ValueError) as reloadError:
+      queued_log.Error('>> Room [{}] not reloaded from [{}]: {}', self.hubID, self.roomFileName, reloadError)
+      reloadResult = {'error': str(reloadError)}
+    #end try
+
+    reloadResult['reason'] = reloadReason
+
+    self.__sendReloadResult(reloadWorkerName, json.dumps(reloadResult))
+  #end def (__reloadRoomFile)
+
+
+  def __reloadWorkers(self):
+
+    timestampStart = time.monotonic()
+
+    newConfig = room_config.ValidateRoomConfig(room_config.LoadRoomConfig(self.roomFileName))
+
+    for settingName in room_config.RESTART_SETTINGS:
+      if newConfig.get(settingName) != self.config.get(settingName):
+        queued_log.Warning('>> Room [{}] setting [{}] changed, it takes a restart to use the new one', self.hubID, settingName)
+        newConfig[settingName] = self.config.get(settingName)
+      #end if
+    #end for
+
+    oldPuzzleConfigs = {puzzleConfig['puzzleID']: puzzleConfig for puzzleConfig in self.config['puzzles']}
+
+    # A puzzle that changed starts over, one that didn't is put back where it was
+    for puzzleConfig in newConfig['puzzles']:
+      if puzzleConfig != oldPuzzleConfigs.get(puzzleConfig['puzzleID']):
+        self.__puzzleStates.pop(puzzleConfig['puzzleID'], None)
+      #end if
+    #end for
+
+    self.config = newConfig
+    self.debugFlag = newConfig['debug']
+
+    queued_log.SetLevel(queued_log.DEBUG if self.debugFlag is True else queued_log.INFO)
+
+    newWorkerConfigs = GroupPuzzles(newConfig)
+
+    reloadResult = {'unchanged': [], 'restarted': [], 'added': [], 'removed': []}
+
+    # Stopped first, whatever gets started next may want their pins
+    for workerName, worker in list(self.__workers.items()):
+      if workerName not in newWorkerConfigs:
+        self.__stopWorker(worker)
+        del self.__workers[workerName]
+        reloadResult['removed'].append(workerName)
+
+      elif newWorkerConfigs[workerName] != worker.config:
+        self.__stopWorker(worker)
+        reloadResult['restarted'].append(workerName)
+
+      else:
+        reloadResult['unchanged'].append(workerName)
+      #end if
+    #end for
+
+    workers = collections.OrderedDict()
+
+    for workerName, workerConfig in newWorkerConfigs.items():
+      worker = self.__workers.get(workerName)
+
+      if worker is None:
+        worker = _Worker(workerName, workerConfig)
+        reloadResult['added'].append(workerName)
+      #end if
+
+      worker.config = workerConfig
+
+      if (worker.process is None) and (worker.timestampRestartDue is None):
+        self.__startWorker(worker)
+      #end if
+
+      workers[workerName] = worker
+    #end for
+
+    self.__workers = workers
+
+    reloadResult['reloadMs'] = round((time.monotonic() - timestampStart) * 1000, 1)
+
+    queued_log.Info('>> Room [{}] reloaded in {:.1f} ms ({}): restarted {}, added {}, removed {}, unchanged {}',
+                    self.hubID, reloadResult['reloadMs'], self.__reloadReason,
+                    reloadResult['restarted'], reloadResult['added'], reloadResult['removed'], reloadResult['unchanged'])
+
+    return reloadResult
+  #end def (__reloadWorkers)
+
+
+  # To the worker that asked for the reload if it is still there (it may have been restarted by it, that's
+  # fine, the pipe is the new one's), otherwise to the first one running
+  def __sendReloadResult(self, workerName, reloadPayload):
+
+    workers = list(self.__workers.values())
+
+    if workerName in self.__workers:
+      workers.insert(0, self.__workers[workerName])
+    #end if
+
+    for worker in workers:
+      if worker.process is None:
+        continue
+      #end if
+
+      try:
+        worker.connection.send(('reloaded', reloadPayload))
+        return
+
+      # On its way out, the sentinel will tell us
+      except OSError:
+        pass
+      #end try
+    #end for
+
+    queued_log.Warning('>> Room [{}] has no worker running to publish the reload result', self.hubID)
+  #end def (__sendReloadResult)
+
+#end class
@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+
+# Queued Console Logging
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# print() writes to the console on the calling thread, and a slow console (the media
+# controller's TTY, a serial console, an ssh session on a bad link) holds that thread up
+# for as long as it takes. With Debug on that thread is very often a GPIO edge callback,
+# and the puzzle notices the contact late.
+#
+# Everything we used to print() now goes through here instead:
+#
+#   queued_log.Info('>> Puzzle ID [{}] connected to [{}]', puzzleID, mqttBroker)
+#   queued_log.Debug('>> Input Contact Pin [{}] is ACTIVE: [{}]', pin, isActive)
+#
+# The calling thread only compares the level and puts the message on a queue (a
+# queue.SimpleQueue, no lock taken on the way in). A single background thread does the
+# formatting (str.format() with the arguments, so a filtered out message is never
+# formatted at all) and the writing.
+#
+# The writer thread also rate limits: more than RateLimit messages from the same format
+# string within RateWindow seconds and the rest are counted instead of written, with one
+# line saying how many were left out once the window is over. A contact bouncing a
+# hundred times costs us a handful of lines.
+#
+# Messages are written exactly as before, levels only decide what gets written. The level
+# defaults to DEBUG (everything, as print() did), SetLevel() raises it.
+#
+# A forked child (see puzzle_supervisor.py) doesn't get the writer thread, only a copy of the
+# queue it was reading. The shared log starts a writer of its own in the child, on a new queue.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import atexit
+import os
+import queue
+import sys
+import threading
+import time
+
+
+DEBUG   = 10
+INFO    = 20
+WARNING = 30
+ERROR   = 40
+
+
+class QueuedLog:
+
+  def __init__(self, Level = DEBUG, RateLimit = 10, RateWindow = 1.0, MaxQueued = 10000):
+    self.level = Level
+
+    self.__rateLimit  = RateLimit
+    self.__rateWindow = RateWindow
+    self.__maxQueued  = MaxQueued
+
+    self.__queue = queue.SimpleQueue()
+    self.__rateWindows = {}   # format string -> [window start, messages written, messages left out], writer thread only
+
+    self.__writtenCount    = 0
+    self.__suppressedCount = 0
+    self.__droppedCount    = 0
+
+    self.__startWriter()
+  #end def
+
+
+  # Only the forking thread carries on in a child, whatever the parent still had queued is its to write
+  def AfterFork(self):
+    self.__queue = queue.SimpleQueue()
+    self.__rateWindows = {}
+    self.__startWriter()
+  #end def (AfterFork)
+
+
+  def __startWriter(self):
+    self.__writerThread = threading.Thread(target=self.__run, name='queued-log', daemon=True)
+    self.__writerThread.start()
+  #end def (__startWriter)
+
+
+  def SetLevel(self, level):
+    self.level = level
+  #end def (SetLevel)
+
+
+  def IsEnabled(self, level):
+    return level >= self.level
+  #end def (IsEnabled)
+
+
+  def Log(self, level, message, *messageArgs):
+
+    if level < self.level:
+      return
+    #end if
+
+    # Only if the writer can't keep up at all, better to lose a message than to eat all the memory
+    if self.__queue.qsize() >= self.__maxQueued:
+      self.__droppedCount += 1
+      return
+    #end if
+
+    self.__queue.put((message, messageArgs))
+  #end def (Log)
+
+
+  def Debug(self, message, *messageArgs):
+    if DEBUG >= self.level:
+      self.Log(DEBUG, message, *messageArgs)
+    #end if
+  #end def (Debug)
+
+
+  def Info(self, message, *messageArgs):
+    self.Log(INFO, message, *messageArgs)
+  #end def (Info)
+
+
+  def Warning(self, message, *messageArgs):
+    self.Log(WARNING, message, *messageArgs)
+  #end def (Warning)
+
+
+  def Error(self, message, *messageArgs):
+    self.Log(ERROR, message, *messageArgs)
+  #end def (Error)
+
+
+  # Waits (up to Timeout seconds) for everything queued so far to be written, returns False if it wasn't
+  def Flush(self, Timeout = 2.0):
+    flushed = threading.Event()
+    self.__queue.put(flushed)
+    return flushed.wait(Timeout)
+  #end def (Flush)
+
+
+  def GetMetrics(self):
+    metrics = {}
+    metrics['queued']     = self.__queue.qsize()
+    metrics['written']    = self.__writtenCount
+    metrics['suppressed'] = self.__suppressedCount
+    metrics['dropped']    = self.__droppedCount
+    return metrics
+  #end def (GetMetrics)
+
+
+  def __run(self):
+
+    while True:
+      try:
+        queueEntry = self.__queue.get(timeout = self.__rateWindow)
+      except queue.Empty:
+        self.__closeRateWindows()
+        continue
+      #end try
+
+      if isinstance(queueEntry, threading.Event):
+        self.__closeRateWindows(Everything = True)
+        queueEntry.set()
+        continue
+      #end if
+
+      message, messageArgs = queueEntry
+
+      if self.__allowedByRateLimit(message) is True:
+        self.__write(self.__format(message, messageArgs))
+      #end if
+    #end while
+
+  #end def (__run)
+
+
+  def __allowedByRateLimit(self, message):
+
+    timestampNow = time.monotonic()
+    rateWindow = self.__rateWindows.get(message)
+
+    if (rateWindow is None) or (timestampNow - rateWindow[0] >= self.__rateWindow):
+      if rateWindow is not None:
+        self.__reportSuppressed(message, rateWindow)
+      #end if
+
+      self.__rateWindows[message] = [timestampNow, 1, 0]
+      return True
+    #end if
+
+    if rateWindow[1] < self.__rateLimit:
+      rateWindow[1] += 1
+      return True
+    #end if
+
+    rateWindow[2] += 1
+    self.__suppressedCount += 1
+    return False
+  #end def (__allowedByRateLimit)
+
+
+  # Owns up to whatever the finished windows left out, and forgets about them
+  def __closeRateWindows(self, Everything = False):
+
+    timestampNow = time.monotonic()
+
+    for message, rateWindow in list(self.__rateWindows.items()):
+      if (Everything is True) or (timestampNow - rateWindow[0] >= self.__rateWindow):
+        self.__reportSuppressed(message, rateWindow)
+        del self.__rateWindows[message]
+      #end if
+    #end for
+
+  #end def (__closeRateWindows)
+
+
+  def __reportSuppressed(self, message, rateWindow):
+
+    if rateWindow[2] > 0:
+      self.__write('>> ({} more like this left out) {}'.format(rateWindow[2], message))
+      rateWindow[2] = 0
+    #end if
+
+  #end def (__reportSuppressed)
+
+
+  def __format(self, message, messageArgs):
+
+    if len(messageArgs) == 0:
+      return str(message)
+    #end if
+
+    try:
+      return message.format(*messageArgs)
+    except Exception:
+      return '{} {}'.format(message, messageArgs)   # a broken log call mustn't cost us the message
+    #end try
+
+  #end def (__format)
+
+
+  def __write(self, text):
+
+    # Whatever sys.stdout is by now, someone may have redirected it since we started
+    try:
+      sys.stdout.write(text + '\n')
+      sys.stdout.flush()
+    except Exception:
+      pass
+    #end try
+
+    self.__writtenCount += 1
+  #end def (__write)
+
+#end class
+
+
+_sharedLog = QueuedLog()
+
+# Give the writer a moment to catch up on the way out
+atexit.register(_sharedLog.Flush)
+
+# Python 3.7 and up
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_sharedLog.AfterFork)
+#end if
+
+
+def SetLevel(level):
+  _sharedLog.SetLevel(level)
+#end def (SetLevel)
+
+
+def IsEnabled(level):
+  return level >= _sharedLog.level
+#end def (IsEnabled)
+
+
+def Debug(message, *messageArgs):
+  if DEBUG >= _sharedLog.level:
+    _sharedLog.Log(DEBUG, message, *messageArgs)
+  #end if
+#end def (Debug)
+
+
+def Info(message, *messageArgs):
+  _sharedLog.Log(INFO, message, *messageArgs)
+#end def (Info)
+
+
+def Warning(message, *messageArgs):
+  _sharedLog.Log(WARNING, message, *messageArgs)
+#end def (Warning)
+
+
+def Error(message, *messageArgs):
+  _sharedLog.Log(ERROR, message, *messageArgs)
+#end def (Error)
+
+
+def Flush(Timeout = 2.0):
+  return _sharedLog.Flush(Timeout)
+#end def (Flush)
+
+
+def GetMetrics():
+  return _sharedLog.GetMetrics()
+#end def (GetMetrics)
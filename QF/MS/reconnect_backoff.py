@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+# Jittered Reconnect Backoff
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# When the room controller Pi reboots, every puzzle and media controller in the room loses
+# the broker at the same moment. If they all retry on the same fixed 2/4/8/16/30 second
+# schedule they also all come knocking at the same moment, every time.
+#
+# ReconnectBackoff tracks one connection through three states:
+#
+#   DISCONNECTED  -> not connected and not trying (not connected yet, or we hung up)
+#   CONNECTED     -> up and running
+#   BACKING_OFF   -> lost it (or failed to get it), waiting to try again
+#
+# and hands out "full jitter" delays: a random time between MinDelay and
+# min(MaxDelay, BaseDelay * 2^failures). Controllers that failed together spread out over
+# the whole window instead of retrying in lock-step.
+#
+# The failure count only goes back to zero once a connection has stayed up for StableAfter
+# seconds, so a broker that accepts us and drops us straight away keeps us backing off.
+#
+# GetMetrics() reports attempts, failures, reconnects, time spent disconnected and the
+# last error seen.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import random
+import threading
+import time
+
+
+STATE_DISCONNECTED = 'DISCONNECTED'
+STATE_CONNECTED    = 'CONNECTED'
+STATE_BACKING_OFF  = 'BACKING_OFF'
+
+
+class ReconnectBackoff:
+
+  def __init__(self, BaseDelay = 1, MaxDelay = 30, MinDelay = 0.5, StableAfter = 60):
+    self.__baseDelay   = BaseDelay
+    self.__maxDelay    = MaxDelay
+    self.__minDelay    = MinDelay
+    self.__stableAfter = StableAfter
+
+    self.__lock = threading.Lock()
+
+    self.state = STATE_DISCONNECTED
+
+    self.__consecutiveFailures = 0
+    self.__timestampConnected = None
+    self.__timestampOutageStart = time.monotonic()
+
+    self.__attemptCount      = 0
+    self.__failureCount      = 0
+    self.__reconnectCount    = 0
+    self.__disconnectedTotal = 0.0
+    self.__lastError         = None
+  #end def
+
+
+  # How long to wait before the next attempt
+  def NextDelay(self):
+
+    with self.__lock:
+      ceiling = min(self.__maxDelay, self.__baseDelay * (2 ** min(self.__consecutiveFailures, 16)))
+      return random.uniform(self.__minDelay, max(self.__minDelay, ceiling))
+    #end with
+
+  #end def (NextDelay)
+
+
+  def OnConnected(self):
+
+    with self.__lock:
+      now = time.monotonic()
+
+      if self.state == STATE_BACKING_OFF:
+        self.__reconnectCount += 1
+      #end if
+
+      if self.__timestampOutageStart is not None:
+        self.__disconnectedTotal += now - self.__timestampOutageStart
+        self.__timestampOutageStart = None
+      #end if
+
+      self.__attemptCount += 1
+      self.__timestampConnected = now
+      self.state = STATE_CONNECTED
+    #end with
+
+  #end def (OnConnected)
+
+
+  def OnConnectFailed(self, errorText = None):
+
+    with self.__lock:
+      self.__attemptCount += 1
+      self.__failureCount += 1
+      self.__consecutiveFailures += 1
+
+      if errorText is not None:
+        self.__lastError = errorText
+      #end if
+
+      self.state = STATE_BACKING_OFF
+    #end with
+
+  #end def (OnConnectFailed)
+
+
+  def OnDisconnected(self, errorText = None):
+
+    with self.__lock:
+      if errorText is not None:
+        self.__lastError = errorText
+      #end if
+
+      # paho follows a refused CONNACK with a disconnect, that one was already counted as a failure
+      if self.state != STATE_CONNECTED:
+        return
+      #end if
+
+      now = time.monotonic()
+
+      if now - self.__timestampConnected >= self.__stableAfter:
+        self.__consecutiveFailures = 0
+      else:
+        self.__consecutiveFailures += 1
+      #end if
+
+      self.__timestampConnected = None
+      self.__timestampOutageStart = now
+
+      # No error means we hung up ourselves and nobody is going to try again
+      if errorText is None:
+        self.state = STATE_DISCONNECTED
+      else:
+        self.state = STATE_BACKING_OFF
+      #end if
+    #end with
+
+  #end def (OnDisconnected)
+
+
+  def GetMetrics(self):
+
+    with self.__lock:
+      disconnectedSeconds = self.__disconnectedTotal
+
+      if self.__timestampOutageStart is not None:
+        disconnectedSeconds += time.monotonic() - self.__timestampOutageStart
+      #end if
+
+      metrics = {}
+      metrics['state']               = self.state
+      metrics['attempts']            = self.__attemptCount
+      metrics['failures']            = self.__failureCount
+      metrics['consecutiveFailures'] = self.__consecutiveFailures
+      metrics['reconnects']          = self.__reconnectCount
+      metrics['disconnectedSeconds'] = round(disconnectedSeconds, 1)
+      metrics['lastError']           = self.__lastError
+      return metrics
+    #end with
+
+  #end def (GetMetrics)
+
+#end class
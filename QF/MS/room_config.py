@@ -0,0 +1,903 @@
+#!/usr/bin/python3
+
+# Declarative Room Configuration
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# A puzzle host used to be a script with one copy-pasted block per puzzle: the puzzle class
+# and its pins, handlers publishing its state, the room controller's commands wired back to
+# it. A Room builds all of that from one file instead (JSON, or YAML if PyYAML is installed):
+#
+#   {
+#     "hubID": "multi",
+#     "mqttBroker": "ms-roomcontroller.local",
+#     "puzzles": [
+#       {"puzzleID": "fuel", "class": "and", "alwaysActive": true,
+#        "contacts":      [{"pin": 7, "activeLow": true}],
+#        "solvedOutputs": [{"pin": 6, "activeLow": true}]},
+#
+#       {"puzzleID": "finalcues", "class": "cues",
+#        "outputs":  {"engaged": {"pin": 20, "activeLow": true}},
+#        "commands": {"activate": {"engaged": "on"}, "reset": {"engaged": "off"}}}
+#     ]
+#   }
+#
+# Puzzle classes:
+#   and  -> ANDMatchPuzzleContacts: contacts, activeOutputs, solvedOutputs, delay (ms), alwaysActive
+#   algo -> AlgoMatchPuzzleContacts: inputs {pins, failPin, activeLow}, outputs {pins, activeLow},
+#           activeOutputs, solvedOutputs, failedOutputs, alwaysActive
+#   cues -> no puzzle logic, named outputs switched "on", "off" or "pulse"d (one second) by
+#           the room controller's commands
+#
+# Every puzzle gets its own puzzle ID on the one hub connection (and local bus), publishes
+# ACTIVE/SOLVED/FAILED/RESET as it goes, takes reset/activate/solve/reboot commands, and has
+# the state journal and adaptive heartbeats on unless its config says otherwise. All of them
+# run off the one ProcessEvents() loop. With "supervised": true they run in worker processes
+# instead, grouped by their "worker" setting (see puzzle_supervisor.py).
+#
+# The whole file is checked before a single pin is claimed, and every problem is reported at
+# once (RoomConfigError). How long loading, checking and building took is kept in
+# GetStartupTimings(), and each puzzle's heartbeat has when it was configured. The debug setting
+# also sets queued_log's level (DEBUG lines only with debug on).
+#
+# A running room picks up changes to its file without a restart (RequestReload(), on SIGHUP or
+# COPI/HUB/<hubID>/RELOAD). The new file is checked in full first, a bad one changes nothing.
+# Then only the puzzles that changed are touched: a new delay is applied in place, any other
+# change rebuilds that one puzzle (its pins are let go of and claimed again, its controller and
+# MQTT session are kept), and puzzles taken out of or added to the file are taken down or built.
+# Every other puzzle keeps its pins, state and connection as they were. hubID, mqttBroker and
+# mqttPort take a restart. What happened is published to CIPO/HUB/<hubID>/RELOAD.
+#
+#
+# Optional dependencies:
+#  - PyYAML (only needed for .yaml/.yml room files)
+#  $> sudo pip3 install pyyaml
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import json
+import os
+import threading
+import time
+
+try:
+  import yaml
+except ImportError:
+  yaml = None
+#end try
+
+import gpiozero
+
+import queued_log
+from class_puzzle_contact_and import ANDMatchPuzzleContacts
+from class_puzzle_contact_algo import AlgoMatchPuzzleContacts
+from controller_communications_hub import ControllerCommunicationsHub
+
+
+# Broadcom numbering, which is what gpiozero takes
+_GPIO_PINS = range(0, 28)
+
+_ROOM_KEYS   = {'hubID', 'mqttBroker', 'mqttPort', 'debug', 'supervised', 'puzzles'}
+_COMMON_KEYS = {'puzzleID', 'class', 'stateJournal', 'adaptiveHeartbeats', 'worker'}
+
+_CLASS_KEYS = {}
+_CLASS_KEYS['and']  = {'alwaysActive', 'contacts', 'activeOutputs', 'solvedOutputs', 'delay'}
+_CLASS_KEYS['algo'] = {'alwaysActive', 'inputs', 'outputs', 'activeOutputs', 'solvedOutputs', 'failedOutputs'}
+_CLASS_KEYS['cues'] = {'outputs', 'commands'}
+
+_CUE_ACTIONS = ('on', 'off', 'pulse')
+
+# The commands controller_communications.py hands on to us (REBOOT is always handled here)
+_CUE_COMMANDS = ('reset', 'activate', 'solve', 'fail')
+
+# The state a cue command leaves the cues in, and the other way round for putting them back
+_CUE_STATES = {'reset': 'RESET', 'activate': 'ACTIVE', 'solve': 'SOLVED', 'fail': 'FAILED'}
+
+
+class RoomConfigError(ValueError):
+
+  def __init__(self, problems):
+    self.problems = problems
+    ValueError.__init__(self, 'Room configuration has {} problem(s):\n  {}'.format(len(problems), '\n  '.join(problems)))
+  #end def
+
+#end class
+
+
+# Just the parsing, see ValidateRoomConfig() for the checking
+def LoadRoomConfig(roomFileName):
+
+  with open(roomFileName, 'r') as roomFile:
+    if os.path.splitext(roomFileName)[1].lower() in ('.yaml', '.yml'):
+      if yaml is None:
+        raise RoomConfigError(['[{}] is YAML, and PyYAML is not installed'.format(roomFileName)])
+      #end if
+
+      return yaml.safe_load(roomFile)
+    #end if
+
+    return json.load(roomFile)
+  #end with
+
+#end def (LoadRoomConfig)
+
+
+# Raises RoomConfigError with everything that is wrong, fills in the defaults when nothing is
+def ValidateRoomConfig(config):
+
+  problems = []
+
+  if not isinstance(config, dict):
+    raise RoomConfigError(['the room file must hold a single object'])
+  #end if
+
+  for unknownKey in sorted(set(config) - _ROOM_KEYS):
+    problems.append('unknown room setting [{}]'.format(unknownKey))
+  #end for
+
+  _checkType(problems, 'room', config, 'hubID', str, Required = True)
+  _checkType(problems, 'room', config, 'mqttBroker', str)
+  _checkType(problems, 'room', config, 'mqttPort', int)
+  _checkType(problems, 'room', config, 'debug', bool)
+  _checkType(problems, 'room', config, 'supervised', bool)
+
+  puzzleConfigs = config.get('puzzles')
+
+  if (not isinstance(puzzleConfigs, list)) or (len(puzzleConfigs) == 0):
+    problems.append('[puzzles] must be a list with at least one puzzle in it')
+    puzzleConfigs = []
+  #end if
+
+  puzzleIDs = set()
+  claimedPins = {}   # pin -> who has it, across the whole room
+
+  for puzzleIndex, puzzleConfig in enumerate(puzzleConfigs):
+    if not isinstance(puzzleConfig, dict):
+      problems.append('puzzle #{} must be an object'.format(puzzleIndex))
+      continue
+    #end if
+
+    puzzleID = puzzleConfig.get('puzzleID')
+
+    if (not isinstance(puzzleID, str)) or (len(puzzleID) == 0) or (set(puzzleID) & set('/#+')):
+      problems.append('puzzle #{} needs a [puzzleID] that is a non-empty string without / # or +'.format(puzzleIndex))
+      puzzleID = '#{}'.format(puzzleIndex)
+
+    elif puzzleID in puzzleIDs:
+      problems.append('puzzle ID [{}] is used more than once'.format(puzzleID))
+    #end if
+
+    puzzleIDs.add(puzzleID)
+
+    ValidatePuzzleConfig(puzzleConfig, problems, claimedPins, Where = 'puzzle [{}]'.format(puzzleID))
+  #end for
+
+  if len(problems) > 0:
+    raise RoomConfigError(problems)
+  #end if
+
+  config.setdefault('mqttBroker', None)
+  config.setdefault('mqttPort', 1883)
+  config.setdefault('debug', False)
+  config.setdefault('supervised', False)
+
+  return config
+#end def (ValidateRoomConfig)
+
+
+# One puzzle's part of ValidateRoomConfig(), problems are appended rather than raised
+def ValidatePuzzleConfig(puzzleConfig, problems, claimedPins, Where = 'puzzle'):
+
+  puzzleClass = puzzleConfig.get('class')
+
+  if puzzleClass not in _CLASS_KEYS:
+    problems.append('{} has class [{}], it must be one of {}'.format(Where, puzzleClass, sorted(_CLASS_KEYS)))
+    return
+  #end if
+
+  for unknownKey in sorted(set(puzzleConfig) - _COMMON_KEYS - _CLASS_KEYS[puzzleClass]):
+    problems.append('{} has an unknown [{}] setting for an [{}] puzzle'.format(Where, unknownKey, puzzleClass))
+  #end for
+
+  _checkType(problems, Where, puzzleConfig, 'stateJournal', bool)
+  _checkType(problems, Where, puzzleConfig, 'adaptiveHeartbeats', bool)
+
+  # It ends up in the worker's hub ID, and so in topics
+  workerName = puzzleConfig.get('worker', 'worker')
+
+  if (not isinstance(workerName, str)) or (len(workerName) == 0) or (set(workerName) & set('/#+')):
+    problems.append('{} [worker] must be a non-empty string without / # or +'.format(Where))
+  #end if
+
+  if puzzleClass in ('and', 'algo'):
+    _checkType(problems, Where, puzzleConfig, 'alwaysActive', bool)
+
+    for outputsKey in ('activeOutputs', 'solvedOutputs', 'failedOutputs'):
+      if not isinstance(puzzleConfig.get(outputsKey, []), list):
+        problems.append('{} [{}] must be a list of pins'.format(Where, outputsKey))
+        continue
+      #end if
+
+      for pinIndex, pinConfig in enumerate(puzzleConfig.get(outputsKey, [])):
+        _checkPin(problems, claimedPins, '{} {}[{}]'.format(Where, outputsKey, pinIndex), pinConfig)
+      #end for
+    #end for
+  #end if
+
+  if puzzleClass == 'and':
+    contacts = puzzleConfig.get('contacts')
+
+    if (not isinstance(contacts, list)) or (len(contacts) == 0):
+      problems.append('{} needs at least one contact in [contacts]'.format(Where))
+      contacts = []
+    #end if
+
+    for pinIndex, pinConfig in enumerate(contacts):
+      _checkPin(problems, claimedPins, '{} contacts[{}]'.format(Where, pinIndex), pinConfig)
+    #end for
+
+    if ('delay' in puzzleConfig) and ((type(puzzleConfig['delay']) is not int) or (puzzleConfig['delay'] <= 0)):
+      problems.append('{} [delay] must be a whole number of milliseconds above 0'.format(Where))
+    #end if
+
+  elif puzzleClass == 'algo':
+    inputs = puzzleConfig.get('inputs')
+
+    if (not isinstance(inputs, dict)) or (not isinstance(inputs.get('pins'), list)) or (len(inputs['pins']) == 0):
+      problems.append('{} needs [inputs] with at least one pin in [pins]'.format(Where))
+    else:
+      _checkType(problems, Where + ' inputs', inputs, 'activeLow', bool)
+
+      for pinIndex, pinNumber in enumerate(inputs['pins'] + ([inputs['failPin']] if inputs.get('failPin') is not None else [])):
+        _checkPin(problems, claimedPins, '{} inputs[{}]'.format(Where, pinIndex), {'pin': pinNumber})
+      #end for
+    #end if
+
+    outputs = puzzleConfig.get('outputs', {'pins': []})
+
+    if (not isinstance(outputs, dict)) or (not isinstance(outputs.get('pins'), list)):
+      problems.append('{} [outputs] must have a list of [pins]'.format(Where))
+    else:
+      _checkType(problems, Where + ' outputs', outputs, 'activeLow', bool)
+
+      for pinIndex, pinNumber in enumerate(outputs['pins']):
+        _checkPin(problems, claimedPins, '{} outputs[{}]'.format(Where, pinIndex), {'pin': pinNumber})
+      #end for
+    #end if
+
+  elif puzzleClass == 'cues':
+    outputs = puzzleConfig.get('outputs')
+    commands = puzzleConfig.get('commands')
+
+    if (not isinstance(outputs, dict)) or (len(outputs) == 0):
+      problems.append('{} needs at least one named output in [outputs]'.format(Where))
+      outputs = {}
+    #end if
+
+    for outputName, pinConfig in outputs.items():
+      _checkPin(problems, claimedPins, '{} output [{}]'.format(Where, outputName), pinConfig)
+    #end for
+
+    if not isinstance(commands, dict):
+      problems.append('{} needs [commands], each one a set of outputs to switch'.format(Where))
+      commands = {}
+    #end if
+
+    for commandName, cueActions in commands.items():
+      if commandName not in _CUE_COMMANDS:
+        problems.append('{} has cues for command [{}], the room controller only sends {}'.format(Where, commandName, _CUE_COMMANDS))
+      #end if
+
+      if not isinstance(cueActions, dict):
+        problems.append('{} command [{}] must map output names to {}'.format(Where, commandName, _CUE_ACTIONS))
+        continue
+      #end if
+
+      for outputName, cueAction in cueActions.items():
+        if outputName not in outputs:
+          problems.append('{} command [{}] switches output [{}], which isn\'t in [outputs]'.format(Where, commandName, outputName))
+        #end if
+
+        if cueAction not in _CUE_ACTIONS:
+          problems.append('{} command [{}] has [{}] for output [{}], it must be one of {}'.format(Where, commandName, cueAction, outputName, _CUE_ACTIONS))
+        #end if
+      #end for
+    #end for
+  #end if
+
+#end def (ValidatePuzzleConfig)
+
+
+def _checkType(problems, where, config, settingName, settingType, Required = False):
+
+  if settingName not in config:
+    if Required is True:
+      problems.append('{} is missing [{}]'.format(where, settingName))
+    #end if
+
+    return
+  #end if
+
+  # type() rather than isinstance(), True is an int as far as isinstance() is concerned
+  if type(config[settingName]) is not settingType:
+    problems.append('{} [{}] must be a {}'.format(where, settingName, settingType.__name__))
+  #end if
+
+#end def (__checkType)
+
+
+def _checkPin(problems, claimedPins, where, pinConfig):
+
+  if (not isinstance(pinConfig, dict)) or ('pin' not in pinConfig):
+    problems.append('{} must be an object with a [pin]'.format(where))
+    return
+  #end if
+
+  pinNumber = pinConfig['pin']
+
+  if (type(pinNumber) is not int) or (pinNumber not in _GPIO_PINS):
+    problems.append('{} has pin [{}], it must be a GPIO number from {} to {}'.format(where, pinNumber, _GPIO_PINS[0], _GPIO_PINS[-1]))
+    return
+  #end if
+
+  _checkType(problems, where, pinConfig, 'activeLow', bool)
+
+  if pinNumber in claimedPins:
+    problems.append('{} wants GPIO{}, which {} already has'.format(where, pinNumber, claimedPins[pinNumber]))
+  else:
+    claimedPins[pinNumber] = where
+  #end if
+
+#end def (__checkPin)
+
+
+# Loads, checks and builds the room in that order, nothing touches the hardware unless the file is good
+def LoadRoom(roomFileName, Bus = None, Debug = None):
+
+  timestampStart = time.monotonic()
+  config = LoadRoomConfig(roomFileName)
+
+  timestampLoaded = time.monotonic()
+  ValidateRoomConfig(config)
+
+  timestampValidated = time.monotonic()
+
+  room = Room(config, Bus = Bus, Debug = Debug)
+  room.roomFileName = roomFileName
+
+  room.startupTimings['load']     = round(timestampLoaded - timestampStart, 4)
+  room.startupTimings['validate'] = round(timestampValidated - timestampLoaded, 4)
+
+  queued_log.Info('>> Room [{}] built from [{}]: {} puzzles, load {:.1f} ms, validate {:.1f} ms, build {:.1f} ms',
+                  room.hubID, roomFileName, len(room.GetPuzzleIDs()),
+                  room.startupTimings['load'] * 1000, room.startupTimings['validate'] * 1000, room.startupTimings['build'] * 1000)
+
+  return room
+#end def (LoadRoom)
+
+
+class _CuePuzzle:
+
+  def __init__(self, commands):
+    self.__outputs = {}
+
+    self.commands = commands
+    self.state = None
+  #end def
+
+
+  def AddOutput(self, outputName, pinConfig):
+    self.__outputs[outputName] = gpiozero.LED(pinConfig['pin'], active_high = not pinConfig.get('activeLow', False))
+  #end def (AddOutput)
+
+
+  # Restoring puts the outputs back as the command left them, without firing its pulses again
+  def RunCommand(self, commandName, Restoring = False):
+
+    self.state = _CUE_STATES[commandName]
+
+    for outputName, cueAction in self.commands[commandName].items():
+      if cueAction == 'on':
+        self.__outputs[outputName].on()
+      elif cueAction == 'off':
+        self.__outputs[outputName].off()
+      elif (cueAction == 'pulse') and (Restoring is False):
+        self.__outputs[outputName].blink(on_time=1, n=1)
+      #end if
+    #end for
+
+  #end def (RunCommand)
+
+
+  # Cues have no state of their own to start from
+  def Reset(self):
+    pass
+  #end def (Reset)
+
+
+  def ProcessEvents(self):
+    pass
+  #end def (ProcessEvents)
+
+
+  def Cleanup(self):
+
+    for outputObject in self.__outputs.values():
+      outputObject.close()
+    #end for
+
+    self.__outputs.clear()
+  #end def (Cleanup)
+
+#end class
+
+
+class RoomPuzzle:
+
+  def __init__(self, config, puzzle, controller):
+    self.config = config
+    self.puzzle = puzzle
+    self.controller = controller
+  #end def
+
+#end class
+
+
+# What a reload can change on a running puzzle without rebuilding it
+_IN_PLACE_SETTINGS = {'delay'}
+
+# What a reload can only change by giving the puzzle a new controller (and so a new session on the hub)
+_CONTROLLER_SETTINGS = {'stateJournal', 'adaptiveHeartbeats'}
+
+# What a reload can't change at all, these need a restart
+RESTART_SETTINGS = ('hubID', 'mqttBroker', 'mqttPort', 'supervised')
+
+# Only the supervisor cares about these (see puzzle_supervisor.py)
+_SUPERVISOR_SETTINGS = {'worker'}
+
+# ANDMatchPuzzleContacts' own default, for a delay taken out of the file
+_DEFAULT_DELAY = 1000
+
+_PUZZLE_COMMANDS = ['command_reset', 'command_activate', 'command_solve', 'command_fail']
+
+
+class Room:
+
+  def __init__(self, config, Bus = None, Debug = None):
+
+    timestampStart = time.monotonic()
+
+    self.config = config
+    self.hubID = config['hubID']
+    self.roomFileName = None   # set by LoadRoom(), it is where RequestReload() reloads from
+
+    self.__debugOverride = Debug
+    self.__applyDebugFlag()
+
+    self.startupTimings = {}
+
+    self.__puzzles = {}   # puzzleID -> RoomPuzzle, in the order the file has them
+    self.__started = False
+
+    # Set from anywhere (a signal handler, paho's thread), acted on by the main loop in ProcessEvents()
+    self.__reloadRequested = threading.Event()
+    self.__reloadReason = None
+
+    self.hub = ControllerCommunicationsHub(self.hubID, config.get('mqttBroker'), config.get('mqttPort', 1883), BackgroundConnect = True, Bus = Bus)
+    self.hub.RegisterAdminHandler('RELOAD', lambda message: self.RequestReload('mqtt'))
+
+    for puzzleConfig in config['puzzles']:
+      self.AddPuzzle(puzzleConfig)
+    #end for
+
+    self.startupTimings['build'] = round(time.monotonic() - timestampStart, 4)
+  #end def
+
+
+  def GetPuzzleIDs(self):
+    return list(self.__puzzles)
+  #end def (GetPuzzleIDs)
+
+
+  def GetPuzzle(self, puzzleID):
+    return self.__puzzles[puzzleID]
+  #end def (GetPuzzle)
+
+
+  def GetStartupTimings(self):
+    return dict(self.startupTimings)
+  #end def (GetStartupTimings)
+
+
+  # The room file's debug setting covers the puzzle classes' chatter and the console log level
+  def __applyDebugFlag(self):
+    self.debugFlag = self.config.get('debug', False) if self.__debugOverride is None else self.__debugOverride
+    queued_log.SetLevel(queued_log.DEBUG if self.debugFlag is True else queued_log.INFO)
+  #end def (__applyDebugFlag)
+
+
+  # Builds one puzzle from its (already validated) config and puts it on the hub. If anything in it fails,
+  # whatever it had claimed so far (pins, a controller on the hub) is let go of again before the exception
+  # goes on up. In a running room it starts in RestoreState (see Start()), or reset without one.
+  def AddPuzzle(self, puzzleConfig, Controller = None, RestoreState = None):
+
+    puzzleID = puzzleConfig['puzzleID']
+
+    controller = Controller
+    puzzle = None
+
+    if controller is None:
+      controller = self.hub.AddPuzzle(puzzleID)
+    #end if
+
+    try:
+      if Controller is None:
+        if puzzleConfig.get('stateJournal', True) is True:
+          controller.EnableStateJournal()
+        #end if
+
+        if puzzleConfig.get('adaptiveHeartbeats', True) is True:
+          controller.EnableAdaptiveHeartbeats()
+        #end if
+      #end if
+
+      if puzzleConfig['class'] == 'cues':
+        puzzle = _CuePuzzle(puzzleConfig['commands'])
+        self.__buildCuePuzzle(puzzle, puzzleConfig, controller)
+      else:
+        puzzle = self.__newContactPuzzle(puzzleConfig)
+        self.__buildContactPuzzle(puzzle, puzzleConfig, controller)
+      #end if
+
+      controller.RegisterCallback('command_reboot', self.__handlerReboot)
+      controller.RecordStartupTiming('configured')
+
+      roomPuzzle = RoomPuzzle(puzzleConfig, puzzle, controller)
+
+      # Puzzles added to a running room start straight away
+      if self.__started is True:
+        self.__startPuzzle(roomPuzzle, RestoreState)
+        controller.MarkPuzzleReady()
+      #end if
+
+    except Exception:
+      if puzzle is not None:
+        puzzle.Cleanup()
+      #end if
+
+      if Controller is None:
+        controller.disconnect()
+      else:
+        for eventName in _PUZZLE_COMMANDS:
+          controller.UnregisterCallback(eventName)
+        #end for
+      #end if
+
+      raise
+    #end try
+
+    self.__puzzles[puzzleID] = roomPuzzle
+
+    return roomPuzzle
+  #end def (AddPuzzle)
+
+
+  # Lets go of the puzzle's pins and takes it off the hub (its state goes to UNKNOWN)
+  def RemovePuzzle(self, puzzleID):
+    roomPuzzle = self.__puzzles.pop(puzzleID)
+    roomPuzzle.puzzle.Cleanup()
+    roomPuzzle.controller.disconnect()
+  #end def (RemovePuzzle)
+
+
+  # Constructing one claims nothing yet, the pins are only claimed in __buildContactPuzzle()
+  def __newContactPuzzle(self, puzzleConfig):
+
+    puzzleID = puzzleConfig['puzzleID']
+    alwaysActive = puzzleConfig.get('alwaysActive', False)
+
+    if puzzleConfig['class'] == 'and':
+      return ANDMatchPuzzleContacts(Debug = self.debugFlag, AlwaysActive = alwaysActive, PuzzleID = puzzleID)
+    #end if
+
+    return AlgoMatchPuzzleContacts(Debug = self.debugFlag, AlwaysActive = alwaysActive, PuzzleID = puzzleID)
+  #end def (__newContactPuzzle)
+
+
+  def __buildContactPuzzle(self, puzzle, puzzleConfig, controller):
+
+    if puzzleConfig['class'] == 'and':
+      for pinConfig in puzzleConfig['contacts']:
+        puzzle.AddContact(pinConfig['pin'], ActiveLow = pinConfig.get('activeLow', False))
+      #end for
+
+      if 'delay' in puzzleConfig:
+        puzzle.SetDelay(puzzleConfig['delay'])
+      #end if
+
+    else:
+      inputs = puzzleConfig['inputs']
+      puzzle.SetAlgorithmInputs(inputs['pins'], FailPin = inputs.get('failPin'), ActiveLow = inputs.get('activeLow', False))
+
+      outputs = puzzleConfig.get('outputs', {'pins': []})
+      puzzle.SetAlgorithmOutputs(outputs['pins'], ActiveLow = outputs.get('activeLow', False))
+
+      for pinConfig in puzzleConfig.get('failedOutputs', []):
+        puzzle.AddFailedOutput(pinConfig['pin'], ActiveLow = pinConfig.get('activeLow', False))
+      #end for
+    #end if
+
+    for pinConfig in puzzleConfig.get('activeOutputs', []):
+      puzzle.AddActiveOutput(pinConfig['pin'], ActiveLow = pinConfig.get('activeLow', False))
+    #end for
+
+    for pinConfig in puzzleConfig.get('solvedOutputs', []):
+      puzzle.AddSolvedOutput(pinConfig['pin'], ActiveLow = pinConfig.get('activeLow', False))
+    #end for
+
+    puzzle.RegisterCallback('activated', lambda: controller.PublishStatus('ACTIVE'))
+    puzzle.RegisterCallback('solved',    lambda: controller.PublishStatus('SOLVED'))
+    puzzle.RegisterCallback('failed',    lambda: controller.PublishStatus('FAILED'))
+    puzzle.RegisterCallback('reset',     lambda: controller.PublishStatus('RESET'))
+
+    controller.RegisterCallback('command_reset',    puzzle.Reset)
+    controller.RegisterCallback('command_activate', puzzle.Activate)
+    controller.RegisterCallback('command_solve',    puzzle.Solve)
+  #end def (__buildContactPuzzle)
+
+
+  def __buildCuePuzzle(self, puzzle, puzzleConfig, controller):
+
+    for outputName, pinConfig in puzzleConfig['outputs'].items():
+      puzzle.AddOutput(outputName, pinConfig)
+    #end for
+
+    for commandName in puzzleConfig['commands']:
+      controller.RegisterCallback('command_' + commandName, lambda commandName = commandName: puzzle.RunCommand(commandName))
+    #end for
+  #end def (__buildCuePuzzle)
+
+
+  def __handlerReboot(self):
+    queued_log.Info('>> Processing a remote reboot command!')
+    queued_log.Flush()
+    os.system('sudo reboot')
+  #end def (__handlerReboot)
+
+
+  # Safe from a signal handler or any thread, the reload itself happens on the next ProcessEvents()
+  def RequestReload(self, reason = 'request'):
+    self.__reloadReason = reason
+    self.__reloadRequested.set()
+  #end def (RequestReload)
+
+
+  # Applies a new room config to the running room, touching only the puzzles that changed in it:
+  #  - unchanged puzzles are left exactly as they are, pins, state, MQTT and all
+  #  - a changed delay is applied in place
+  #  - a puzzle with other changes lets go of all of its pins and is rebuilt, on the same controller unless
+  #    its controller settings changed as well. The new one is put back in the state the old one was in
+  #    (SOLVED stays SOLVED, outputs and all, see Start()), only a puzzle that fails to build loses it
+  #  - puzzles no longer in the file are taken down, new ones are built and started
+  #
+  # A config that doesn't validate changes nothing (RoomConfigError). Returns what was done to which puzzle.
+  def Reload(self, newConfig):
+
+    timestampStart = time.monotonic()
+
+    ValidateRoomConfig(newConfig)
+
+    for settingName in RESTART_SETTINGS:
+      if newConfig.get(settingName) != self.config.get(settingName):
+        queued_log.Warning('>> Room [{}] setting [{}] changed, it takes a restart to use the new one', self.hubID, settingName)
+        newConfig[settingName] = self.config.get(settingName)
+      #end if
+    #end for
+
+    self.config = newConfig
+    self.__applyDebugFlag()
+
+    newPuzzleConfigs = collections.OrderedDict((puzzleConfig['puzzleID'], puzzleConfig) for puzzleConfig in newConfig['puzzles'])
+
+    reloadResult = {'unchanged': [], 'updated': [], 'rebuilt': [], 'added': [], 'removed': [], 'failed': []}
+    rebuildControllers = {}   # puzzleID -> the controller to rebuild it on, None for a new one
+
+    # Taken before anything is torn down, rebuilt puzzles start from here
+    puzzleStates = self.GetPuzzleStates()
+
+    # Everything that is going away lets go of its pins first, whatever gets built next may want them
+    for puzzleID, roomPuzzle in list(self.__puzzles.items()):
+      newPuzzleConfig = newPuzzleConfigs.get(puzzleID)
+
+      if newPuzzleConfig is None:
+        self.RemovePuzzle(puzzleID)
+        reloadResult['removed'].append(puzzleID)
+        continue
+      #end if
+
+      changedSettings = {settingName for settingName in set(roomPuzzle.config) | set(newPuzzleConfig) if roomPuzzle.config.get(settingName) != newPuzzleConfig.get(settingName)}
+      changedSettings -= _SUPERVISOR_SETTINGS
+
+      if len(changedSettings) == 0:
+        reloadResult['unchanged'].append(puzzleID)
+
+      elif changedSettings <= _IN_PLACE_SETTINGS:
+        roomPuzzle.puzzle.SetDelay(newPuzzleConfig.get('delay', _DEFAULT_DELAY))
+        roomPuzzle.config = newPuzzleConfig
+        reloadResult['updated'].append(puzzleID)
+
+      elif len(changedSettings & _CONTROLLER_SETTINGS) > 0:
+        self.RemovePuzzle(puzzleID)
+        rebuildControllers[puzzleID] = None
+
+      else:
+        del self.__puzzles[puzzleID]
+        roomPuzzle.puzzle.Cleanup()
+
+        for eventName in _PUZZLE_COMMANDS:
+          roomPuzzle.controller.UnregisterCallback(eventName)
+        #end for
+
+        rebuildControllers[puzzleID] = roomPuzzle.controller
+      #end if
+    #end for
+
+    puzzles = collections.OrderedDict()
+
+    for puzzleID, newPuzzleConfig in newPuzzleConfigs.items():
+      if puzzleID in self.__puzzles:
+        puzzles[puzzleID] = self.__puzzles[puzzleID]
+        continue
+      #end if
+
+      try:
+        restoreState = puzzleStates.get(puzzleID) if puzzleID in rebuildControllers else None
+        puzzles[puzzleID] = self.AddPuzzle(newPuzzleConfig, Controller = rebuildControllers.get(puzzleID), RestoreState = restoreState)
+        reloadResult['rebuilt' if puzzleID in rebuildControllers else 'added'].append(puzzleID)
+
+      except Exception as buildError:
+        queued_log.Error('>> Room [{}] unable to build puzzle [{}]: {}', self.hubID, puzzleID, buildError)
+        reloadResult['failed'].append(puzzleID)
+
+        # AddPuzzle() has let go of its pins and any controller it made, the one it was lent is ours to take down
+        if rebuildControllers.get(puzzleID) is not None:
+          rebuildControllers[puzzleID].disconnect()
+        #end if
+      #end try
+    #end for
+
+    self.__puzzles = puzzles
+
+    reloadResult['reloadMs'] = round((time.monotonic() - timestampStart) * 1000, 1)
+
+    queued_log.Info('>> Room [{}] reloaded in {:.1f} ms: updated {}, rebuilt {}, added {}, removed {}, failed {}',
+                    self.hubID, reloadResult['reloadMs'], reloadResult['updated'], reloadResult['rebuilt'],
+                    reloadResult['added'], reloadResult['removed'], reloadResult['failed'])
+
+    return reloadResult
+  #end def (Reload)
+
+
+  def __reloadRoomFile(self):
+
+    reloadReason = self.__reloadReason
+
+    try:
+      reloadResult = self.Reload(LoadRoomConfig(self.roomFileName))
+
+    except (OSError, ValueError) as reloadError:
+      queued_log.Error('>> Room [{}] not reloaded from [{}]: {}', self.hubID, self.roomFileName, reloadError)
+      reloadResult = {'error': str(reloadError)}
+    #end try
+
+    reloadResult['reason'] = reloadReason
+
+    # The room controller hears how it went, whoever asked for it
+    self.hub.PublishHubEvent('RELOAD', json.dumps(reloadResult))
+  #end def (__reloadRoomFile)
+
+
+  # Where each puzzle is at, as published to the room controller (None before its first state)
+  def GetPuzzleStates(self):
+
+    puzzleStates = {}
+
+    for puzzleID, roomPuzzle in self.__puzzles.items():
+      if roomPuzzle.config['class'] == 'cues':
+        puzzleStates[puzzleID] = roomPuzzle.puzzle.state
+      else:
+        puzzleStates[puzzleID] = roomPuzzle.controller.GetPuzzleState()
+      #end if
+    #end for
+
+    return puzzleStates
+  #end def (GetPuzzleStates)
+
+
+  # Puts every puzzle in its starting state and tells the room controller they are ready. RestoreStates
+  # ({puzzleID: state}, from GetPuzzleStates()) puts puzzles back where they were instead.
+  def Start(self, RestoreStates = None):
+
+    if RestoreStates is None:
+      RestoreStates = {}
+    #end if
+
+    for puzzleID, roomPuzzle in self.__puzzles.items():
+      self.__startPuzzle(roomPuzzle, RestoreStates.get(puzzleID))
+    #end for
+
+    for roomPuzzle in self.__puzzles.values():
+      roomPuzzle.controller.MarkPuzzleReady()
+    #end for
+
+    self.__started = True
+  #end def (Start)
+
+
+  def __startPuzzle(self, roomPuzzle, restoreState):
+
+    if roomPuzzle.config['class'] == 'cues':
+      for commandName, cueState in _CUE_STATES.items():
+        if (cueState == restoreState) and (commandName in roomPuzzle.puzzle.commands):
+          roomPuzzle.puzzle.RunCommand(commandName, Restoring = True)
+          return
+        #end if
+      #end for
+
+      roomPuzzle.puzzle.Reset()
+
+    elif restoreState == 'ACTIVE':
+      roomPuzzle.puzzle.Activate()
+
+    elif restoreState == 'SOLVED':
+      roomPuzzle.puzzle.Solve()
+
+    elif restoreState == 'FAILED':
+      roomPuzzle.puzzle.Fail()
+
+    else:
+      roomPuzzle.puzzle.Reset()
+    #end if
+
+  #end def (__startPuzzle)
+
+
+  # The one loop every puzzle in the room runs off. Contacts and timeouts are handled on threads of their own,
+  # all a pass has to do is heartbeats and reloads, so it waits up to Timeout seconds (less for a reload) once done.
+  def ProcessEvents(self, Timeout = 0.1):
+
+    if self.__reloadRequested.is_set() is True:
+      self.__reloadRequested.clear()
+      self.__reloadRoomFile()
+    #end if
+
+    for roomPuzzle in self.__puzzles.values():
+      roomPuzzle.puzzle.ProcessEvents()
+    #end for
+
+    self.hub.ProcessEvents()
+
+    self.__reloadRequested.wait(Timeout)
+  #end def (ProcessEvents)
+
+
+  def disconnect(self):
+    self.hub.disconnect()
+  #end def (disconnect)
+
+#end class
@@ -53,6 +53,7 @@ import time
 #from class_puzzle_contact_and import ANDMatchPuzzleContacts as ANDMatchPuzzleContactClass
 from class_puzzle_contact_algo import AlgoMatchPuzzleContacts as AlgoMatchPuzzleContactClass
 from controller_communications import ControllerCommunications
+import queued_log
 
 #FIXME - let's move this to a config file and/or command-line arguments someday
 MQTTserver = '192.168.200.138'
@@ -63,7 +64,7 @@ DebugFlag  = True
 ## PUZZLE CONTROLLER -> FUEL PUZZLE ##
 ######################################
 def handlerFuelPuzzleReset():
-  print('PUBLISH -> PUZZLE WAS RESET')
+  queued_log.Info('PUBLISH -> PUZZLE WAS RESET')
 #  FuelRoomController.PublishStatus('RESET')
 
 #  time.sleep(2)
@@ -71,19 +72,19 @@ def handlerFuelPuzzleReset():
 #end def
 
 def handlerFuelPuzzleActivated():
-  print('PUBLISH -> PUZZLE WAS ACTIVATED')
+  queued_log.Info('PUBLISH -> PUZZLE WAS ACTIVATED')
 #  FuelRoomController.PublishStatus('ACTIVE')
 #end def
 
 def handlerFuelPuzzleSolved():
-  print('PUBLISH -> PUZZLE WAS SOLVED')
+  queued_log.Info('PUBLISH -> PUZZLE WAS SOLVED')
   time.sleep(4)
   FuelPuzzle.Reset()
 #  FuelRoomController.PublishStatus('SOLVED')
 #end def
 
 def handlerFuelPuzzleFailed():
-  print('PUBLISH -> PUZZLE WAS FAILED')
+  queued_log.Info('PUBLISH -> PUZZLE WAS FAILED')
   time.sleep(2)
   FuelPuzzle.Reset()
 #  FuelRoomController.PublishStatus('FAILED')
@@ -115,7 +116,7 @@ FuelPuzzle.RegisterCallback('failed',    handlerFuelPuzzleFailed)
 ## ROOM CONTROL COMMUNICATION -> FUEL PUZZLE ##
 ###############################################
 def handlerFuelRoomControllerReboot():
-  print('>> Processing a remote reboot command!')
+  queued_log.Info('>> Processing a remote reboot command!')
   #os.system('sudo reboot')
 #end def
 
@@ -172,7 +173,7 @@ try:
   
 except (KeyboardInterrupt, SystemExit):
 
-  print("\r\nExiting..")
+  queued_log.Info("\r\nExiting..")
   quit()
 
 except:
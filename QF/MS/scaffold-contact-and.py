@@ -51,6 +51,7 @@ import time
 
 from class_puzzle_contact_and import ANDMatchPuzzleContacts as ANDMatchPuzzleContactClass
 from controller_communications import ControllerCommunications
+import queued_log
 
 #FIXME - let's move this to a config file and/or command-line arguments someday
 MQTTserver = '192.168.200.138'
@@ -62,7 +63,7 @@ DebugFlag  = True
 ######################################
 def handlerFuelPuzzleReset():
   FuelRoomController.PublishStatus('RESET')
-  print('PUBLISH -> PUZZLE WAS RESET')
+  queued_log.Info('PUBLISH -> PUZZLE WAS RESET')
 
 #  time.sleep(2)
 #  FuelPuzzle.Activate()
@@ -70,12 +71,12 @@ def handlerFuelPuzzleReset():
 
 def handlerFuelPuzzleActivated():
   FuelRoomController.PublishStatus('ACTIVE')
-  print('PUBLISH -> PUZZLE WAS ACTIVATED')
+  queued_log.Info('PUBLISH -> PUZZLE WAS ACTIVATED')
 #end def
 
 def handlerFuelPuzzleSolved():
   FuelRoomController.PublishStatus('SOLVED')
-  print('PUBLISH -> PUZZLE WAS SOLVED')
+  queued_log.Info('PUBLISH -> PUZZLE WAS SOLVED')
 #end def
 
 #FuelPuzzle = ANDMatchPuzzleContactClass(Debug = DebugFlag, AlwaysActive=False)
@@ -102,7 +103,7 @@ FuelPuzzle.RegisterCallback('reset',     handlerFuelPuzzleReset)
 ## ROOM CONTROL COMMUNICATION -> FUEL PUZZLE ##
 ###############################################
 def handlerFuelRoomControllerReboot():
-  print('>> Processing a remote reboot command!')
+  queued_log.Info('>> Processing a remote reboot command!')
   #os.system('sudo reboot')
 #end def
 
@@ -159,7 +160,7 @@ try:
   
 except (KeyboardInterrupt, SystemExit):
 
-  print("\r\nExiting..")
+  queued_log.Info("\r\nExiting..")
   quit()
 
 except:
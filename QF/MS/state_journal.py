@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+
+# Store-and-Forward State Journal
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# A state change published while the broker is unreachable only lives in memory until
+# the broker comes back. If the puzzle controller is restarted in the meantime (or the
+# room controller Pi reboots mid-game and somebody power-cycles everything) that
+# SOLVED is gone, and so is the player's progress.
+#
+# The StateJournal is a small append-only file, one JSON record per line:
+#
+#   {"seq": 7, "state": "SOLVED", "timestamp": 1571000000.0}   <- a state transition
+#   {"delivered": 7}                                           <- the broker has it
+#
+# Every transition is written before it is handed to MQTT and marked delivered once the
+# broker acknowledges it. Anything still undelivered when a controller starts up is
+# replayed, in order, as soon as it is connected.
+#
+# Writes are flushed right away, but fsync()ed in batches at most SyncInterval seconds
+# apart, so a burst of transitions costs one disk sync rather than one each.
+#
+# Once the file grows past MaxBytes it is compacted: delivered records go, and so do
+# undelivered transitions a later one has made pointless. SOLVED and FAILED are never
+# compacted away, the room controller has to hear about those even if the puzzle has
+# been reset since. If it is still too big after that, the oldest records are dropped.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import threading
+import time
+
+
+# States that still matter to the room controller after the puzzle has moved on
+TERMINAL_STATES = ['SOLVED', 'FAILED']
+
+
+class StateJournal:
+
+  def __init__(self, journalPath, MaxBytes = 65536, SyncInterval = 0.25):
+    self.journalPath = journalPath
+
+    self.__maxBytes     = MaxBytes
+    self.__syncInterval = SyncInterval
+
+    self.__lock = threading.Lock()
+    self.__syncTimer = None
+
+    self.__undelivered = []   # [seq, state, timestamp], oldest first
+    self.__nextSeq = 1
+
+    self.droppedCount = 0
+
+    self.__load()
+
+    # Start every run from a compacted file, it also gets rid of any half-written last line
+    with self.__lock:
+      self.__compact()
+      self.__journalFile = open(self.journalPath, 'a')
+    #end with
+
+  #end def
+
+
+  def Append(self, state):
+
+    with self.__lock:
+      seq = self.__nextSeq
+      self.__nextSeq += 1
+
+      record = [seq, state, time.time()]
+      self.__undelivered.append(record)
+
+      self.__write({'seq': seq, 'state': state, 'timestamp': record[2]})
+    #end with
+
+    return seq
+  #end def (Append)
+
+
+  def MarkDelivered(self, seq):
+
+    with self.__lock:
+      for index, record in enumerate(self.__undelivered):
+        if record[0] == seq:
+          del self.__undelivered[index]
+          self.__write({'delivered': seq})
+          break
+        #end if
+      #end for
+    #end with
+
+  #end def (MarkDelivered)
+
+
+  # Oldest first, as (seq, state, timestamp)
+  def GetUndelivered(self):
+    with self.__lock:
+      return [tuple(record) for record in self.__undelivered]
+    #end with
+  #end def (GetUndelivered)
+
+
+  def Sync(self):
+
+    with self.__lock:
+      self.__syncTimer = None
+
+      if self.__journalFile is not None:
+        self.__journalFile.flush()
+        os.fsync(self.__journalFile.fileno())
+      #end if
+    #end with
+
+  #end def (Sync)
+
+
+  def Close(self):
+
+    self.Sync()
+
+    with self.__lock:
+      if self.__syncTimer is not None:
+        self.__syncTimer.cancel()
+        self.__syncTimer = None
+      #end if
+
+      self.__journalFile.close()
+      self.__journalFile = None
+    #end with
+
+  #end def (Close)
+
+
+  def __load(self):
+
+    if not os.path.exists(self.journalPath):
+      return
+    #end if
+
+    undelivered = {}
+
+    with open(self.journalPath, 'r') as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue   # a line cut short by a power cut, whatever was on it never got acknowledged anyway
+        #end try
+
+        if 'delivered' in entry:
+          undelivered.pop(entry['delivered'], None)
+
+        elif 'seq' in entry:
+          undelivered[entry['seq']] = [entry['seq'], entry['state'], entry['timestamp']]
+          self.__nextSeq = max(self.__nextSeq, entry['seq'] + 1)
+        #end if
+      #end for
+    #end with
+
+    self.__undelivered = sorted(undelivered.values())
+  #end def (__load)
+
+
+  # Must be called with the lock held
+  def __write(self, entry):
+
+    self.__journalFile.write(json.dumps(entry) + '\n')
+    self.__journalFile.flush()
+
+    if self.__journalFile.tell() > self.__maxBytes:
+      self.__journalFile.close()
+      self.__compact()
+      self.__journalFile = open(self.journalPath, 'a')
+    #end if
+
+    if self.__syncTimer is None:
+      self.__syncTimer = threading.Timer(self.__syncInterval, self.Sync)
+      self.__syncTimer.daemon = True
+      self.__syncTimer.start()
+    #end if
+
+  #end def (__write)
+
+
+  # Must be called with the lock held (and the journal file closed)
+  def __compact(self):
+
+    compacted = []
+
+    for index, record in enumerate(self.__undelivered):
+      supersededBy = self.__undelivered[index + 1] if index + 1 < len(self.__undelivered) else None
+
+      if (supersededBy is not None) and ((record[1] not in TERMINAL_STATES) or (record[1] == supersededBy[1])):
+        continue
+      #end if
+
+      compacted.append(record)
+    #end for
+
+    lines = [json.dumps({'seq': record[0], 'state': record[1], 'timestamp': record[2]}) + '\n' for record in compacted]
+
+    while (len(lines) > 1) and (sum(len(line) for line in lines) > self.__maxBytes // 2):
+      del lines[0]
+      del compacted[0]
+      self.droppedCount += 1
+    #end while
+
+    self.__undelivered = compacted
+
+    # Write the new file next to the old one and swap it in, so a crash in here loses nothing
+    temporaryPath = self.journalPath + '.tmp'
+
+    with open(temporaryPath, 'w') as f:
+      f.writelines(lines)
+      f.flush()
+      os.fsync(f.fileno())
+    #end with
+
+    os.replace(temporaryPath, self.journalPath)
+  #end def (__compact)
+
+#end class
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+# Heartbeat Telemetry Providers
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Every heartbeat reports the same handful of facts about the controller it came from.
+# Most of them never change (MAC address), some change rarely (IP address, Pi model)
+# and only a couple are worth reading on every single beat (uptime, temperature).
+#
+# A TelemetryRegistry holds one provider function per metric, each with its own TTL:
+#   TTL = None  -> computed the first time it is asked for, then kept forever
+#   TTL = 0     -> sampled on every request
+#   TTL = N     -> cached for N seconds
+#
+# GetSharedRegistry() hands out one registry per broker/platform, so a host running
+# several puzzle IDs in one process does this work once, not once per puzzle.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import time
+import socket
+import uuid
+import re
+import math
+import sys
+import os
+
+
+class TelemetryRegistry:
+
+  def __init__(self):
+    self.__providers = {}
+    self.__cache = {}
+  #end def
+
+
+  def RegisterProvider(self, metricName, providerFunction, TTL = None):
+    self.__providers[metricName] = (providerFunction, TTL)
+    self.__cache.pop(metricName, None)
+  #end def (RegisterProvider)
+
+
+  def HasProvider(self, metricName):
+    return metricName in self.__providers
+  #end def (HasProvider)
+
+
+  def Invalidate(self, metricName = None):
+    if metricName is None:
+      self.__cache.clear()
+    else:
+      self.__cache.pop(metricName, None)
+    #end if
+  #end def (Invalidate)
+
+
+  def GetMetric(self, metricName):
+
+    providerFunction, TTL = self.__providers[metricName]
+
+    if TTL == 0:
+      return providerFunction()
+    #end if
+
+    now = time.monotonic()
+    cachedEntry = self.__cache.get(metricName)
+
+    if (cachedEntry is not None) and ((cachedEntry[1] is None) or (now < cachedEntry[1])):
+      return cachedEntry[0]
+    #end if
+
+    # Two threads racing through here just both compute the value, which is harmless
+    value = providerFunction()
+
+    if TTL is None:
+      self.__cache[metricName] = (value, None)
+    else:
+      self.__cache[metricName] = (value, now + TTL)
+    #end if
+
+    return value
+  #end def (GetMetric)
+
+#end class
+
+
+_sharedRegistries = {}
+
+def GetSharedRegistry(mqttBroker, platformPrefix):
+
+  registryKey = (mqttBroker, platformPrefix)
+
+  if registryKey not in _sharedRegistries:
+    registry = TelemetryRegistry()
+
+    registry.RegisterProvider('temperature', getTemperature,                            TTL = 0)
+    registry.RegisterProvider('uptime',      getUptime,                                 TTL = 0)
+    registry.RegisterProvider('ipAddress',   lambda: getIPAddress(mqttBroker),          TTL = 60)
+    registry.RegisterProvider('piModel',     getRaspberryPiVersion,                     TTL = 3600)
+    registry.RegisterProvider('platform',    lambda: getPlatform(platformPrefix, registry.GetMetric('piModel')), TTL = 3600)
+    registry.RegisterProvider('MACaddress',  getMACaddress,                             TTL = None)
+
+    _sharedRegistries[registryKey] = registry
+  #end if
+
+  return _sharedRegistries[registryKey]
+#end def (GetSharedRegistry)
+
+
+def getTemperature():
+
+  # If we are running on anyting other than a Raspberry Pi, this file will probably not exist.
+  try:
+    with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
+      celsius = int(f.readline().strip()) / 1000;
+      fahrenheit = math.floor((celsius * 1.8) + 32);
+
+    return fahrenheit
+  except:
+    return 'n/a'
+  #end except
+#end def (getTemperature)
+
+
+def getUptime():
+  with open('/proc/uptime', 'r') as f:
+    uptime_seconds = float(f.readline().split()[0])
+
+  return uptime_seconds
+#end def (getUptime)
+
+
+# How long this process has been running, which is how far back "startup" really is
+def getProcessUptime():
+  try:
+    with open('/proc/self/stat', 'r') as f:
+      statFields = f.readline().rsplit(')', 1)[1].split()
+
+    return getUptime() - (int(statFields[19]) / os.sysconf('SC_CLK_TCK'))
+
+  except:
+    return 0.0
+  #end try
+
+#end def (getProcessUptime)
+
+
+def getIPAddress(mqttBroker):
+  try:
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect((mqttBroker, 80))  # The server doesn't need to actually be listening on this port for this to work BTW
+
+    host_ip = s.getsockname()[0]
+
+    s.close()
+
+    return host_ip
+
+  except:
+    return None
+  #end try
+
+#end def (getIPAddress)
+
+
+def getMACaddress():
+  return ':'.join(re.findall('..', '%012x' % uuid.getnode() ))
+#end def (getMACaddress)
+
+
+def getRaspberryPiVersion():
+
+  # Only Raspberry Pi's will have this, so we catch the error to mean we're running on some other platform (Simu-Puzzle perhaps?)
+  try:
+    with open('/proc/device-tree/model', 'r') as f:
+      model = f.readline()
+      return model
+    #end with
+
+  except:
+    return 'Unknown'
+  #end try
+
+#end def (getRaspberryPiVersion)
+
+
+def getPlatform(platformPrefix, piModel):
+  return '{}/Python v{}.{}.{}/{}'.format(platformPrefix, sys.version_info[0], sys.version_info[1], sys.version_info[2], piModel)
+#end def (getPlatform)
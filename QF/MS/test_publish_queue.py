@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+# Tests for publish_queue.py
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#  $> python3 -m pytest -q test_publish_queue.py
+#
+# paho is stood in for by a client that only writes down what it was asked to publish, and
+# acknowledges nothing until the test calls handlerMQTTonPublish() for it.
+
+
+import paho.mqtt.client as mqtt
+
+from heartbeat_delta import HeartbeatEncoder, HeartbeatDecoder
+from publish_queue import OutboundPublishQueue, PRIORITY_STATE, PRIORITY_HEARTBEAT
+
+
+class RecordingClient:
+
+  def __init__(self):
+    self.published = []   # (mid, topic, payload, qos)
+    self.rc = mqtt.MQTT_ERR_SUCCESS
+    self.on_publish = None
+  #end def
+
+
+  def publish(self, topic, payload, qos = 0, retain = False, properties = None):
+    messageInfo = mqtt.MQTTMessageInfo(len(self.published) + 1)
+    messageInfo.rc = self.rc
+
+    self.published.append((messageInfo.mid, topic, payload, qos))
+    return messageInfo
+  #end def
+
+#end class
+
+
+def makeQueue(**kwargs):
+  mqttClient = RecordingClient()
+  return OutboundPublishQueue(mqttClient, **kwargs), mqttClient
+#end def (makeQueue)
+
+
+def test_states_go_first_on_connect():
+
+  outboundQueue, mqttClient = makeQueue()
+
+  outboundQueue.Publish('CIPO/PING/a', 'ping', priority = PRIORITY_HEARTBEAT)
+  outboundQueue.Publish('CIPO/a/ERROR', 'oops')
+  outboundQueue.Publish('CIPO/a/STATE', 'SOLVED', qos = 1, priority = PRIORITY_STATE)
+
+  assert mqttClient.published == []
+
+  outboundQueue.SetConnected(True)
+
+  assert [payload for mid, topic, payload, qos in mqttClient.published] == ['SOLVED', 'oops', 'ping']
+#end def
+
+
+def test_heartbeats_coalesce_per_topic():
+
+  outboundQueue, mqttClient = makeQueue()
+
+  for beat in range(3):
+    outboundQueue.Publish('CIPO/PING/a', 'a{}'.format(beat), priority = PRIORITY_HEARTBEAT)
+    outboundQueue.Publish('CIPO/PING/b', 'b{}'.format(beat), priority = PRIORITY_HEARTBEAT)
+  #end for
+
+  outboundQueue.SetConnected(True)
+
+  assert [payload for mid, topic, payload, qos in mqttClient.published] == ['a2', 'b2']
+  assert outboundQueue.GetMetrics()['coalesced'] == 4
+#end def
+
+
+# A long outage overflows the queue with heartbeats and errors, never with states
+def test_states_are_never_dropped():
+
+  outboundQueue, mqttClient = makeQueue(MaxDepth = 4)
+
+  states = ['RESET', 'ACTIVE', 'SOLVED', 'RESET', 'ACTIVE', 'FAILED', 'RESET', 'ACTIVE']
+
+  for state in states:
+    outboundQueue.Publish('CIPO/a/STATE', state, qos = 1, priority = PRIORITY_STATE)
+    outboundQueue.Publish('CIPO/a/ERROR', 'error while ' + state)
+    outboundQueue.Publish('CIPO/PING/a', 'ping', priority = PRIORITY_HEARTBEAT)
+  #end for
+
+  metrics = outboundQueue.GetMetrics()
+  assert metrics['depthState'] == len(states)
+  assert metrics['depthError'] == 0
+  assert metrics['depthHeartbeat'] == 0
+
+  outboundQueue.SetConnected(True)
+
+  assert [payload for mid, topic, payload, qos in mqttClient.published] == states
+#end def
+
+
+def test_in_flight_window():
+
+  outboundQueue, mqttClient = makeQueue(MaxInFlight = 2)
+  outboundQueue.SetConnected(True)
+
+  for errorIndex in range(5):
+    outboundQueue.Publish('CIPO/a/ERROR', str(errorIndex))
+  #end for
+
+  assert len(mqttClient.published) == 2
+
+  # States never wait for the window
+  outboundQueue.Publish('CIPO/a/STATE', 'SOLVED', qos = 1, priority = PRIORITY_STATE)
+  assert mqttClient.published[-1][2] == 'SOLVED'
+
+  # The state took a place in the window as well, so it takes three acknowledgements to make room for two more
+  for mid, topic, payload, qos in list(mqttClient.published):
+    outboundQueue.handlerMQTTonPublish(mqttClient, None, mid)
+  #end for
+
+  assert [payload for mid, topic, payload, qos in mqttClient.published] == ['0', '1', 'SOLVED', '2', '3']
+#end def
+
+
+def test_on_delivered():
+
+  outboundQueue, mqttClient = makeQueue()
+  outboundQueue.SetConnected(True)
+
+  delivered = []
+  outboundQueue.Publish('CIPO/a/STATE', 'SOLVED', qos = 1, priority = PRIORITY_STATE, onDelivered = lambda: delivered.append('SOLVED'))
+
+  assert delivered == []
+
+  outboundQueue.handlerMQTTonPublish(mqttClient, None, mqttClient.published[0][0])
+
+  assert delivered == ['SOLVED']
+#end def
+
+
+# A QoS 0 publish paho couldn't take waits here for the next try
+def test_failed_qos0_publish_is_kept():
+
+  outboundQueue, mqttClient = makeQueue()
+  outboundQueue.SetConnected(True)
+
+  mqttClient.rc = mqtt.MQTT_ERR_NO_CONN
+  outboundQueue.Publish('CIPO/a/ERROR', 'oops')
+
+  assert outboundQueue.GetDepth() == 1
+
+  mqttClient.rc = mqtt.MQTT_ERR_SUCCESS
+  outboundQueue.SetConnected(True)
+
+  assert outboundQueue.GetDepth() == 0
+  assert [payload for mid, topic, payload, qos in mqttClient.published] == ['oops', 'oops']
+#end def
+
+
+# Delta heartbeats coalesced in the queue must still leave the receiver with an unbroken chain
+def test_coalesced_delta_heartbeats_go_out_full():
+
+  outboundQueue, mqttClient = makeQueue()
+  outboundQueue.SetConnected(True)
+
+  heartbeatEncoder = HeartbeatEncoder(SnapshotInterval = 100)
+  heartbeatDecoder = HeartbeatDecoder()
+
+  def sendBeat(uptime):
+    payload = heartbeatEncoder.Encode({'puzzleID': 'a', 'uptime': uptime})
+    fullPayload = heartbeatEncoder.GetFullSnapshot() if payload['heartbeatType'] == 'delta' else None
+    outboundQueue.Publish('CIPO/PING/a', payload, priority = PRIORITY_HEARTBEAT, fullPayload = fullPayload)
+  #end def
+
+  def receivedBeats():
+    return [heartbeatDecoder.Decode(payload) for mid, topic, payload, qos in mqttClient.published]
+  #end def
+
+  sendBeat(1)
+  assert receivedBeats() == [{'puzzleID': 'a', 'uptime': 1}]
+
+  # The broker goes away for a few beats
+  outboundQueue.SetConnected(False)
+
+  for uptime in range(2, 6):
+    sendBeat(uptime)
+  #end for
+
+  outboundQueue.SetConnected(True)
+  sendBeat(6)
+
+  del mqttClient.published[0]
+  assert receivedBeats() == [{'puzzleID': 'a', 'uptime': 5}, {'puzzleID': 'a', 'uptime': 6}]
+  assert heartbeatDecoder.gapCount == 0
+#end def
+
+
+def test_uncoalesced_delta_heartbeats_stay_deltas():
+
+  outboundQueue, mqttClient = makeQueue()
+  outboundQueue.SetConnected(True)
+
+  heartbeatEncoder = HeartbeatEncoder(SnapshotInterval = 100)
+
+  for uptime in range(3):
+    payload = heartbeatEncoder.Encode({'puzzleID': 'a', 'uptime': uptime})
+    outboundQueue.Publish('CIPO/PING/a', payload, priority = PRIORITY_HEARTBEAT, fullPayload = heartbeatEncoder.GetFullSnapshot())
+
+    outboundQueue.handlerMQTTonPublish(mqttClient, None, mqttClient.published[-1][0])
+  #end for
+
+  assert [payload['heartbeatType'] for mid, topic, payload, qos in mqttClient.published] == ['full', 'delta', 'delta']
+#end def
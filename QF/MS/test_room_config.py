@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+
+# Tests for room_config.py
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#  $> python3 -m pytest -q test_room_config.py
+#
+# The pins are gpiozero's mock pins and the broker is one that isn't there (the hub just keeps
+# retrying in the background), so this runs anywhere.
+
+
+import copy
+
+import gpiozero
+import pytest
+from gpiozero.pins.mock import MockFactory, MockPWMPin
+
+import room_config
+
+
+BASE_CONFIG = {
+  'hubID': 'test',
+  'mqttBroker': '127.0.0.1',
+  'mqttPort': 1,
+
+  'puzzles': [
+    {'puzzleID': 'fuel',  'class': 'and', 'alwaysActive': True, 'stateJournal': False,
+     'contacts': [{'pin': 7}], 'solvedOutputs': [{'pin': 6}]},
+
+    {'puzzleID': 'keys',  'class': 'and', 'stateJournal': False, 'delay': 2000,
+     'contacts': [{'pin': 8}, {'pin': 25}], 'solvedOutputs': [{'pin': 26}]},
+
+    {'puzzleID': 'patch', 'class': 'and', 'alwaysActive': True, 'stateJournal': False,
+     'contacts': [{'pin': 22}], 'solvedOutputs': [{'pin': 19}]},
+
+    {'puzzleID': 'cues',  'class': 'cues', 'stateJournal': False,
+     'outputs': {'smoke': {'pin': 15}}, 'commands': {'solve': {'smoke': 'on'}, 'reset': {'smoke': 'off'}}},
+  ],
+}
+
+
+@pytest.fixture
+def room():
+
+  gpiozero.Device.pin_factory = MockFactory(pin_class = MockPWMPin)
+
+  room = room_config.Room(copy.deepcopy(BASE_CONFIG), Debug = False)
+  room.Start()
+
+  yield room
+
+  room.disconnect()
+  gpiozero.Device.pin_factory.reset()
+#end def (room)
+
+
+def pinIsFree(pinNumber):
+
+  try:
+    gpiozero.LED(pinNumber).close()
+  except gpiozero.GPIOPinInUse:
+    return False
+  #end try
+
+  return True
+#end def (pinIsFree)
+
+
+def getPuzzleConfig(config, puzzleID):
+  return [puzzleConfig for puzzleConfig in config['puzzles'] if puzzleConfig['puzzleID'] == puzzleID][0]
+#end def (getPuzzleConfig)
+
+
+def test_reload_unchanged(room):
+
+  before = {puzzleID: room.GetPuzzle(puzzleID).puzzle for puzzleID in room.GetPuzzleIDs()}
+
+  reloadResult = room.Reload(copy.deepcopy(BASE_CONFIG))
+
+  assert sorted(reloadResult['unchanged']) == ['cues', 'fuel', 'keys', 'patch']
+
+  for puzzleID, puzzle in before.items():
+    assert room.GetPuzzle(puzzleID).puzzle is puzzle
+  #end for
+#end def
+
+
+def test_reload_diff(room):
+
+  fuel = room.GetPuzzle('fuel')
+  keys = room.GetPuzzle('keys')
+
+  newConfig = copy.deepcopy(BASE_CONFIG)
+  getPuzzleConfig(newConfig, 'keys')['delay'] = 500
+  getPuzzleConfig(newConfig, 'fuel')['contacts'] = [{'pin': 23}]
+  getPuzzleConfig(newConfig, 'cues')['adaptiveHeartbeats'] = False
+
+  # patch goes, and its pin is given to a new puzzle in the same reload
+  newConfig['puzzles'] = [puzzleConfig for puzzleConfig in newConfig['puzzles'] if puzzleConfig['puzzleID'] != 'patch']
+  newConfig['puzzles'].append({'puzzleID': 'newone', 'class': 'cues', 'stateJournal': False,
+                               'outputs': {'x': {'pin': 22}}, 'commands': {'fail': {'x': 'pulse'}}})
+
+  reloadResult = room.Reload(newConfig)
+
+  assert reloadResult['updated'] == ['keys']
+  assert sorted(reloadResult['rebuilt']) == ['cues', 'fuel']
+  assert reloadResult['added'] == ['newone']
+  assert reloadResult['removed'] == ['patch']
+  assert reloadResult['failed'] == []
+
+  assert room.GetPuzzleIDs() == ['fuel', 'keys', 'cues', 'newone']
+  assert sorted(room.hub.GetPuzzleIDs()) == ['cues', 'fuel', 'keys', 'newone']
+
+  # keys is the same puzzle with a new delay, fuel is a new puzzle on the same controller
+  assert room.GetPuzzle('keys') is keys
+  assert room.GetPuzzle('fuel').puzzle is not fuel.puzzle
+  assert room.GetPuzzle('fuel').controller is fuel.controller
+
+  assert pinIsFree(7) is True
+  assert pinIsFree(19) is True
+#end def
+
+
+def test_invalid_reload_changes_nothing(room):
+
+  before = room.GetPuzzleIDs()
+
+  newConfig = copy.deepcopy(BASE_CONFIG)
+  newConfig['puzzles'][0]['class'] = 'xor'
+
+  with pytest.raises(room_config.RoomConfigError):
+    room.Reload(newConfig)
+  #end with
+
+  assert room.GetPuzzleIDs() == before
+#end def
+
+
+# A puzzle that fails half way through being built lets go of what it had claimed, and a later
+# reload that fixes the problem builds it cleanly
+def test_failed_add_then_fixed_reload(room):
+
+  # Held by something outside the room, the config checks can't see it
+  pinHolder = gpiozero.LED(24)
+
+  newConfig = copy.deepcopy(BASE_CONFIG)
+  newConfig['puzzles'].append({'puzzleID': 'extra', 'class': 'and', 'stateJournal': False,
+                               'contacts': [{'pin': 9}, {'pin': 24}]})
+
+  reloadResult = room.Reload(copy.deepcopy(newConfig))
+
+  assert reloadResult['failed'] == ['extra']
+  assert 'extra' not in room.GetPuzzleIDs()
+  assert 'extra' not in room.hub.GetPuzzleIDs()
+  assert pinIsFree(9) is True
+
+  pinHolder.close()
+
+  reloadResult = room.Reload(copy.deepcopy(newConfig))
+
+  assert reloadResult['added'] == ['extra']
+  assert reloadResult['failed'] == []
+  assert 'extra' in room.hub.GetPuzzleIDs()
+#end def
+
+
+def test_failed_rebuild_then_fixed_reload(room):
+
+  pinHolder = gpiozero.LED(24)
+
+  newConfig = copy.deepcopy(BASE_CONFIG)
+  getPuzzleConfig(newConfig, 'fuel')['contacts'] = [{'pin': 7}, {'pin': 24}]
+
+  reloadResult = room.Reload(copy.deepcopy(newConfig))
+
+  assert reloadResult['failed'] == ['fuel']
+  assert 'fuel' not in room.GetPuzzleIDs()
+  assert 'fuel' not in room.hub.GetPuzzleIDs()
+  assert pinIsFree(6) is True
+  assert pinIsFree(7) is True
+
+  pinHolder.close()
+
+  reloadResult = room.Reload(copy.deepcopy(newConfig))
+
+  assert reloadResult['added'] == ['fuel']
+  assert 'fuel' in room.hub.GetPuzzleIDs()
+#end def
+
+
+# A rebuilt puzzle picks up where the one it replaced left off, on the same controller or a new one
+def test_rebuild_keeps_state(room):
+
+  room.GetPuzzle('fuel').puzzle.Solve()
+  room.GetPuzzle('cues').puzzle.RunCommand('solve')
+
+  assert room.GetPuzzleStates()['fuel'] == 'SOLVED'
+
+  newConfig = copy.deepcopy(BASE_CONFIG)
+  getPuzzleConfig(newConfig, 'fuel')['contacts'] = [{'pin': 23}]
+  getPuzzleConfig(newConfig, 'cues')['adaptiveHeartbeats'] = False
+
+  reloadResult = room.Reload(newConfig)
+
+  assert sorted(reloadResult['rebuilt']) == ['cues', 'fuel']
+
+  puzzleStates = room.GetPuzzleStates()
+  assert puzzleStates['fuel'] == 'SOLVED'
+  assert puzzleStates['cues'] == 'SOLVED'
+  assert puzzleStates['keys'] == 'RESET'
+
+  # Outputs included
+  assert gpiozero.Device.pin_factory.pin(6).state == 1
+  assert gpiozero.Device.pin_factory.pin(15).state == 1
+#end def
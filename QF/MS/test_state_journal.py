@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+# Tests for state_journal.py
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#  $> python3 -m pytest -q test_state_journal.py
+#
+# Every test gets a journal file of its own under pytest's tmp_path. Reopening the file
+# with a new StateJournal is a controller restart.
+
+
+from state_journal import StateJournal
+
+
+def undeliveredStates(stateJournal):
+  return [state for seq, state, timestamp in stateJournal.GetUndelivered()]
+#end def (undeliveredStates)
+
+
+def test_undelivered_survive_a_restart(tmp_path):
+
+  journalPath = str(tmp_path / 'state-a.journal')
+
+  stateJournal = StateJournal(journalPath)
+  resetSeq  = stateJournal.Append('RESET')
+  activeSeq = stateJournal.Append('ACTIVE')
+  stateJournal.Append('SOLVED')
+
+  stateJournal.MarkDelivered(resetSeq)
+  stateJournal.MarkDelivered(activeSeq)
+  stateJournal.Close()
+
+  stateJournal = StateJournal(journalPath)
+  assert undeliveredStates(stateJournal) == ['SOLVED']
+
+  # Sequence numbers carry on where the last run left off
+  assert stateJournal.Append('RESET') == 4
+  stateJournal.Close()
+#end def
+
+
+def test_nothing_undelivered(tmp_path):
+
+  journalPath = str(tmp_path / 'state-a.journal')
+
+  stateJournal = StateJournal(journalPath)
+
+  for state in ['RESET', 'ACTIVE', 'SOLVED']:
+    stateJournal.MarkDelivered(stateJournal.Append(state))
+  #end for
+
+  stateJournal.Close()
+
+  assert StateJournal(journalPath).GetUndelivered() == []
+#end def
+
+
+# A power cut half way through a write leaves a partial last line behind
+def test_partial_last_line_is_ignored(tmp_path):
+
+  journalPath = str(tmp_path / 'state-a.journal')
+
+  stateJournal = StateJournal(journalPath)
+  stateJournal.Append('SOLVED')
+  stateJournal.Close()
+
+  with open(journalPath, 'a') as journalFile:
+    journalFile.write('{"seq": 2, "state": "RES')
+  #end with
+
+  stateJournal = StateJournal(journalPath)
+  assert undeliveredStates(stateJournal) == ['SOLVED']
+
+  stateJournal.Append('RESET')
+  stateJournal.Close()
+
+  assert undeliveredStates(StateJournal(journalPath)) == ['SOLVED', 'RESET']
+#end def
+
+
+# Compaction drops what a later transition made pointless, but never a SOLVED or FAILED
+def test_compaction_keeps_terminal_states(tmp_path):
+
+  journalPath = str(tmp_path / 'state-a.journal')
+
+  stateJournal = StateJournal(journalPath)
+
+  for state in ['RESET', 'ACTIVE', 'SOLVED', 'RESET', 'ACTIVE', 'FAILED', 'RESET', 'ACTIVE']:
+    stateJournal.Append(state)
+  #end for
+
+  stateJournal.Close()
+
+  # Every run starts from a compacted file
+  assert undeliveredStates(StateJournal(journalPath)) == ['SOLVED', 'FAILED', 'ACTIVE']
+#end def
+
+
+def test_compaction_when_the_file_gets_too_big(tmp_path):
+
+  journalPath = str(tmp_path / 'state-a.journal')
+
+  stateJournal = StateJournal(journalPath, MaxBytes = 512)
+
+  for cycle in range(20):
+    stateJournal.MarkDelivered(stateJournal.Append('RESET'))
+    stateJournal.MarkDelivered(stateJournal.Append('ACTIVE'))
+  #end for
+
+  stateJournal.Append('SOLVED')
+  stateJournal.Sync()
+
+  with open(journalPath) as journalFile:
+    assert len(journalFile.read()) <= 512
+  #end with
+
+  assert undeliveredStates(stateJournal) == ['SOLVED']
+  stateJournal.Close()
+#end def
+
+
+# Still too big once compacted, the oldest records go
+def test_oldest_records_dropped_past_max_bytes(tmp_path):
+
+  journalPath = str(tmp_path / 'state-a.journal')
+
+  stateJournal = StateJournal(journalPath, MaxBytes = 256)
+
+  for cycle in range(10):
+    stateJournal.Append('SOLVED')
+    stateJournal.Append('FAILED')
+  #end for
+
+  undelivered = stateJournal.GetUndelivered()
+  stateJournal.Close()
+
+  assert stateJournal.droppedCount > 0
+  assert undelivered[-1][1] == 'FAILED'
+  assert [seq for seq, state, timestamp in undelivered] == sorted(seq for seq, state, timestamp in undelivered)
+#end def
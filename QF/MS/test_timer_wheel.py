@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+
+# Tests for timer_wheel.py
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#  $> python3 -m pytest -q test_timer_wheel.py
+#
+# The wheel is driven by hand here (StartThread = False) off a clock we move ourselves, so
+# nothing waits on real time. Times are whole multiples of a power-of-two resolution, the
+# arithmetic is exact and a timer's due tick is known up front.
+
+
+import heapq
+import random
+
+from timer_wheel import TimerWheel
+
+
+RESOLUTION = 1.0 / 128
+
+
+class FakeClock:
+
+  def __init__(self):
+    self.now = 1000.0
+  #end def
+
+
+  def __call__(self):
+    return self.now
+  #end def
+
+#end class
+
+
+def makeWheel(Resolution = RESOLUTION):
+  clock = FakeClock()
+  return TimerWheel(Resolution = Resolution, Clock = clock, StartThread = False), clock
+#end def (makeWheel)
+
+
+# A level 0 timer that fires on the tick before a level 1 boundary used to take the wheel past
+# that boundary without cascading it, stranding whatever was in the level 1 slot for ~164 seconds
+def test_boundary_cascade_after_level0_timer():
+
+  wheel, clock = makeWheel(Resolution = 0.01)
+  timestampStart = clock.now
+
+  fired = {}
+
+  wheel.Schedule(2.545, lambda: fired.setdefault('a', clock.now))
+  wheel.Schedule(3.0, lambda: fired.setdefault('b', clock.now))
+
+  for step in range(600):
+    clock.now = timestampStart + (step * 0.01)
+    wheel.RunDue()
+  #end for
+
+  assert set(fired) == {'a', 'b'}
+  assert 3.0 <= fired['b'] - timestampStart < 3.02
+  assert wheel.GetMetrics()['pending'] == 0
+#end def
+
+
+# Landing exactly on an unprocessed boundary with nothing on level 0 must still cascade it
+def test_boundary_cascade_when_idle():
+
+  wheel, clock = makeWheel()
+  timestampStart = clock.now
+
+  fired = []
+  wheel.Schedule(300 * RESOLUTION, lambda: fired.append(clock.now))
+
+  # Straight onto the boundary, then one tick at a time
+  clock.now = timestampStart + (256 * RESOLUTION)
+  wheel.RunDue()
+
+  for tick in range(257, 400):
+    clock.now = timestampStart + (tick * RESOLUTION)
+    wheel.RunDue()
+  #end for
+
+  assert fired == [timestampStart + (300 * RESOLUTION)]
+#end def
+
+
+def test_cancel():
+
+  wheel, clock = makeWheel()
+
+  fired = []
+  timerHandle = wheel.Schedule(1.0, fired.append, 'x')
+
+  assert timerHandle.IsPending() is True
+  assert timerHandle.Cancel() is True
+  assert timerHandle.Cancel() is False
+
+  clock.now += 5
+  wheel.RunDue()
+
+  assert fired == []
+  assert wheel.GetMetrics()['cancelled'] == 1
+  assert wheel.GetMetrics()['pending'] == 0
+#end def
+
+
+def test_callback_exception_is_counted():
+
+  wheel, clock = makeWheel()
+
+  def explode():
+    raise RuntimeError('boom')
+  #end def
+
+  wheel.Schedule(0.1, explode)
+
+  clock.now += 1
+  wheel.RunDue()
+
+  assert wheel.GetMetrics()['errors'] == 1
+  assert wheel.GetMetrics()['fired'] == 1
+#end def
+
+
+# Random schedules, cancels and clock steps (short ones, and long jumps across every level),
+# checked step by step against a plain heap of due ticks
+def test_matches_heap_scheduler():
+
+  for seed in range(6):
+    randomizer = random.Random(seed)
+
+    wheel, clock = makeWheel()
+    timestampStart = clock.now
+
+    nowTick = 0
+    fired = []
+
+    expected = []        # heap of (due tick, timer ID)
+    handles = {}         # timer ID -> TimerHandle, for the ones not yet fired or cancelled
+    nextTimerID = 0
+
+    for step in range(300):
+      for scheduleCount in range(randomizer.randint(0, 5)):
+        # Mostly level 0 and 1, now and then far enough out for levels 2 and 3
+        delayTicks = randomizer.choice([randomizer.randint(0, 300), randomizer.randint(0, 20000), randomizer.randint(0, 3000000)])
+
+        timerID = nextTimerID
+        nextTimerID += 1
+
+        handles[timerID] = wheel.Schedule(delayTicks * RESOLUTION, fired.append, timerID)
+        heapq.heappush(expected, (nowTick + delayTicks, timerID))
+      #end for
+
+      if (len(handles) > 0) and (randomizer.random() < 0.3):
+        timerID = randomizer.choice(list(handles))
+        assert handles.pop(timerID).Cancel() is True
+        expected = [(dueTick, expectedID) for dueTick, expectedID in expected if expectedID != timerID]
+        heapq.heapify(expected)
+      #end if
+
+      nowTick += randomizer.choice([1, 1, 1, 7, 100, 255, 256, 257, 5000, 70000, 1500000])
+      clock.now = timestampStart + (nowTick * RESOLUTION)
+
+      del fired[:]
+      wheel.RunDue()
+
+      expectedNow = []
+
+      while (len(expected) > 0) and (expected[0][0] <= nowTick):
+        expectedNow.append(heapq.heappop(expected)[1])
+      #end while
+
+      assert sorted(fired) == sorted(expectedNow), 'seed {} step {}'.format(seed, step)
+
+      for timerID in fired:
+        del handles[timerID]
+      #end for
+
+      assert wheel.GetMetrics()['pending'] == len(expected)
+    #end for
+  #end for
+
+#end def
@@ -0,0 +1,411 @@
+#!/usr/bin/python3
+
+# Shared Timer Wheel
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Every threading.Timer is an OS thread of its own, started for one timeout and thrown away,
+# and cancelling one that may or may not have run yet ends up wrapped in try/except. Puzzle
+# timeouts all go through one TimerWheel per process instead:
+#
+#   probeTimer = timer_wheel.GetSharedWheel().Schedule(120, handlerReactorPuzzleFailed)
+#   ...
+#   probeTimer.Cancel()
+#
+# It is a hierarchical timing wheel. Time moves on in ticks of Resolution seconds (10ms by
+# default), and a timer goes into a slot according to how far off it is:
+#
+#   level 0: 256 slots of 1 tick      (the next 2.56 seconds)
+#   level 1:  64 slots of 256 ticks   (the next ~2.7 minutes)
+#   level 2:  64 slots of 16K ticks   (the next ~2.9 hours)
+#   level 3:  64 slots of 1M ticks    (the next ~7.7 days, anything further out waits here too)
+#
+# Scheduling and cancelling are a dict insert or delete in one slot. Every time level 0 comes
+# round, the next slot up is emptied out into the levels below it (and so on up), so a timer
+# is only ever looked at a handful of times however far off it was.
+#
+# One thread ("timer-wheel") ticks the wheel, and only while there is something on it that is
+# due soon: with nothing pending it sleeps until the next Schedule(), with nothing on level 0 it
+# sleeps until the next level 1 slot comes round.
+#
+# Callbacks run on that thread, one after another, so they have to be quick (flip an output,
+# publish a state, hand anything longer to callback_executor.py). A timer never fires early,
+# and on an idle wheel no more than a tick or so late - GetMetrics() keeps track of how late
+# they actually were, along with how many were scheduled, fired and cancelled.
+#
+# Cancel() returns True if it stopped the timer, and False if the callback had already been
+# started (or the timer had already been cancelled). Once Cancel() has returned True, the
+# callback will not run.
+#
+# TimerWheel(Clock = ..., StartThread = False) leaves the ticking to the caller: RunDue() fires
+# whatever is due by Clock() and returns. test_timer_wheel.py drives the wheel that way.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import threading
+import time
+import traceback
+
+import queued_log
+
+
+# Bits of the tick count each level covers, lowest level first
+_LEVEL_BITS = (8, 6, 6, 6)
+
+
+_sharedWheel = None
+_sharedWheelLock = threading.Lock()
+
+def GetSharedWheel():
+
+  global _sharedWheel
+
+  with _sharedWheelLock:
+    if _sharedWheel is None:
+      _sharedWheel = TimerWheel()
+    #end if
+  #end with
+
+  return _sharedWheel
+#end def (GetSharedWheel)
+
+
+class TimerHandle:
+
+  __slots__ = ['wheel', 'scheduledAt', 'due', 'dueTick', 'callbackFunction', 'callbackArgs', 'slot', 'level']
+
+  def __init__(self, wheel, scheduledAt, due, dueTick, callbackFunction, callbackArgs):
+    self.wheel = wheel
+    self.scheduledAt = scheduledAt
+    self.due = due                 # the wheel's clock (time.monotonic() unless it was given another) it is due at
+    self.dueTick = dueTick
+    self.callbackFunction = callbackFunction
+    self.callbackArgs = callbackArgs
+
+    self.slot = None               # the slot dict it is in, None once it has fired or been cancelled
+    self.level = None
+  #end def
+
+
+  # True if it stopped the timer, False if it had already fired (or been cancelled)
+  def Cancel(self):
+    return self.wheel.Cancel(self)
+  #end def (Cancel)
+
+
+  def IsPending(self):
+    return self.slot is not None
+  #end def (IsPending)
+
+#end class
+
+
+class TimerWheel:
+
+  def __init__(self, Resolution = 0.01, LatenessWindow = 1000, Clock = None, StartThread = True):
+    self.__resolution = Resolution
+    self.__clock = Clock if Clock is not None else time.monotonic
+
+    self.__condition = threading.Condition()
+
+    self.__timestampStart = self.__clock()
+    self.__tick = 0   # the next tick to be processed, everything before it has fired
+
+    self.__levels = []
+    self.__levelShifts = []
+
+    shift = 0
+    for levelBits in _LEVEL_BITS:
+      self.__levels.append([{} for slotIndex in range(1 << levelBits)])
+      self.__levelShifts.append(shift)
+      shift += levelBits
+    #end for
+
+    self.__levelCounts = [0] * len(_LEVEL_BITS)
+
+    self.__scheduledCount = 0
+    self.__firedCount     = 0
+    self.__cancelledCount = 0
+    self.__errorCount     = 0
+
+    self.__lateness = collections.deque(maxlen=LatenessWindow)   # seconds late, of the most recent timers to fire
+
+    self.__wheelThread = None
+
+    if StartThread is True:
+      self.__wheelThread = threading.Thread(target=self.__run, name='timer-wheel', daemon=True)
+      self.__wheelThread.start()
+    #end if
+  #end def
+
+
+  # Runs callbackFunction(*callbackArgs) on the wheel's thread, delay seconds from now
+  def Schedule(self, delay, callbackFunction, *callbackArgs):
+
+    timestampNow = self.__clock()
+    due = timestampNow + max(0.0, delay)
+
+    # Rounded up, a timer must never fire early
+    dueTick = -(-(due - self.__timestampStart) // self.__resolution)
+
+    timerHandle = TimerHandle(self, timestampNow, due, int(dueTick), callbackFunction, callbackArgs)
+
+    with self.__condition:
+      self.__place(timerHandle)
+      self.__scheduledCount += 1
+
+      # The wheel thread may be asleep for a lot longer than this one is going to take
+      self.__condition.notify()
+    #end with
+
+    return timerHandle
+  #end def (Schedule)
+
+
+  def Cancel(self, timerHandle):
+
+    with self.__condition:
+      if timerHandle.slot is None:
+        return False
+      #end if
+
+      self.__remove(timerHandle)
+      self.__cancelledCount += 1
+    #end with
+
+    return True
+  #end def (Cancel)
+
+
+  def GetMetrics(self):
+
+    with self.__condition:
+      metrics = {}
+      metrics['scheduled'] = self.__scheduledCount
+      metrics['fired']     = self.__firedCount
+      metrics['cancelled'] = self.__cancelledCount
+      metrics['errors']    = self.__errorCount
+      metrics['pending']   = sum(self.__levelCounts)
+
+      lateness = sorted(self.__lateness)
+    #end with
+
+    if len(lateness) > 0:
+      metrics['lateP50Ms'] = round(self.__percentile(lateness, 50) * 1000, 1)
+      metrics['lateP99Ms'] = round(self.__percentile(lateness, 99) * 1000, 1)
+      metrics['lateMaxMs'] = round(lateness[-1] * 1000, 1)
+    #end if
+
+    return metrics
+  #end def (GetMetrics)
+
+
+  # Nearest-rank percentile of an already sorted list
+  def __percentile(self, sortedValues, percentile):
+    rank = max(1, -(-percentile * len(sortedValues) // 100))
+    return sortedValues[int(rank) - 1]
+  #end def (__percentile)
+
+
+  # Must be called with the lock held. Picks the lowest level the timer fits on, relative to the next tick.
+  def __place(self, timerHandle):
+
+    ticksAway = timerHandle.dueTick - self.__tick
+
+    if ticksAway < 0:
+      timerHandle.dueTick = self.__tick   # overdue (we are catching up), it goes out with the next tick
+      ticksAway = 0
+    #end if
+
+    level = 0
+
+    while (level < len(_LEVEL_BITS) - 1) and (ticksAway >= (1 << (self.__levelShifts[level] + _LEVEL_BITS[level]))):
+      level += 1
+    #end while
+
+    slots = self.__levels[level]
+    slot = slots[(timerHandle.dueTick >> self.__levelShifts[level]) & (len(slots) - 1)]
+
+    slot[timerHandle] = None
+    timerHandle.slot = slot
+    timerHandle.level = level
+
+    self.__levelCounts[level] += 1
+  #end def (__place)
+
+
+  # Must be called with the lock held
+  def __remove(self, timerHandle):
+    del timerHandle.slot[timerHandle]
+    self.__levelCounts[timerHandle.level] -= 1
+    timerHandle.slot = None
+  #end def (__remove)
+
+
+  # Must be called with the lock held. Processes self.__tick and returns what is due on it.
+  def __processTick(self):
+
+    tick = self.__tick
+
+    # Highest level first, whatever comes down from level 3 may need to go on down past level 1 as well
+    for level in range(len(_LEVEL_BITS) - 1, 0, -1):
+      if tick & ((1 << self.__levelShifts[level]) - 1) != 0:
+        continue
+      #end if
+
+      slots = self.__levels[level]
+      slotIndex = (tick >> self.__levelShifts[level]) & (len(slots) - 1)
+
+      cascading = slots[slotIndex]
+      slots[slotIndex] = {}
+
+      for timerHandle in cascading:
+        self.__levelCounts[level] -= 1
+        self.__place(timerHandle)
+      #end for
+    #end for
+
+    slots = self.__levels[0]
+    slotIndex = tick & (len(slots) - 1)
+
+    dueTimers = list(slots[slotIndex])
+    slots[slotIndex] = {}
+
+    for timerHandle in dueTimers:
+      self.__levelCounts[0] -= 1
+      timerHandle.slot = None
+    #end for
+
+    self.__tick += 1
+
+    return dueTimers
+  #end def (__processTick)
+
+
+  # True if the tick is where a level 1 slot cascades down
+  def __isOnBoundary(self, tick):
+    return tick & ((1 << _LEVEL_BITS[0]) - 1) == 0
+  #end def (__isOnBoundary)
+
+
+  # The first level 1 boundary after the tick
+  def __nextBoundary(self, tick):
+    return (tick | ((1 << _LEVEL_BITS[0]) - 1)) + 1
+  #end def (__nextBoundary)
+
+
+  # Fires whatever is due by now on the calling thread, and returns how many there were. The wheel's own
+  # thread does this, with StartThread = False (and a Clock to drive) it is up to the caller.
+  def RunDue(self):
+
+    with self.__condition:
+      dueTimers = self.__collectDue()
+    #end with
+
+    for timerHandle in dueTimers:
+      self.__fire(timerHandle)
+    #end for
+
+    return len(dueTimers)
+  #end def (RunDue)
+
+
+  # Must be called with the lock held. Processes every tick up to now, returns what is due.
+  def __collectDue(self):
+
+    dueTimers = []
+    nowTick = int((self.__clock() - self.__timestampStart) // self.__resolution)
+
+    while self.__tick <= nowTick:
+      # Nothing on level 0, so nothing can fire before the next level 1 slot comes round. A tick that
+      # is itself on a level 1 boundary still has its cascade to run, it is never skipped.
+      if (self.__levelCounts[0] == 0) and (self.__isOnBoundary(self.__tick) is False):
+        self.__tick = min(nowTick + 1, self.__nextBoundary(self.__tick))
+
+        if self.__tick > nowTick:
+          break
+        #end if
+      #end if
+
+      dueTimers.extend(self.__processTick())
+    #end while
+
+    return dueTimers
+  #end def (__collectDue)
+
+
+  # Must be called with the lock held. How long until the next tick that can fire or cascade anything, None with nothing pending.
+  def __secondsToNextTick(self):
+
+    if sum(self.__levelCounts) == 0:
+      return None
+    #end if
+
+    if (self.__levelCounts[0] > 0) or (self.__isOnBoundary(self.__tick) is True):
+      nextTick = self.__tick
+    else:
+      nextTick = self.__nextBoundary(self.__tick)
+    #end if
+
+    return max(0.0, self.__timestampStart + (nextTick * self.__resolution) - self.__clock())
+  #end def (__secondsToNextTick)
+
+
+  def __run(self):
+
+    while True:
+      with self.__condition:
+        dueTimers = self.__collectDue()
+
+        if len(dueTimers) == 0:
+          self.__condition.wait(self.__secondsToNextTick())
+          continue
+        #end if
+      #end with
+
+      for timerHandle in dueTimers:
+        self.__fire(timerHandle)
+      #end for
+    #end while
+
+  #end def (__run)
+
+
+  def __fire(self, timerHandle):
+
+    lateBy = self.__clock() - timerHandle.due
+
+    try:
+      timerHandle.callbackFunction(*timerHandle.callbackArgs)
+
+    except Exception:
+      queued_log.Error('>> Timer callback [{}] raised an exception:\n{}', getattr(timerHandle.callbackFunction, '__name__', timerHandle.callbackFunction), traceback.format_exc().rstrip())
+
+      with self.__condition:
+        self.__errorCount += 1
+      #end with
+    #end try
+
+    with self.__condition:
+      self.__firedCount += 1
+      self.__lateness.append(lateBy)
+    #end with
+
+  #end def (__fire)
+
+#end class
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+# MQTT Topic Router
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Incoming messages used to be dispatched with substring checks on the topic
+# ('COMMANDS' in topic, 'PONG' in topic, ...), which gets slower and more fragile with
+# every topic a puzzle cares about.
+#
+# A TopicRouter holds handlers registered against MQTT topic patterns, including the
+# usual '+' (exactly one level) and '#' (this level and everything below) wildcards:
+#
+#   router.AddRoute('COPI/fuel/COMMANDS', handleCommand)
+#   router.AddRoute('POPI/fuel/+',        handlePuzzleEvent)
+#
+# Patterns are compiled into a trie, one node per topic level, so routing a message
+# costs one dict lookup per level of its topic no matter how many routes there are.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+
+
+class _TopicNode:
+
+  __slots__ = ['children', 'handlers']
+
+  def __init__(self):
+    self.children = {}   # topic level (or '+' / '#') -> _TopicNode
+    self.handlers = []
+  #end def
+
+#end class
+
+
+class TopicRouter:
+
+  def __init__(self):
+    self.__root = _TopicNode()
+    self.__lock = threading.Lock()
+  #end def
+
+
+  def AddRoute(self, topicPattern, handlerFunction):
+
+    topicLevels = self.__splitPattern(topicPattern)
+
+    with self.__lock:
+      node = self.__root
+
+      for topicLevel in topicLevels:
+        node = node.children.setdefault(topicLevel, _TopicNode())
+      #end for
+
+      if handlerFunction not in node.handlers:
+        node.handlers.append(handlerFunction)
+      #end if
+    #end with
+
+  #end def (AddRoute)
+
+
+  def RemoveRoute(self, topicPattern, handlerFunction):
+
+    topicLevels = self.__splitPattern(topicPattern)
+
+    with self.__lock:
+      nodePath = [self.__root]
+
+      for topicLevel in topicLevels:
+        node = nodePath[-1].children.get(topicLevel)
+
+        if node is None:
+          return False
+        #end if
+
+        nodePath.append(node)
+      #end for
+
+      if handlerFunction not in nodePath[-1].handlers:
+        return False
+      #end if
+
+      nodePath[-1].handlers.remove(handlerFunction)
+
+      # Prune the branch back up as far as it is now empty
+      for index in range(len(topicLevels), 0, -1):
+        node = nodePath[index]
+
+        if (len(node.handlers) > 0) or (len(node.children) > 0):
+          break
+        #end if
+
+        del nodePath[index - 1].children[topicLevels[index - 1]]
+      #end for
+    #end with
+
+    return True
+  #end def (RemoveRoute)
+
+
+  def GetHandlers(self, topic):
+
+    handlerFunctions = []
+    topicLevels = topic.split('/')
+
+    with self.__lock:
+      self.__collect(self.__root, topicLevels, 0, handlerFunctions)
+    #end with
+
+    # Overlapping patterns for the same handler still only get it called once
+    uniqueHandlers = []
+
+    for handlerFunction in handlerFunctions:
+      if handlerFunction not in uniqueHandlers:
+        uniqueHandlers.append(handlerFunction)
+      #end if
+    #end for
+
+    return uniqueHandlers
+  #end def (GetHandlers)
+
+
+  # Calls every handler whose pattern matches the topic with the given arguments,
+  # and returns how many there were so the caller can deal with unrouted topics.
+  def Route(self, topic, *handlerArgs):
+
+    handlerFunctions = self.GetHandlers(topic)
+
+    # Handlers run outside the lock, they are free to add or remove routes
+    for handlerFunction in handlerFunctions:
+      handlerFunction(*handlerArgs)
+    #end for
+
+    return len(handlerFunctions)
+  #end def (Route)
+
+
+  def __splitPattern(self, topicPattern):
+
+    topicLevels = topicPattern.split('/')
+
+    for index, topicLevel in enumerate(topicLevels):
+      if ('#' in topicLevel) and ((topicLevel != '#') or (index != len(topicLevels) - 1)):
+        raise ValueError('Invalid topic pattern [{}], "#" must be a whole level and the last one'.format(topicPattern))
+      #end if
+
+      if ('+' in topicLevel) and (topicLevel != '+'):
+        raise ValueError('Invalid topic pattern [{}], "+" must be a whole level'.format(topicPattern))
+      #end if
+    #end for
+
+    return topicLevels
+  #end def (__splitPattern)
+
+
+  # Must be called with the lock held
+  def __collect(self, node, topicLevels, levelIndex, handlerFunctions):
+
+    # '#' also matches the parent level itself ('COPI/fuel/#' matches 'COPI/fuel')
+    wildcardNode = node.children.get('#')
+
+    if (wildcardNode is not None) and ((levelIndex > 0) or (not topicLevels[0].startswith('$'))):
+      handlerFunctions.extend(wildcardNode.handlers)
+    #end if
+
+    if levelIndex == len(topicLevels):
+      handlerFunctions.extend(node.handlers)
+      return
+    #end if
+
+    topicLevel = topicLevels[levelIndex]
+
+    exactNode = node.children.get(topicLevel)
+
+    if exactNode is not None:
+      self.__collect(exactNode, topicLevels, levelIndex + 1, handlerFunctions)
+    #end if
+
+    # Wildcards never match the $SYS style topics at the first level
+    plusNode = node.children.get('+')
+
+    if (plusNode is not None) and ((levelIndex > 0) or (not topicLevel.startswith('$'))):
+      self.__collect(plusNode, topicLevels, levelIndex + 1, handlerFunctions)
+    #end if
+
+  #end def (__collect)
+
+#end class
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+# RCPCS Wire Formats
+# Part of the RCPCS project (Room Control and Puzle Coordination System)
+# Copyright (C) 2019  Joel D. Caturia
+#
+#
+# Structured payloads (heartbeats, mostly) have always gone out as JSON text, and the
+# Node-RED room controller flows expect exactly that. JSON stays the default and the
+# fallback for everything.
+#
+# A controller can optionally send those payloads in a compact binary encoding instead.
+# Binary payloads start with a marker byte (0xC1) followed by a one byte format ID.
+# 0xC1 is never used by msgpack and can't start valid UTF-8 either, so a receiver can
+# always tell the two apart from the first byte, and DecodePayload() does exactly that.
+#
+# Every JSON heartbeat advertises the sender's protocolVersion and the wireFormats it
+# can produce. A room controller that wants something else asks for it by publishing
+# the format name to COPI/<puzzleID>/FORMAT.
+#
+# Plain string payloads (STATE, ERROR, COMMANDS) are already about as small as they
+# get, so they are always sent as-is.
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Python3 Dependencies (optional):
+#  - msgpack (only needed for the 'msgpack' wire format)
+#  $> sudo pip3 install msgpack
+
+
+import json
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+#end try
+
+
+# 1 -> JSON only (every controller before this module existed)
+# 2 -> JSON plus the binary formats below, advertised in the heartbeat
+PROTOCOL_VERSION = 2
+
+BINARY_MARKER = 0xC1
+
+_binaryFormatIDs = {'msgpack' : 1}
+
+
+def GetAvailableFormats():
+
+  availableFormats = ['json']
+
+  if msgpack is not None:
+    availableFormats.append('msgpack')
+  #end if
+
+  return availableFormats
+#end def (GetAvailableFormats)
+
+
+def EncodePayload(data, wireFormat = 'json'):
+
+  if (wireFormat == 'msgpack') and (msgpack is not None):
+    return bytes([BINARY_MARKER, _binaryFormatIDs['msgpack']]) + msgpack.packb(data, use_bin_type=True)
+  #end if
+
+  return json.dumps(data)
+#end def (EncodePayload)
+
+
+def DecodePayload(payload):
+
+  if isinstance(payload, str):
+    return json.loads(payload)
+  #end if
+
+  if (len(payload) >= 2) and (payload[0] == BINARY_MARKER):
+
+    if payload[1] == _binaryFormatIDs['msgpack']:
+      if msgpack is None:
+        raise ValueError('Received a msgpack payload, but msgpack is not installed')
+      #end if
+
+      return msgpack.unpackb(payload[2:], raw=False)
+    #end if
+
+    raise ValueError('Unknown binary wire format ID [{}]'.format(payload[1]))
+  #end if
+
+  return json.loads(payload.decode())
+#end def (DecodePayload)
@@ -0,0 +1 @@
+../QF/MS/mqtt_v5.py
\ No newline at end of file
@@ -26,12 +26,14 @@
 #   - paho-mqtt-client
 #   $> sudo pip3 install paho-mqtt
 #
+#   - mqtt_v5 (linked in from QF/MS, for --mqtt-v5)
+#
 
 import argparse
-import paho.mqtt.client as mqtt
 import time
 import json
 
+import mqtt_v5
 from PyDMX import *
 
 parser = argparse.ArgumentParser(description='Provide DMX lighting support in an MQTT ecosystem.')
@@ -39,6 +41,7 @@ parser = argparse.ArgumentParser(description='Provide DMX lighting support in an
 parser.add_argument('mqttHost', metavar='<MQTT BROKER>', help='The IP/hostname of the MQTT broker to connect to.')
 parser.add_argument('puzzleID', metavar='<PUZZLE ID>', help='The name of the puzzle. Will be used in all other places to reference this puzzle controller.')
 parser.add_argument('serialPort', metavar='<SERIAL PORT>', help='The serial port that your DMX data will be sent out of.')
+parser.add_argument('--mqtt-v5', action='store_true', dest='mqttV5', help='Connect with MQTT v5, falling back to 3.1.1 if the broker refuses it.')
 
 args = parser.parse_args()
 
@@ -47,10 +50,37 @@ brokerPort       = 1883
 puzzleName       = args.puzzleID
 serialPort	 = args.serialPort
 
-def on_connect(client, userdata, flags, rc):
+# Only with --mqtt-v5, and it falls back to 3.1.1 by itself (see mqtt_v5.py). A cue the room controller
+# sent with a MessageExpiryInterval is dropped by the broker rather than delivered late after a reconnect.
+mqttSession = mqtt_v5.MQTTv5Session() if args.mqttV5 is True else None
+
+def on_connect(client, userdata, flags, rc, properties = None):
+
+    if rc != 0:
+        if (mqttSession is not None) and (mqtt_v5.IsProtocolRefused(rc)):
+            mqtt_v5.FallBackToMQTTv311(client)
+            mqttSession.Disable()
+            print('MQTT broker does not support v5, falling back to 3.1.1..')
+        #end if
+
+        return
+    #end if
+
+    if mqttSession is not None:
+        mqttSession.OnConnect(properties)
+    #end if
+
     client.subscribe('COLI/' + puzzleName + '/ACTIVATE_CUE')
 #end def
 
+def on_disconnect(client, userdata, rc, properties = None):
+
+    if mqttSession is not None:
+        mqttSession.OnDisconnect()
+    #end if
+
+#end def
+
 REDchan   = 0
 GREENchan = 0
 BLUEchan  = 0
@@ -91,7 +121,8 @@ def on_message(client, userdata, message):
 		dmx.send()
 
 	else:
-		client.publish('CILO/' + puzzleName + '/ERROR', 'Unrecognized data received: [TOPIC: {}, PAYLOAD: {}]'.format(message.topic, message.payload.decode() ))
+		publishProperties = mqtt_v5.BuildPublishProperties(mqttSession, 60, mqtt_v5.GetUserProperty(message, mqtt_v5.CORRELATION_PROPERTY))
+		mqtt_v5.Publish(client, mqttSession, 'CILO/' + puzzleName + '/ERROR', 'Unrecognized data received: [TOPIC: {}, PAYLOAD: {}]'.format(message.topic, message.payload.decode() ), publishProperties = publishProperties)
 
         #end if
     #end if
@@ -99,7 +130,11 @@ def on_message(client, userdata, message):
 
 
 try:
-  client = mqtt.Client()
+  client = mqtt_v5.CreateClient(args.mqttV5)
+  client.on_connect    = on_connect
+  client.on_disconnect = on_disconnect
+  client.on_message    = on_message
+
   client.connect(brokerIP, brokerPort, 60)
   client.loop_start()
 
@@ -108,8 +143,6 @@ except:
   exit()
 
 #end try
-client.on_connect = on_connect
-client.on_message = on_message
 
 dmx = PyDMX(serialPort)
 
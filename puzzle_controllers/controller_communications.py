@@ -43,6 +43,9 @@ import uuid
 import re
 import math
 
+import flight_recorder
+import queued_log
+
 __platform__ = 'RCPCS/Python/RasPi'
 __version__  = '0.9'
 
@@ -63,7 +66,7 @@ class ControllerCommunications:
     
     
     def handlerMQTTonConnect(client, userdata, flags, rc):
-      print('>> Puzzle ID [{}] connected to MQTT Broker [{}:{}]..'.format(self.puzzleID, self.mqttBroker, self.mqttPort) )
+      queued_log.Info('>> Puzzle ID [{}] connected to MQTT Broker [{}:{}]..', self.puzzleID, self.mqttBroker, self.mqttPort)
       
       self.__MQTTConnected = True
       
@@ -97,7 +100,7 @@ class ControllerCommunications:
         incomingCommand = message.payload.decode()
                     
         if incomingCommand in ['RESET', 'ACTIVATE', 'SOLVE', 'PONG', 'REBOOT']:
-          print(' -> Received MQTT command: [{}]'.format(incomingCommand))
+          queued_log.Info(' -> Received MQTT command: [{}]', incomingCommand)
                             
           if incomingCommand == 'RESET':
             self.__callbacks['command_reset']()
@@ -116,6 +119,10 @@ class ControllerCommunications:
 
       elif ('PONG' in message.topic):
             self.__callbacks['pong']()
+
+      # Post-game debugging, see flight_recorder.py
+      elif ('DUMP' in message.topic):
+        flight_recorder.GetSharedRecorder().TryDump('mqtt')
                   
       else:
         self.mqttClient.publish('CIPO/' + self.puzzleID + '/ERROR', 'Unknown COMMAND received: [{}]'.format(incomingCommand))
@@ -138,13 +145,13 @@ class ControllerCommunications:
 
     while (self.__MQTTConnected == False):
       try:
-        print(">> Attempting MQTT broker connection..")
+        queued_log.Info(">> Attempting MQTT broker connection..")
         self.mqttClient.connect(self.mqttBroker, self.mqttPort, self.mqttKeepalive)
         self.mqttClient.loop_start()  
         time.sleep(1)
 
       except:
-        print('>> Unable to connect to MQTT broker! Sleeping for {} seconds..'.format(backOffTimer) )
+        queued_log.Warning('>> Unable to connect to MQTT broker! Sleeping for {} seconds..', backOffTimer)
         time.sleep(backOffTimer)
       #end try
     #end while
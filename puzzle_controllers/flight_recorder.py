@@ -0,0 +1 @@
+../QF/MS/flight_recorder.py
\ No newline at end of file
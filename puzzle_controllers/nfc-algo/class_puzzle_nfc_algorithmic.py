@@ -21,9 +21,12 @@ import nfc
 import ndef
 from nfc.clf import RemoteTarget
 
+import flight_recorder
+import queued_log
+
 class AlgorithmicPuzzleNFC:
 
-    def __init__(self, ReaderPort, Debug = False):
+    def __init__(self, ReaderPort, Debug = False, PuzzleID = None, Recorder = None):
     
         self.__debugFlag = Debug
         self.__readerPort = ReaderPort	## LOOKS LIKE: tty:USB0:pn532
@@ -35,6 +38,10 @@ class AlgorithmicPuzzleNFC:
         self.__puzzleSolved   = False
         self.__cardPresent    = False
 
+        # What the puzzle did, kept in memory until somebody asks for it (see flight_recorder.py)
+        self.__puzzleID       = PuzzleID
+        self.__recorder       = Recorder if Recorder is not None else flight_recorder.GetSharedRecorder()
+
         # FIXME - we need way better error checking (callbacks?) here
         # when/if we cannot communicate with our NFC readers
         # this is especially bad when we're buried deep inside a puzzle
@@ -43,6 +50,11 @@ class AlgorithmicPuzzleNFC:
         self.__clf = nfc.ContactlessFrontend(self.__readerPort)
 
     #end def
+
+
+    def __recordEvent(self, eventName, payload = None):
+        self.__recorder.Record(self.__puzzleID, eventName, payload)
+    #end def (__recordEvent)
     
     
     def AppendToSolutionPattern(self, solutionText):
@@ -57,6 +69,8 @@ class AlgorithmicPuzzleNFC:
     
     def EnterNewElement(self, enteredElement):
 
+        self.__recordEvent('tag', {'text': enteredElement})
+
         # Slide everything in our user pattern list of once to the left
         self.__userPattern = self.__userPattern[1:]
 
@@ -68,19 +82,19 @@ class AlgorithmicPuzzleNFC:
     
 
     def SpillYourGuts(self):
-        print('===================')
-        print('INTERNAL STATE DUMP')
-        print('===================')
-        print('PATTERN LENGTH: [{}]'.format(self.__patternLength))
-        print('CORRECT PATTERN:')
-        print(self.__correctPattern)
-        print('\r\n')
+        queued_log.Info('===================')
+        queued_log.Info('INTERNAL STATE DUMP')
+        queued_log.Info('===================')
+        queued_log.Info('PATTERN LENGTH: [{}]', self.__patternLength)
+        queued_log.Info('CORRECT PATTERN:')
+        queued_log.Info('{}', self.__correctPattern)
+        queued_log.Info('\r\n')
         
-        print('USER PATTERN:')
-        print(self.__userPattern)
-        print('\r\n')
-        print('SOLVED STATE: [{}]'.format(self.__puzzleSolved))
-        print('===================')
+        queued_log.Info('USER PATTERN:')
+        queued_log.Info('{}', self.__userPattern)
+        queued_log.Info('\r\n')
+        queued_log.Info('SOLVED STATE: [{}]', self.__puzzleSolved)
+        queued_log.Info('===================')
     #end def (SpillYourGuts)        
 
 
@@ -89,10 +103,11 @@ class AlgorithmicPuzzleNFC:
         if self.__correctPattern == self.__userPattern:
             
             if self.__debugFlag is True:
-                print('>> PUZZLE SOLVED!')
+                queued_log.Debug('>> PUZZLE SOLVED!')
             #end if
             
             self.__puzzleSolved = True
+            self.__recordEvent('solved', {'pattern': list(self.__userPattern)})
 
             try:            
                 self.__callbacks['Solved']()
@@ -110,6 +125,7 @@ class AlgorithmicPuzzleNFC:
     def Reset(self):
         self.__userPattern = []
         self.__puzzleSolved = False
+        self.__recordEvent('reset')
     #end def (Reset)
 
 
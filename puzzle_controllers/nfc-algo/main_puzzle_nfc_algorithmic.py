@@ -18,6 +18,8 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import flight_recorder
+import queued_log
 from class_puzzle_nfc_algorithmic import AlgorithmicPuzzleNFC
 
 puzzle = AlgorithmicPuzzleNFC('tty:USB0:pn532', Debug = True)
@@ -29,7 +31,7 @@ puzzle.AppendToSolutionPattern('shoreline.nt.altar.koran')
 puzzle.AppendToSolutionPattern('shoreline.nt.altar.torah')
 
 puzzle.SpillYourGuts()
-print('>> Waiting for NFC tag..')
+queued_log.Info('>> Waiting for NFC tag..')
 
 try:
 
@@ -41,17 +43,18 @@ try:
        
             puzzle.SpillYourGuts()
 
-            print('>> Waiting for NFC tag..')
+            queued_log.Info('>> Waiting for NFC tag..')
         #end if
     #end while
 
     puzzle.Cleanup()
 
 except KeyboardInterrupt:
-    print('\r\nCTRL+C Received! Exiting..\r\n')
+    queued_log.Info('\r\nCTRL+C Received! Exiting..\r\n')
     
 except Exception as e:
-    print(e)
+    queued_log.Error('{}', e)
+    flight_recorder.GetSharedRecorder().TryDump('crash')
 
 finally:
     puzzle.Cleanup()
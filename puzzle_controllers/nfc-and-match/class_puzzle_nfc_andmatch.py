@@ -21,9 +21,12 @@ import nfc
 import ndef
 from nfc.clf import RemoteTarget
 
+import flight_recorder
+import queued_log
+
 class ANDMatchPuzzleNFC:
 
-    def __init__(self, Debug = False):
+    def __init__(self, Debug = False, PuzzleID = None, Recorder = None):
 
         self.__debugFlag             = Debug
         self.__puzzleReaderElements  = {}
@@ -31,9 +34,18 @@ class ANDMatchPuzzleNFC:
         self.__readerStorageDict     = {}
         self.__callbacks             = {}
         self.__puzzleSolved          = False
+
+        # What the puzzle did, kept in memory until somebody asks for it (see flight_recorder.py)
+        self.__puzzleID              = PuzzleID
+        self.__recorder              = Recorder if Recorder is not None else flight_recorder.GetSharedRecorder()
       
 
     #end def (__init__)
+
+
+    def __recordEvent(self, eventName, payload = None):
+        self.__recorder.Record(self.__puzzleID, eventName, payload)
+    #end def (__recordEvent)
     
     def AddPuzzleElement(self, ReaderPort, FriendlyName, MatchingText):
 
@@ -44,44 +56,49 @@ class ANDMatchPuzzleNFC:
         # mechanism - perhaps even using the powered USB hub to our advantage
 
         if self.__debugFlag is True:
-            print('>> Attempting to add NFC reader: [NAME:{}] [PORT:{}]'.format(FriendlyName, ReaderPort))
+            queued_log.Debug('>> Attempting to add NFC reader: [NAME:{}] [PORT:{}]', FriendlyName, ReaderPort)
         #end if
        
         ## LOOKS LIKE: tty:USB0:pn532 (on Linux)
         self.__puzzleReaderElements[FriendlyName] = nfc.ContactlessFrontend(ReaderPort)  
     
         if self.__puzzleReaderElements[FriendlyName]:
-            if self.__debugFlag is True: print('  >> SUCCESS!')
+            if self.__debugFlag is True: queued_log.Debug('  >> SUCCESS!')
 
             self.__puzzleMatchElements[FriendlyName] = MatchingText            
+            self.__recordEvent('reader_added', {'reader': FriendlyName, 'port': ReaderPort})
     
     #end def (AddPuzzleElement)
 
 
     def SpillYourGuts(self):
-        print('===================')
-        print('INTERNAL STATE DUMP')
-        print('===================')
+        queued_log.Info('===================')
+        queued_log.Info('INTERNAL STATE DUMP')
+        queued_log.Info('===================')
 #        print('PATTERN LENGTH: [{}]'.format(self.__patternLength))
-        print('MATCH DICTIONARY:')
-        print(self.__puzzleMatchElements)
-        print('\r\n')
-
-        print('REAL-TIME DICTIONARY:')
-        print(self.__readerStorageDict)
-        print('\r\n')
-        print('SOLVED STATE: [{}]'.format(self.__puzzleSolved))
-        print('===================')
+        queued_log.Info('MATCH DICTIONARY:')
+        queued_log.Info('{}', self.__puzzleMatchElements)
+        queued_log.Info('\r\n')
+
+        queued_log.Info('REAL-TIME DICTIONARY:')
+        queued_log.Info('{}', self.__readerStorageDict)
+        queued_log.Info('\r\n')
+        queued_log.Info('SOLVED STATE: [{}]', self.__puzzleSolved)
+        queued_log.Info('===================')
     #end def (SpillYourGuts)        
 
     
     def ProcessEvents(self):
         for friendlyName, objReader in self.__puzzleReaderElements.items():
-            print(' >>> SERVICE -> [{}]'.format(friendlyName))
+            queued_log.Debug(' >>> SERVICE -> [{}]', friendlyName)
 
             target = objReader.sense(RemoteTarget("106A"))
 
             if target is None:
+                if self.__readerStorageDict.get(friendlyName) is not None:
+                    self.__recordEvent('tag_removed', {'reader': friendlyName})
+                #end if
+
                 self.__readerStorageDict[friendlyName] = None
                 continue
                 
@@ -92,6 +109,11 @@ class ANDMatchPuzzleNFC:
                     if len(tag.ndef.records) > 0:
                         record = tag.ndef.records[0]
 
+                        # The tag is read again on every pass, only a change is worth recording
+                        if self.__readerStorageDict.get(friendlyName) != record.text:
+                            self.__recordEvent('tag', {'reader': friendlyName, 'text': record.text})
+                        #end if
+
                         self.__readerStorageDict[friendlyName] = record.text
                         
                         #self.CheckForSolve()
@@ -109,6 +131,7 @@ class ANDMatchPuzzleNFC:
             # or the card is sitting in the magnetic field enough to confuse the
             # reader but not enough to get good data.
             except:
+                self.__recordEvent('read_error', {'reader': friendlyName})
                 return None
             #end try
 
@@ -126,7 +149,7 @@ class ANDMatchPuzzleNFC:
             try:
                 if self.__readerStorageDict[friendlyName] == textToMatch:
                     if self.__debugFlag is True:
-                        print('>> [{}] - MATCH - [{}]'.format(friendlyName, textToMatch))
+                        queued_log.Debug('>> [{}] - MATCH - [{}]', friendlyName, textToMatch)
 
                     next
                 
@@ -139,7 +162,7 @@ class ANDMatchPuzzleNFC:
            # exist - technically that would mean the puzzle was not solved so that's how we'll handle it
            # for the time being.  
             except:
-                print('EXCEPTION!')
+                queued_log.Warning('EXCEPTION!')
                 self.__puzzleSolved = False
                 return False
             #end try
@@ -148,6 +171,7 @@ class ANDMatchPuzzleNFC:
         if tmpPuzzleSolved is True:
 
             self.__puzzleSolved = tmpPuzzleSolved
+            self.__recordEvent('solved')
     
             try:
                 self.__callbacks['Solved']()
@@ -168,7 +192,7 @@ class ANDMatchPuzzleNFC:
 
     def Cleanup(self):
         for friendlyName, objReader in self.__puzzleReaderElements.items():
-            print('CLEANUP -> [{}]'.format(friendlyName))
+            queued_log.Info('CLEANUP -> [{}]', friendlyName)
             objReader.close()
         #end for
     #end def (Cleanup)
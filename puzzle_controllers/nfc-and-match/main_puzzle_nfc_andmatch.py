@@ -18,6 +18,8 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import flight_recorder
+import queued_log
 from class_puzzle_nfc_andmatch import ANDMatchPuzzleNFC
 
 puzzle = ANDMatchPuzzleNFC(Debug = True)
@@ -38,10 +40,11 @@ try:
     #puzzle.Cleanup()
 
 except KeyboardInterrupt:
-    print('\r\nCTRL+C Received! Exiting..\r\n')
+    queued_log.Info('\r\nCTRL+C Received! Exiting..\r\n')
 
 except Exception as e:
-    print(e)
+    queued_log.Error('{}', e)
+    flight_recorder.GetSharedRecorder().TryDump('crash')
 
 finally:
     puzzle.Cleanup()
@@ -0,0 +1 @@
+../QF/MS/queued_log.py
\ No newline at end of file
@@ -40,6 +40,8 @@ import json
 import curses
 from   curses import wrapper
 
+import queued_log
+
 
 __platform__ = 'Simu-Puzzle'
 __version__  = '0.9'
@@ -270,7 +272,7 @@ try:
     client.loop_start()
 
 except:
-    print('\r\nERROR: unable to communicate with MQTT broker. Exiting...')
+    queued_log.Error('\r\nERROR: unable to communicate with MQTT broker. Exiting...')
     exit()
 #end try
 
@@ -308,7 +310,7 @@ try:
 
             if  menuSelection in ['q', 'Q']:  # (q)uit
                 curses.endwin()
-                print('Simu-Puzzle terminating normally..\r\n')
+                queued_log.Info('Simu-Puzzle terminating normally..\r\n')
                 exit()
 
             elif menuSelection in ['a', 'A']: # (a)ctivate      
@@ -341,11 +343,11 @@ try:
 
 except KeyboardInterrupt:
     curses.endwin()
-    print('\r\nCTRL+C detected, exiting..\r\n')
+    queued_log.Info('\r\nCTRL+C detected, exiting..\r\n')
 
 except Exception as e:
     curses.endwin()
-    print(e)
+    queued_log.Error('{}', e)
 
 finally:
     pass
@@ -31,6 +31,7 @@ import time
 
 from puzzle_controller import PuzzleClass as PuzzleClass
 from controller_communications import ControllerCommunications
+import queued_log
 
 chan_list = [11, 13]
 resetPin = 15
@@ -81,7 +82,7 @@ puzzle.RegisterCallback('reset', handlerPuzzleReset)
 roomController = ControllerCommunications('reactor', '192.168.200.138')
 
 def handlerRoomControllerReboot():
-  print('>> Processing a remote reboot command!')
+  queued_log.Info('>> Processing a remote reboot command!')
 #  time.sleep(3)
   os.system('sudo reboot')
 #end def
@@ -122,14 +123,17 @@ try:
 
   puzzle.reset()
 
+  # Neither of these blocks, so sleep a little each time round or this spins a core. pygame
+  # keeps the touch events queued up in the meantime and 10ms is still well under a frame.
   while True:
     puzzle.ProcessEvents()
     roomController.ProcessEvents()
+    time.sleep(.01)
   #end while
   
 except (KeyboardInterrupt, SystemExit):
   GPIO.cleanup()
-  print("Exiting..")
+  queued_log.Info("Exiting..")
   quit()
 
 except:
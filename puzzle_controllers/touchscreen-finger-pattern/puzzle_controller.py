@@ -31,11 +31,14 @@ from pygame.locals import *
 
 import time
 
+import flight_recorder
+import queued_log
+
 class PuzzleClass:
 
-    def __init__(self, DebugMode = False):
+    def __init__(self, DebugMode = False, PuzzleID = None, Recorder = None):
 
-        print('Puzzle Initialization Beginning..')
+        queued_log.Info('Puzzle Initialization Beginning..')
 
         # When we're in "Debug Mode" we want the screen to be smaller,
         #   the window to be resizeable, and not lose our mouse cursor
@@ -64,6 +67,10 @@ class PuzzleClass:
         
         self.callbacks = {}		# Holds our event callbacks
 
+        # What the puzzle did, kept in memory until somebody asks for it (see flight_recorder.py)
+        self.__puzzleID = PuzzleID
+        self.__recorder = Recorder if Recorder is not None else flight_recorder.GetSharedRecorder()
+
         self.stateSolved = False	# Holds our winning state
         
         # Define some colors in a dictionary (RGB values as a tuple)
@@ -136,6 +143,11 @@ class PuzzleClass:
     #end def (__init__)
 
 
+    def __recordEvent(self, eventName, payload = None):
+        self.__recorder.Record(self.__puzzleID, eventName, payload)
+    #end def (__recordEvent)
+
+
     def reset(self):
 
         self.current_combo = [
@@ -168,8 +180,9 @@ class PuzzleClass:
         self.pos = 'start'
 
         self.stateSolved = False
+        self.__recordEvent('reset')
         
-        print('[PUZZLE] > Resetting..')
+        queued_log.Info('[PUZZLE] > Resetting..')
 
         if 'reset' in self.callbacks.keys():
             self.callbacks['reset']()
@@ -184,13 +197,14 @@ class PuzzleClass:
 
     def solve(self):
         self.stateSolved = True
+        self.__recordEvent('solved')
 
         if 'solve' in self.callbacks.keys():
             self.callbacks['solve']()
         #end if
 
         self.__showSolvedText()
-        print('[PUZZLE] > Solved!!')
+        queued_log.Info('[PUZZLE] > Solved!!')
     #end def (solve)
         
 
@@ -256,15 +270,15 @@ class PuzzleClass:
 
         tmpSolvedState = True
         for x in range(0, 10):
-            print('[PUZZLE] > [{0}] WANTED: [x={1} y={2}]'.format(x, self.right_combo[x][0], self.right_combo[x][1]), end='')
-            print(' -> GOT: [x={1} y={2}]'.format(x, self.current_combo[x][0], self.current_combo[x][1]), end='')
-            
             if self.right_combo[x][0] != self.current_combo[x][0] or self.right_combo[x][1] != self.current_combo[x][1]:
                 tmpSolvedState = False
-                print(' -> Incorrect')
+                dotResult = 'Incorrect'
             else:
-                print(' -> OK!')
+                dotResult = 'OK!'
             #end if
+
+            queued_log.Debug('[PUZZLE] > [{0}] WANTED: [x={1} y={2}] -> GOT: [x={3} y={4}] -> {5}', x, self.right_combo[x][0], self.right_combo[x][1],
+                             self.current_combo[x][0], self.current_combo[x][1], dotResult)
         #end for
         
         return tmpSolvedState
@@ -283,7 +297,7 @@ class PuzzleClass:
             if self.pos == 'start':
                 xx, yy = self.__check_area(x, y, 40)
                 if xx >= 0 and yy >= 0 and (xx != self.last_xx or yy != self.last_yy):
-                    print('[PUZZLE] > dot coordinate: {0}x{1}'.format(xx, yy) )
+                    queued_log.Debug('[PUZZLE] > dot coordinate: {0}x{1}', xx, yy)
                     self.last_xx = xx
                     self.last_yy = yy
                     self.cnt += 1
@@ -296,17 +310,19 @@ class PuzzleClass:
 
                     self.current_combo[0][0] = xx
                     self.current_combo[0][1] = yy
+                    self.__recordEvent('dot', {'index': 0, 'x': xx, 'y': yy})
                 #end if
                 
             elif self.pos == 'end':
                 xx, yy = self.__check_area(x, y, 40)
                 
                 if xx >= 0 and yy >= 0 and (xx != self.last_xx or yy != self.last_yy):
-                    print('[PUZZLE] > dot coordinate: {0}x{1}'.format(xx, yy) )
+                    queued_log.Debug('[PUZZLE] > dot coordinate: {0}x{1}', xx, yy)
                     self.last_xx = xx
                     self.last_yy = yy
                     self.current_combo[self.cnt][0] = xx
                     self.current_combo[self.cnt][1] = yy
+                    self.__recordEvent('dot', {'index': self.cnt, 'x': xx, 'y': yy})
                     self.line_x[1] = xx
                     self.line_y[1] = yy
                     self.pos = 'end'
@@ -327,13 +343,14 @@ class PuzzleClass:
                 
                 else:
                     self.stateSolved = False
+                    self.__recordEvent('failed', {'combination': [list(dot) for dot in self.current_combo]})
                     
                     if 'fail' in self.callbacks.keys():
                         self.callbacks['fail']()
                     #end if
                     
                     self.__showFailedText()    
-                    print('[PUZZLE] > PUZZLE FAILED')
+                    queued_log.Info('[PUZZLE] > PUZZLE FAILED')
                     
                     time.sleep(3)
                 